@@ -0,0 +1,114 @@
+import threading
+from adscore import stats
+
+class Overloaded(Exception):
+    """
+    The upstream service has no free slot and the request waited (or would have
+    waited) too long for one
+    """
+
+class Upstream(object):
+    """
+    Bounded number of simultaneous requests to one upstream service, shared by
+    all the threads of the process
+    """
+
+    def __init__(self, name, url, concurrency, queue_timeout, max_queue):
+        self.name = name
+        self.url = url
+        self.concurrency = concurrency
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue
+        self._semaphore = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.admitted = 0
+        self.shed = 0
+
+    def acquire(self):
+        if self._semaphore.acquire(blocking=False):
+            acquired = True
+        else:
+            with self._lock:
+                if self.waiting >= self.max_queue:
+                    self.shed += 1
+                    raise Overloaded(self.name)
+                self.waiting += 1
+                self.max_waiting = max(self.max_waiting, self.waiting)
+            try:
+                acquired = self._semaphore.acquire(timeout=self.queue_timeout)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+        with self._lock:
+            if not acquired:
+                self.shed += 1
+                raise Overloaded(self.name)
+            self.in_flight += 1
+            self.admitted += 1
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._semaphore.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'concurrency': self.concurrency,
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'max_waiting': self.max_waiting,
+            'admitted': self.admitted,
+            'shed': self.shed,
+        }
+
+class AdmissionControl(object):
+    """
+    Limit the requests that each worker process sends simultaneously to every
+    upstream service listed in UPSTREAM_LIMITS (keyed by the name of their
+    setting, e.g. SEARCH_SERVICE), requests to any other URL share the default
+    limit. Requests wait at most queue_timeout seconds for a free slot (and no
+    more than max_queue of them wait at the same time), otherwise they are shed
+    so that a slow service cannot keep every thread of the worker busy.
+    """
+
+    def __init__(self, app=None):
+        self.upstreams = []
+        self.default = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        settings = app.config['UPSTREAM_LIMITS']
+        defaults = dict(settings['default'])
+        self.default = Upstream('default', app.config['API_URL'], **defaults)
+        for name, upstream_settings in settings.items():
+            if name != 'default':
+                self.upstreams.append(Upstream(name, app.config[name], **dict(defaults, **upstream_settings)))
+        # Longest URLs first so that the most specific service matches
+        self.upstreams.sort(key=lambda upstream: len(upstream.url), reverse=True)
+
+        if not hasattr(app, "extensions"):
+            app.extensions = {}
+        app.extensions['admission'] = self
+        stats.register('upstreams', self.stats)
+
+    def upstream(self, url):
+        for upstream in self.upstreams:
+            if url.startswith(upstream.url):
+                return upstream
+        return self.default
+
+    def stats(self):
+        return {upstream.name: upstream.stats() for upstream in self.upstreams + [self.default]}
@@ -1,90 +1,189 @@
-import json
 from collections.abc import Mapping
-from flask import current_app
+from flask import current_app, g
+from werkzeug.exceptions import ServiceUnavailable
+from adscore import cache, json_codec
 from .requests import RequestsManager
 from .search import Search
 
 class Abstract(Mapping):
-    def __init__(self, identifier):
+    def __init__(self, identifier, refresh=False):
+        """
+        Record from the cache or from the API (always from the API if refresh is
+        set, to rebuild the cached record before it expires)
+        """
         self.manager = RequestsManager()
+        storage = None
+        missing = False
         try:
-            redis_client = current_app.extensions['redis']
-            storage = redis_client.get(identifier)
+            if not refresh:
+                storage = cache.get(identifier)
+                if not storage:
+                    # Alternative identifiers (e.g., DOIs) point to the record
+                    # stored under its bibcode
+                    bibcode = self.alias(identifier)
+                    if bibcode:
+                        storage = cache.get(bibcode)
+                # A recent search did not find any record with this identifier
+                missing = not storage and cache.get(self.missing_key(identifier)) is not None
             if storage:
-                storage = json.loads(storage.decode('utf-8'))
+                storage = json_codec.loads(storage)
         except Exception:
             current_app.logger.exception("Exception while restoring abstract results from cache")
             # Do not affect users if connection to Redis is lost in production
             if current_app.debug:
                 raise
             storage = None
-            redis_client = None
         if storage:
             self._storage = storage
+        elif missing:
+            self._storage = {'error': "Record not found."}
         else:
             self._storage = {}
-            docs = self._abstract(identifier)
-            if docs and len(docs) > 0:
-                self._storage.update(self._augment(docs[0]))
+            results = self._abstract(identifier, refresh=refresh)
+            docs = results.get('response', {}).get('docs', [])
+            if docs:
+                self._storage.update(docs[0])
             else:
                 self._storage['error'] = "Record not found."
             try:
-                if redis_client:
-                    redis_client.set(identifier, json.dumps(self._storage), ex=current_app.config['REDIS_EXPIRATION_TIME'])
+                if docs:
+                    bibcode = self._storage['bibcode']
+                    cache.set(bibcode, json_codec.dumps(self._storage), ex=current_app.config['REDIS_EXPIRATION_TIME'], tags=(bibcode,))
+                    if bibcode != identifier:
+                        cache.set(self.alias_key(identifier), bibcode, ex=current_app.config['REDIS_ALIAS_EXPIRATION_TIME'], tags=(bibcode,))
+                elif 'error' not in results:
+                    # Transient errors are not remembered as missing records
+                    cache.set(self.missing_key(identifier), "", ex=current_app.config['REDIS_MISSING_EXPIRATION_TIME'])
             except Exception:
                 current_app.logger.exception("Exception while storing abstract results to cache")
                 # Do not affect users if connection to Redis is lost in production
                 if current_app.debug:
                     raise
+        if 'bibcode' in self._storage and not refresh:
+            cache.touch(self._storage['bibcode'], {'abstract': self._storage['bibcode']})
+
+    @staticmethod
+    def alias_key(identifier):
+        """
+        Redis key that maps an alternative identifier to its bibcode
+        """
+        return "/".join((current_app.config['REDIS_ALIAS_KEY_PREFIX'], identifier))
+
+    @staticmethod
+    def alias(identifier):
+        """
+        Bibcode of an alternative identifier if it is already known, None otherwise
+        """
+        bibcode = cache.get(Abstract.alias_key(identifier))
+        return bibcode.decode('utf-8') if bibcode else None
+
+    @staticmethod
+    def missing_key(identifier):
+        """
+        Redis key that marks identifiers without record
+        """
+        return "/".join((current_app.config['REDIS_MISSING_KEY_PREFIX'], identifier))
 
     def __getitem__(self, key):
+        if key not in self._storage and key in self.sections and 'bibcode' in self._storage:
+            # Sub-resources are retrieved only when they are used
+            self._storage[key] = self._section(key)
         return self._storage[key]
 
     def __iter__(self):
+        if 'bibcode' in self._storage:
+            return iter(list(self._storage) + [section for section in self.sections if section not in self._storage])
         return iter(self._storage)
 
     def __len__(self):
-        return len(self._storage)
+        return len(list(iter(self)))
+
+    # Sub-resources of the record, they are retrieved and cached separately so
+    # that each one has its own expiration time
+    sections = ("associated", "graphics", "metrics", "export")
+
+    # Values used when a sub-resource is not available
+    section_defaults = {"associated": [], "graphics": [], "metrics": {}, "export": None}
 
-    def _augment(self, doc):
+    @staticmethod
+    def section_key(bibcode, section):
+        return "/".join((current_app.config['REDIS_DATA_KEY_PREFIX'], bibcode, section))
+
+    def refresh_section(self, section):
         """
-        Retreive complementary data
+        Rebuild the cached sub-resource from the API
         """
-        # Retrieve extra information
-        doc['associated'] = []
-        if 'ASSOCIATED' in doc.get('property', []):
-            associated = self._resolver(doc['bibcode'], resource="associated")
-            if 'error' not in associated:
-                doc['associated'] = associated.get('links', {}).get('records', [])
+        self._storage[section] = self._section(section, refresh=True)
 
-        graphics = self._graphics(doc['bibcode'])
-        if 'error' not in graphics:
-            doc['graphics'] = graphics
+    def _section(self, section, refresh=False):
+        """
+        Retrieve a sub-resource from the cache or from the API, errors are cached
+        (as empty values) only for REDIS_EXPIRATION_TIME seconds
+        """
+        bibcode = self._storage['bibcode']
+        key = self.section_key(bibcode, section)
+        try:
+            value = cache.get(key) if not refresh else None
+            if value:
+                return json_codec.loads(value)['value']
+        except Exception:
+            current_app.logger.exception("Exception while restoring abstract %s from cache", section)
+            # Do not affect users if connection to Redis is lost in production
+            if current_app.debug:
+                raise
+        try:
+            value, error = getattr(self, "_load_" + section)(bibcode)
+        except ServiceUnavailable:
+            # The service is overloaded, show the page without this sub-resource
+            # (and do not let anyone cache it)
+            g.degraded = True
+            return self.section_defaults[section]
+        if error:
+            expiration_time = current_app.config['REDIS_EXPIRATION_TIME']
         else:
-            doc['graphics'] = []
+            expiration_time = current_app.config['REDIS_ABSTRACT_SECTIONS_EXPIRATION_TIME'][section]
+        try:
+            cache.set(key, json_codec.dumps({'value': value}), ex=expiration_time, tags=(bibcode,))
+        except Exception:
+            current_app.logger.exception("Exception while storing abstract %s to cache", section)
+            # Do not affect users if connection to Redis is lost in production
+            if current_app.debug:
+                raise
+        return value
+
+    def _load_associated(self, bibcode):
+        if 'ASSOCIATED' not in self._storage.get('property', []):
+            return self.section_defaults['associated'], False
+        associated = self._resolver(bibcode, resource="associated")
+        if 'error' not in associated:
+            return associated.get('links', {}).get('records', []), False
+        return self.section_defaults['associated'], True
+
+    def _load_graphics(self, bibcode):
+        graphics = self._graphics(bibcode)
+        if 'error' not in graphics:
+            return graphics, False
+        return self.section_defaults['graphics'], True
 
-        metrics = self._metrics(doc['bibcode'])
+    def _load_metrics(self, bibcode):
+        metrics = self._metrics(bibcode)
         if 'error' not in metrics and 'Error' not in metrics:
-            doc['metrics'] = metrics
-        else:
-            doc['metrics'] = {}
+            return metrics, False
+        return self.section_defaults['metrics'], True
 
-        export = self._export(doc['bibcode'])
+    def _load_export(self, bibcode):
+        export = self._export(bibcode)
         if 'error' not in export:
-            doc['export'] = export.get('export')
-        else:
-            doc['export'] = None
-
-        return doc
+            return export.get('export'), False
+        return self.section_defaults['export'], True
 
-    def _abstract(self, identifier):
+    def _abstract(self, identifier, refresh=False):
         """
-        Retrieve abstract
+        Retrieve abstract (search results with at most one document)
         """
         q = 'identifier:"{0}"'.format(identifier)
         fields = 'identifier,[citations],abstract,author,bibcode,bibstem,book_author,citation_count,comment,issn,isbn,doi,id,keyword,page,page_range,property,esources,pub,pub_raw,publisher,pubdate,pubnote,read_count,title,volume,data,issue,doctype'
-        search = Search(q, rows=1, start=0, sort="date desc", fields=fields)
-        return search.get('response', {}).get('docs', [])
+        return Search(q, rows=1, start=0, sort="date desc", fields=fields, refresh=refresh)
 
     def _export(self, bibcode, retry_counter=0):
         """
@@ -1,47 +1,155 @@
+import hashlib
+import itertools
+import collections
 import urllib.parse
-from flask import request, current_app
+import concurrent.futures
+from flask import request, current_app, copy_current_request_context
+from werkzeug.exceptions import ServiceUnavailable, HTTPException
+from adscore import cache
 from .abstract import Abstract
 from .search import Search
 from .requests import RequestsManager
+from . import objects
+
+# Fields shown in the search results page
+SEARCH_FIELDS = "title,bibcode,author,citation_count,citation_count_norm,pubdate,[citations],property,esources,data,publisher"
 
 class API(object):
     def __init__(self):
         """
-        Create an API object, bootstrap if auth is empty (it will use the provided
-        cookies so that it can take into account any BBB session)
+        Create an API object, if auth is empty it bootstraps before the first
+        request to the API (using the provided cookies so that it can take into
+        account any BBB session), requests fully served from the cache never
+        bootstrap
         """
         self.manager = RequestsManager()
+        self.num_found = None
 
-    def search(self, q, rows=25, start=0, sort="date desc", fields="title,bibcode,author,citation_count,citation_count_norm,pubdate,[citations],property,esources,data,publisher"):
+    def search(self, q, rows=25, start=0, sort="date desc", fields=SEARCH_FIELDS):
         return Search(q, rows=rows, start=start, sort=sort, fields=fields)
 
+    def iterate(self, q, fields="bibcode", rows=2000, sort="id asc"):
+        """
+        Iterate over every document that matches the query using cursor paging
+        (the sort has to include the unique id field), only one page of results
+        is kept in memory. The number of matching documents is stored in
+        num_found once the first page is retrieved.
+        """
+        cursor_mark = "*"
+        while True:
+            params = {
+                        'q': q,
+                        'fl': fields,
+                        'rows': rows,
+                        'sort': sort,
+                        'cursorMark': cursor_mark,
+                        }
+            results = self.manager.request(current_app.config['SEARCH_SERVICE'], params, method="GET", retry_counter=0)
+            if 'error' in results:
+                raise Exception("Search failed while iterating over '{}': {}".format(q, results['error']))
+            self.num_found = results.get('response', {}).get('numFound', self.num_found)
+            for doc in results.get('response', {}).get('docs', []):
+                yield doc
+            next_cursor_mark = results.get('nextCursorMark')
+            if not next_cursor_mark or next_cursor_mark == cursor_mark:
+                break
+            cursor_mark = next_cursor_mark
+
+    def export(self, q, sort="date desc"):
+        """
+        Export every document that matches the query (up to EXPORT_MAX_RECORDS)
+        as BibTeX, yielding the export of each batch of EXPORT_BATCH_SIZE
+        bibcodes in order. At most EXPORT_MAX_WORKERS batches are exported
+        simultaneously and only their results are kept in memory. If there are
+        more matching documents, it ends with a BibTeX comment saying so.
+        """
+        max_records = current_app.config['EXPORT_MAX_RECORDS']
+        max_workers = current_app.config['EXPORT_MAX_WORKERS']
+        batch_size = current_app.config['EXPORT_BATCH_SIZE']
+        # Cursor paging needs the unique id field as the last sort criteria
+        cursor_sort = sort
+        if "id" not in [criteria.split()[0] for criteria in sort.split(",") if criteria.strip()]:
+            cursor_sort = ", ".join((sort, "id asc"))
+        docs = itertools.islice(self.iterate(q, sort=cursor_sort), max_records)
+        bibcodes = (doc['bibcode'] for doc in docs if 'bibcode' in doc)
+        batches = iter(lambda: list(itertools.islice(bibcodes, batch_size)), [])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = collections.deque()
+            for batch in batches:
+                # Each thread needs its own copy of the request context
+                futures.append(executor.submit(copy_current_request_context(self._export_batch), self.manager.request, batch, sort))
+                if len(futures) >= max_workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        if self.is_export_truncated():
+            yield "\n% The export is truncated to the first {} of {} records\n".format(max_records, self.num_found)
+
+    def is_export_truncated(self):
+        """
+        True if the search being exported matches more than EXPORT_MAX_RECORDS
+        documents (known once the export has started)
+        """
+        return (self.num_found or 0) > current_app.config['EXPORT_MAX_RECORDS']
+
+    @staticmethod
+    def _export_batch(manager_request, bibcodes, sort):
+        data = {
+                'bibcode': bibcodes,
+                'sort': sort,
+                }
+        results = manager_request(current_app.config['EXPORT_SERVICE'], data, method="POST", retry_counter=0)
+        if 'error' in results or 'export' not in results:
+            raise Exception("Export of {} bibcodes failed: {}".format(len(bibcodes), results.get('error')))
+        return results['export']
+
     def abstract(self, identifier):
         return Abstract(identifier)
 
     def store_query(self, bibcodes, sort="date desc, bibcode desc"):
         """
-        Store query in vault
+        Store query in vault, identical bibcode sets (ignoring order and repeated
+        bibcodes) re-use the same QID while the vault retains it
         """
+        bibcodes = sorted(set(bibcodes))
+        digest = hashlib.sha1("\n".join([sort] + bibcodes).encode('utf-8')).hexdigest()
+        key = "/".join((current_app.config['REDIS_VAULT_KEY_PREFIX'], digest))
+        try:
+            qid = cache.get(key)
+            if qid:
+                return {'qid': qid.decode('utf-8')}
+        except Exception:
+            current_app.logger.exception("Exception while recovering QID from cache")
+            # Do not affect users if connection to Redis is lost in production
+            if current_app.debug:
+                raise
         data = {
                     'bigquery': ["bibcode\n"+"\n".join(bibcodes)],
                     'fq': ["{!bitset}"],
                     'q': ["*:*"],
                     'sort': [sort]
                 }
-        return self.manager.request(current_app.config['VAULT_SERVICE'], data, method="POST", retry_counter=0)
+        results = self.manager.request(current_app.config['VAULT_SERVICE'], data, method="POST", retry_counter=0)
+        if results.get('qid'):
+            try:
+                cache.set(key, results['qid'], ex=current_app.config['REDIS_VAULT_EXPIRATION_TIME'])
+            except Exception:
+                current_app.logger.exception("Exception while storing QID to cache")
+                # Do not affect users if connection to Redis is lost in production
+                if current_app.debug:
+                    raise
+        return results
 
     def objects_query(self, object_names, retry_counter=0):
         """
-        Transform object into ID
+        Transform objects into IDs with a single (cached) request
         """
-        data = {
-                    'query': ["object:({})".format(",".join(object_names))],
-                }
-        return self.manager.request(current_app.config['OBJECTS_SERVICE'], data, method="POST", retry_counter=0)
+        return objects.translate(self.manager, "object:({})".format(",".join(object_names)))
 
     def link_gateway(self, identifier, section, retry_counter=0):
         """
-        Log click
+        Log click, in the background if asynchronous click logging is enabled
+        and there is already an access token (otherwise it needs to bootstrap)
         """
         params = None
         headers = {}
@@ -49,13 +157,86 @@ class API(object):
             headers['User-Agent'] = request.user_agent.string
         if request.referrer:
             headers['referer'] = request.referrer
-        return self.manager.request(current_app.config['LINKGATEWAY_SERVICE'] + identifier + "/" + section, params, method="GET", headers=headers, retry_counter=0, json_format=False)
+        url = current_app.config['LINKGATEWAY_SERVICE'] + identifier + "/" + section
+        clicks = current_app.extensions.get('clicks')
+        if clicks and self.manager.auth.get('access_token'):
+            headers['Authorization'] = "Bearer {}".format(self.manager.auth['access_token'])
+            clicks.log(url, headers, dict(self.manager.cookies))
+            return {}
+        try:
+            return self.manager.request(url, params, method="GET", headers=headers, retry_counter=0, json_format=False)
+        except ServiceUnavailable:
+            # Clicks are not worth failing the page when link_gateway is overloaded
+            return {}
 
     def resolve_reference(self, text):
         """
-        Resolve a text reference into a bibcode
+        Resolve a text reference into a bibcode (None if it cannot be resolved)
+        """
+        return self.resolve_references([text])[0]
+
+    def resolve_references(self, texts):
         """
+        Resolve text references into bibcodes (None for the ones that cannot be
+        resolved). Results, including failures, are cached by normalized text and
+        the references missing from the cache are resolved concurrently with at
+        most REFERENCES_MAX_WORKERS simultaneous requests.
+        """
+        normalized_texts = [" ".join(text.split()) for text in texts]
+        keys = dict((text, self._reference_key(text)) for text in normalized_texts)
+        bibcodes = {}
+        try:
+            cache.prefetch(keys.values())
+            for text, key in keys.items():
+                bibcode = cache.get(key)
+                if bibcode is not None:
+                    bibcodes[text] = bibcode.decode('utf-8') or None
+        except Exception:
+            current_app.logger.exception("Exception while recovering references from cache")
+            # Do not affect users if connection to Redis is lost in production
+            if current_app.debug:
+                raise
+
+        missing_texts = [text for text in keys if text not in bibcodes]
+        if missing_texts:
+            # The first reference is resolved sequentially so that the manager
+            # bootstraps (if needed) only once
+            resolved = [self._resolve_reference(self.manager.request, missing_texts[0])]
+            if len(missing_texts) > 1:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=current_app.config['REFERENCES_MAX_WORKERS']) as executor:
+                    # Each thread needs its own copy of the request context
+                    futures = [executor.submit(copy_current_request_context(self._resolve_reference), self.manager.request, text) for text in missing_texts[1:]]
+                    resolved += [future.result() for future in futures]
+            for text, result in zip(missing_texts, resolved):
+                if 'error' in result and not 400 <= result.get('status_code', 0) < 500:
+                    # Do not cache transient errors (the service reports
+                    # references that cannot be resolved as client errors)
+                    bibcodes[text] = None
+                    continue
+                bibcodes[text] = result.get('resolved', {}).get('bibcode')
+                try:
+                    if bibcodes[text]:
+                        cache.set(keys[text], bibcodes[text], ex=current_app.config['REDIS_REFERENCES_EXPIRATION_TIME'], tags=(bibcodes[text],))
+                    else:
+                        cache.set(keys[text], "", ex=current_app.config['REDIS_REFERENCES_NEGATIVE_EXPIRATION_TIME'])
+                except Exception:
+                    current_app.logger.exception("Exception while storing reference to cache")
+                    # Do not affect users if connection to Redis is lost in production
+                    if current_app.debug:
+                        raise
+        return [bibcodes[text] for text in normalized_texts]
+
+    def _reference_key(self, text):
+        return "/".join((current_app.config['REDIS_REFERENCES_KEY_PREFIX'], hashlib.sha1(text.encode('utf-8')).hexdigest()))
+
+    @staticmethod
+    def _resolve_reference(manager_request, text):
         params = None
         text = urllib.parse.quote(text)
-        return self.manager.request(current_app.config['REFERENCE_SERVICE']+"/"+text, params, method="GET", retry_counter=0)
-
+        try:
+            return manager_request(current_app.config['REFERENCE_SERVICE']+"/"+text, params, method="GET", retry_counter=0)
+        except HTTPException as e:
+            if e.code is None or e.code < 500:
+                raise
+            # Overloaded or failing service, only this reference is not resolved
+            return {"error": e.description}
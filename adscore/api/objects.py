@@ -0,0 +1,59 @@
+import re
+import hashlib
+from flask import current_app
+from adscore import cache, json_codec
+
+# object: operator followed by a quoted, parenthesized or bare expression
+_OBJECT_TERM = re.compile(r'object:(?:"[^"]*"|\([^()]*\)|[^\s()"]+)')
+
+def translate(manager, query):
+    """
+    Translate object: operators into SIMBAD/NED identifiers (e.g., object:M67
+    into ((=abs:M67 OR simbid:1136125 OR nedid:MESSIER_067) database:astronomy)).
+    Translations almost never change, they are cached for a long time using each
+    object: term as key, so that the same objects combined with different
+    filters (e.g., object:M67 year:2020 and object:M67 year:2021) share them.
+    """
+    normalized_query = " ".join(query.split())
+    terms = list(dict.fromkeys(_OBJECT_TERM.findall(normalized_query)))
+    if not terms:
+        return _translate_term(manager, normalized_query)
+    translated_query = normalized_query
+    try:
+        cache.prefetch(_key(term) for term in terms)
+    except Exception:
+        current_app.logger.exception("Exception while recovering object translations from cache")
+        # Do not affect users if connection to Redis is lost in production
+        if current_app.debug:
+            raise
+    for term in terms:
+        results = _translate_term(manager, term)
+        if 'error' in results or not results.get('query'):
+            return results
+        translated_query = translated_query.replace(term, results['query'])
+    return {'query': translated_query}
+
+def _key(term):
+    return "/".join((current_app.config['REDIS_OBJECTS_KEY_PREFIX'], hashlib.sha1(term.encode('utf-8')).hexdigest()))
+
+def _translate_term(manager, term):
+    key = _key(term)
+    try:
+        results = cache.get(key)
+        if results:
+            return json_codec.loads(results)
+    except Exception:
+        current_app.logger.exception("Exception while recovering object translation from cache")
+        # Do not affect users if connection to Redis is lost in production
+        if current_app.debug:
+            raise
+    results = manager.request(current_app.config['OBJECTS_SERVICE'], {'query': [term]}, method="POST", retry_counter=0)
+    if 'error' not in results and results.get('query'):
+        try:
+            cache.set(key, json_codec.dumps(results), ex=current_app.config['REDIS_OBJECTS_EXPIRATION_TIME'])
+        except Exception:
+            current_app.logger.exception("Exception while storing object translation to cache")
+            # Do not affect users if connection to Redis is lost in production
+            if current_app.debug:
+                raise
+    return results
@@ -1,9 +1,10 @@
-import json
 import urllib.parse
 import flask
-from flask import current_app, abort, g
+from flask import current_app, abort, g, has_request_context
 import requests
 from requests.exceptions import ConnectionError, ConnectTimeout, ReadTimeout
+from adscore import json_codec, ratelimit
+from adscore.admission import Overloaded
 
 class RequestsManager:
     """
@@ -34,13 +35,13 @@ class RequestsManager:
 
         def __init__(self, auth, cookies):
             """
-            Create an API object, bootstrap if auth is empty (it will use the provided
-            cookies so that it can take into account any BBB session)
+            Create an API object, if auth is empty it will bootstrap before the first
+            request is issued (it will use the provided cookies so that it can take
+            into account any BBB session). Requests that are fully served from the
+            cache never bootstrap.
             """
             self.auth = auth
             self.cookies = cookies
-            if not self.auth:
-                self._bootstrap() # It will update self.auth
 
         def _bootstrap(self):
             """
@@ -48,6 +49,10 @@ class RequestsManager:
             will be recovered from the API unless it has expired (in which case, a new
             renewed one will be received)
             """
+            if has_request_context():
+                # Only requests that bootstrap count against this limit, pages
+                # served from the cache do not create access tokens
+                ratelimit.hit(current_app.config['RATELIMIT_BOOTSTRAP'], "bootstrap")
             self.auth = {} # During bootstrap, make sure we do not bootstrap with an access token
             params = None
             bootstrap_response = self.request(current_app.config['BOOTSTRAP_SERVICE'], params,
@@ -61,6 +66,9 @@ class RequestsManager:
             """
             Execute query
             """
+            if not self.auth and endpoint != current_app.config['BOOTSTRAP_SERVICE']:
+                self._bootstrap() # It will update self.auth
+
             if headers is None:
                 new_headers = {}
             else:
@@ -80,18 +88,25 @@ class RequestsManager:
                 url = endpoint
                 data = params
             try:
-                current_app.logger.debug("Dispatching '{}' request to endpoint '{}'".format(method, url))
-                if current_app.config['REQUESTS_CONNECTION_POOL_ENABLED']:
-                    r = getattr(current_app.client, method.lower())(url, json=data, headers=new_headers, cookies=self.cookies, timeout=current_app.config['API_TIMEOUT'], verify=False, allow_redirects=False)
-                else:
-                    if flask.has_request_context():
-                        # Propagate key information from the original request
-                        new_headers[u'X-Original-Uri'] = flask.request.headers.get(u'X-Original-Uri', u'-')
-                        new_headers[u'X-Original-Forwarded-For'] = flask.request.headers.get(u'X-Original-Forwarded-For', u'-')
-                        new_headers[u'X-Forwarded-For'] = flask.request.headers.get(u'X-Forwarded-For', u'-')
-                        new_headers[u'X-Amzn-Trace-Id'] = flask.request.headers.get(u'X-Amzn-Trace-Id', '-')
-                    r = getattr(requests, method.lower())(url, json=data, headers=new_headers, cookies=self.cookies, timeout=current_app.config['API_TIMEOUT'], verify=False, allow_redirects=False)
-                current_app.logger.debug("Received response from endpoint '{}' with status code '{}'".format(url, r.status_code))
+                # Slots are held until the (streamed) response is completely read
+                with current_app.extensions['admission'].upstream(url):
+                    current_app.logger.debug("Dispatching '{}' request to endpoint '{}'".format(method, url))
+                    if current_app.config['REQUESTS_CONNECTION_POOL_ENABLED']:
+                        pool = current_app.extensions['http_pools'].pool(url)
+                        r = getattr(pool.session, method.lower())(url, json=data, headers=new_headers, cookies=self.cookies, timeout=pool.timeout, verify=False, allow_redirects=False, stream=True)
+                    else:
+                        if flask.has_request_context():
+                            # Propagate key information from the original request
+                            new_headers[u'X-Original-Uri'] = flask.request.headers.get(u'X-Original-Uri', u'-')
+                            new_headers[u'X-Original-Forwarded-For'] = flask.request.headers.get(u'X-Original-Forwarded-For', u'-')
+                            new_headers[u'X-Forwarded-For'] = flask.request.headers.get(u'X-Forwarded-For', u'-')
+                            new_headers[u'X-Amzn-Trace-Id'] = flask.request.headers.get(u'X-Amzn-Trace-Id', '-')
+                        r = getattr(requests, method.lower())(url, json=data, headers=new_headers, cookies=self.cookies, timeout=current_app.config['API_TIMEOUT'], verify=False, allow_redirects=False, stream=True)
+                    content = self._read_content(r)
+                    current_app.logger.debug("Received response from endpoint '{}' with status code '{}'".format(url, r.status_code))
+            except Overloaded:
+                current_app.logger.warning("Request to '%s' shed because too many requests are waiting for the same service", url)
+                abort(503)
             except (ConnectionError, ConnectTimeout, ReadTimeout) as e:
                 current_app.logger.exception("Exception while connecting to microservice")
                 if retry_counter == 0:
@@ -104,6 +119,10 @@ class RequestsManager:
                 msg = str(e)
                 return {"error": "{}".format(msg)}
 
+            if content is None:
+                current_app.logger.error("Response from endpoint '%s' exceeds the maximum size of %i bytes", url, current_app.config['API_MAX_RESPONSE_SIZE'])
+                return {"error": "Response is too large"}
+
             if not r.ok:
                 if r.status_code == 401 and retry_counter == 0 and not self.auth.get('bot', False): # Unauthorized
                     # Re-try only once bootstrapping a new token
@@ -114,26 +133,47 @@ class RequestsManager:
                     # Unauthorized (401), too many requests (429), errors...
                     abort(r.status_code)
                 try:
-                    msg = r.json().get('error', {})
+                    msg = json_codec.loads(content).get('error', {})
                     if type(msg) is dict:
                         msg = msg.get('msg', msg)
                     if len(msg) == 0:
                         # Try special case: reference resolver returns a 'reason' key with a json string that contains the 'error' message
-                        msg = json.loads(r.json().get('reason', '{}')).get('error')
+                        msg = json_codec.loads(json_codec.loads(content).get('reason', '{}')).get('error')
                 except:
-                    msg = r.content
+                    msg = content
                 current_app.logger.debug("Response from endpoint '{}' ended with error message '{}'".format(url, msg))
-                return {"error": "{} (HTTP status code {})".format(msg, r.status_code)}
+                return {"error": "{} (HTTP status code {})".format(msg, r.status_code), "status_code": r.status_code}
             #r.raise_for_status()
             r.cookies.clear_expired_cookies()
             self.cookies.update(r.cookies.get_dict())
             if json_format:
                 try:
-                    results = r.json()
-                except json.decoder.JSONDecodeError:
+                    results = json_codec.loads(content)
+                except ValueError:
                     current_app.logger.exception("Exception while interpreting microservice JSON response for '%s'", url)
-                    results = {"error": "Response is not JSON compatible: {}".format(r.content)}
+                    results = {"error": "Response is not JSON compatible: {}".format(content)}
                 return results
             else:
                 return {}
 
+
+        def _read_content(self, r):
+            """
+            Read the streamed response body, it returns None as soon as it exceeds
+            API_MAX_RESPONSE_SIZE bytes (announced or actually received)
+            """
+            max_size = current_app.config['API_MAX_RESPONSE_SIZE']
+            try:
+                announced_size = int(r.headers.get('Content-Length', 0))
+            except ValueError:
+                announced_size = 0
+            if announced_size > max_size:
+                r.close()
+                return None
+            content = bytearray()
+            for chunk in r.iter_content(chunk_size=65536):
+                content += chunk
+                if len(content) > max_size:
+                    r.close()
+                    return None
+            return bytes(content)
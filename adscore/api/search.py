@@ -1,41 +1,78 @@
-import json
+import hashlib
 import datetime
 import functools
 from collections.abc import Mapping
-from flask import current_app
+from flask import current_app, has_request_context
+from adscore import cache, stats, json_codec
 from .requests import RequestsManager
+from . import objects
+
+# Raw parameters first seen for each key (per process) to measure how many
+# searches share a key only thanks to the normalization
+_key_variants = {}
+_key_variants_max_size = 10000
+_key_stats = {'lookups': 0, 'collapsed': 0}
+stats.register('search_keys', lambda: dict(_key_stats, keys=len(_key_variants)))
+
+def canonical_params(q, rows, start, sort, fields):
+    """
+    Canonical form of the search parameters: whitespace in the query is collapsed
+    (the '+' used as space in URLs is already decoded when parsing the form, any
+    remaining '+' is a query operator), sort directions are lowercased (field
+    names are case-sensitive) and the secondary sort added to every search is
+    included, and fields are sorted and unique. Searches are sent to the API
+    with the canonical sort and fields, so that every variant sharing a key
+    gets the same results.
+    """
+    sort_criteria = []
+    for criterion in sort.split(","):
+        if criterion.strip():
+            field, _, direction = criterion.strip().partition(" ")
+            sort_criteria.append(" ".join([field] + direction.lower().split()))
+    if "bibcode desc" not in sort_criteria:
+        sort_criteria.append("bibcode desc")
+    fields = sorted(set(field.strip() for field in fields.split(",") if field.strip()))
+    return (" ".join(q.split()), str(int(rows)), str(int(start)), ", ".join(sort_criteria), ",".join(fields))
+
+DEFAULT_FIELDS = "title,bibcode,author,citation_count,citation_count_norm,pubdate,[citations],property,esources,data"
 
 class Search(Mapping):
-    def __init__(self, q, rows=25, start=0, sort="date desc", fields="title,bibcode,author,citation_count,citation_count_norm,pubdate,[citations],property,esources,data"):
+    def __init__(self, q, rows=25, start=0, sort="date desc", fields=DEFAULT_FIELDS, refresh=False):
+        """
+        Search results from the cache or from the API (always from the API if
+        refresh is set, to rebuild the cached results before they expire)
+        """
         self.manager = RequestsManager()
+        # Prefetches and refreshes run outside of requests
+        key = self.cache_key(q, rows=rows, start=start, sort=sort, fields=fields, count=has_request_context())
+        storage = None
         try:
-            redis_client = current_app.extensions['redis']
-            storage = redis_client.get("/".join((current_app.config['REDIS_DATA_KEY_PREFIX'], q, str(rows), str(start), sort, fields)))
+            if not refresh:
+                cache.touch(key, {'search': {'q': q, 'rows': rows, 'start': start, 'sort': sort, 'fields': fields}})
+                storage = cache.get(key)
             if storage:
-                storage = json.loads(storage.decode('utf-8'))
+                storage = json_codec.loads(storage)
         except Exception:
             current_app.logger.exception("Exception while recovering search results from cache")
             # Do not affect users if connection to Redis is lost in production
             if current_app.debug:
                 raise
             storage = None
-            redis_client = None
         if storage:
             self._storage = storage
         else:
             self._storage = {}
-            if "bibcode desc" not in sort:
-                # Add secondary sort criteria
-                sort += ", bibcode desc"
+            # Canonical sort includes the secondary sort criteria
+            _, _, _, sort, fields = canonical_params(q, rows, start, sort, fields)
             # Add statistics if citation counts is the sorting criteria
             if "citation_count_norm" in sort:
-                stats = 'true'
+                stats_enabled = 'true'
                 stats_field = 'citation_count_norm'
             elif "citation_count" in sort:
-                stats = 'true'
+                stats_enabled = 'true'
                 stats_field = 'citation_count'
             else:
-                stats = 'false'
+                stats_enabled = 'false'
                 stats_field = ''
             params = {
                         'fl': fields,
@@ -43,7 +80,7 @@ class Search(Mapping):
                         'rows': rows,
                         'sort': sort,
                         'start': start,
-                        'stats': stats,
+                        'stats': stats_enabled,
                         'stats.field': stats_field
                         }
             if "object:" in q:
@@ -51,19 +88,40 @@ class Search(Mapping):
                 # For instance, object:M67 translates into:
                 #   ((=abs:M67 OR simbid:1136125 OR nedid:MESSIER_067)
                 #    database:astronomy)
-                r = self.manager.request(current_app.config['OBJECTS_SERVICE'], {'query': [q]}, method="POST", retry_counter=0)
+                r = objects.translate(self.manager, q)
                 params['q'] = r.get('query', q)
             results = self._search(params)
             self._storage.update(self._process(results))
             try:
-                if redis_client:
-                    redis_client.set("/".join((current_app.config['REDIS_DATA_KEY_PREFIX'], q, str(rows), str(start), sort, fields)), json.dumps(self._storage), ex=current_app.config['REDIS_EXPIRATION_TIME'])
+                # Errors are not shared with every search that has the same key
+                if 'error' not in self._storage:
+                    bibcodes = [doc['bibcode'] for doc in self._storage.get('response', {}).get('docs', []) if 'bibcode' in doc]
+                    cache.set(key, json_codec.dumps(self._storage), ex=current_app.config['REDIS_EXPIRATION_TIME'], tags=bibcodes)
             except Exception:
                 current_app.logger.exception("Exception while storing search results to cache")
                 # Do not affect users if connection to Redis is lost in production
                 if current_app.debug:
                     raise
 
+    @staticmethod
+    def cache_key(q, rows=25, start=0, sort="date desc", fields=DEFAULT_FIELDS, count=True):
+        """
+        Fixed length key built from the canonical form of the parameters, so that
+        equivalent searches share the same cache entry. Only the keys of searches
+        requested by users should be counted in the search_keys statistics.
+        """
+        canonical = "\n".join(canonical_params(q, rows, start, sort, fields))
+        key = "/".join((current_app.config['REDIS_DATA_KEY_PREFIX'], "SEARCH", hashlib.sha1(canonical.encode('utf-8')).hexdigest()))
+        if not count:
+            return key
+        raw = "\n".join((q, str(rows), str(start), sort, fields))
+        _key_stats['lookups'] += 1
+        if len(_key_variants) >= _key_variants_max_size:
+            _key_variants.clear()
+        if _key_variants.setdefault(key, raw) != raw:
+            _key_stats['collapsed'] += 1
+        return key
+
     def _search(self, params):
         return self.manager.request(current_app.config['SEARCH_SERVICE'], params, method="GET", retry_counter=0)
 
@@ -1,16 +1,57 @@
 import os
 import sys
+import weakref
 import requests
-from flask import Flask, request
-from flask_minify import minify
+from flask import Flask
+from flask.cli import AppGroup
 from flask_limiter import Limiter
-import flask_limiter.util
 from adsmutils import ADSFlask
 from adscore.flask_redis import FlaskRedisPool
+from adscore.local_cache import LocalCache
+from adscore.ratelimit import SlidingWindowRedisStorage, get_remote_address
+from adscore.clicks import ClickLogger
+from adscore.prefetch import SearchPrefetcher
+from adscore.hot_keys import HotKeys
+from adscore.http_pools import HTTPPools
+from adscore.admission import AdmissionControl
+from adscore.profiler import SamplingProfiler
+from adscore import stats
 import redis
 
-def get_remote_address():
-    return request.headers.get('X-Original-Forwarded-For', flask_limiter.util.get_remote_address())
+# Applications created in this process (not kept alive by this set)
+_apps = weakref.WeakSet()
+
+def _reset_http_client(app):
+    """
+    Drop the connections of the HTTP session (if any) inherited from the parent
+    process, new ones are opened when needed
+    """
+    client = getattr(app, 'client', None)
+    if client is not None:
+        for adapter in client.adapters.values():
+            adapter.close()
+
+def _reset_http_clients():
+    for app in list(_apps):
+        _reset_http_client(app)
+
+# Connections opened before a fork (e.g., gunicorn --preload) cannot be shared
+# by the workers (registered once, hooks cannot be unregistered)
+os.register_at_fork(after_in_child=_reset_http_clients)
+
+class LazyCommands(AppGroup):
+    """
+    CLI commands that are only imported when the CLI looks for them, so that
+    workers do not import adscore.commands (and its dependencies)
+    """
+
+    def get_command(self, ctx, name):
+        import adscore.commands
+        return super(LazyCommands, self).get_command(ctx, name)
+
+    def list_commands(self, ctx):
+        import adscore.commands
+        return super(LazyCommands, self).list_commands(ctx)
 
 def create_app(**config):
     opath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -25,11 +66,29 @@ def create_app(**config):
     app.url_map.strict_slashes = False
 
     if app.config['MINIFY']:
+        from flask_minify import minify
         minify(app=app, html=True, js=True, cssless=True, cache=False, fail_safe=True, bypass=[])
     
-    Limiter(app, key_func=get_remote_address)
+    limiter = Limiter(app, key_func=get_remote_address)
+    if isinstance(limiter._storage, SlidingWindowRedisStorage):
+        stats.register('ratelimit', limiter._storage.stats)
     FlaskRedisPool(app)
+    if app.config['LOCAL_CACHE_ENABLED']:
+        LocalCache(app)
+    if app.config['CLICKS_ASYNC_ENABLED']:
+        ClickLogger(app)
+    AdmissionControl(app)
+    if app.config['REQUESTS_CONNECTION_POOL_ENABLED']:
+        HTTPPools(app)
+    if app.config['SEARCH_PREFETCH_ENABLED']:
+        SearchPrefetcher(app)
+    if app.config['HOT_KEYS_ENABLED']:
+        HotKeys(app)
+    SamplingProfiler(app)
     
+    stats.register('process', stats.process)
+    _apps.add(app)
+
     if app.config['ENVIRONMENT'] == "localhost":
         app.debug = True
     
@@ -38,5 +97,6 @@ def create_app(**config):
 
 # XXX:rca - used anywhere? is that the reasons redis_client variable is instantiated?
 app = create_app()
+app.cli = LazyCommands(app.name)
 limiter = app.extensions['limiter']
 redis_client = app.extensions['redis']
\ No newline at end of file
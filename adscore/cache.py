@@ -0,0 +1,163 @@
+import time
+from flask import current_app, g, has_request_context
+
+def _tag_key(bibcode):
+    return "/".join((current_app.config['REDIS_TAGS_KEY_PREFIX'], bibcode))
+
+def _local():
+    """
+    Node-local cache tier (if enabled) that sits between the workers and Redis
+    """
+    return current_app.extensions.get('local_cache')
+
+def _values():
+    """
+    Values already retrieved from (or pending to be written to) Redis during the
+    current request
+    """
+    if 'cache_values' not in g:
+        g.cache_values = {}
+    return g.cache_values
+
+def _writes():
+    """
+    Writes deferred until the end of the current request
+    """
+    if 'cache_writes' not in g:
+        g.cache_writes = []
+    return g.cache_writes
+
+def _touches():
+    """
+    Keys requested during the current request that have to be counted by the hot
+    key tracker
+    """
+    if 'cache_touches' not in g:
+        g.cache_touches = {}
+    return g.cache_touches
+
+def touch(key, recipe):
+    """
+    Count a request for a key in the hot key tracker (if it is enabled) together
+    with the recipe to rebuild it, the count is sent with the deferred writes of
+    the request (the background refresher does not count)
+    """
+    if has_request_context() and 'hot_keys' in current_app.extensions:
+        _touches()[key] = recipe
+
+def prefetch(keys):
+    """
+    Retrieve with a single MGET all the keys that the current request is going
+    to need, later calls to get() will not reach Redis for these keys
+    """
+    values = _values()
+    keys = [key for key in dict.fromkeys(keys) if key not in values]
+    local = _local()
+    if keys and local:
+        values.update((key, value) for key, value in zip(keys, local.get_many(keys)) if value is not None)
+        keys = [key for key in keys if key not in values]
+    if keys:
+        redis_client = current_app.extensions['redis']
+        redis_values = redis_client.mget(keys)
+        values.update(zip(keys, redis_values))
+        if local:
+            local.set_many([(key, value) for key, value in zip(keys, redis_values) if value is not None], ex=current_app.config['LOCAL_CACHE_EXPIRATION_TIME'])
+
+def get(key):
+    """
+    Retrieve a value from Redis, re-using the value if it was already retrieved
+    (or prefetched) during the current request
+    """
+    if not has_request_context():
+        return _get(key)
+    values = _values()
+    if key not in values:
+        values[key] = _get(key)
+    return values[key]
+
+def _get(key):
+    local = _local()
+    value = local.get(key) if local else None
+    if value is None:
+        value = current_app.extensions['redis'].get(key)
+        if local and value is not None:
+            local.set(key, value, ex=current_app.config['LOCAL_CACHE_EXPIRATION_TIME'])
+    return value
+
+def set(key, value, ex, tags=(), nx=False):
+    """
+    Store a value in Redis and tag its key with the bibcodes it depends on, so
+    that it can be purged when any of these records is corrected. Within a
+    request, the write is deferred until flush() is called at the end of it.
+    With nx, the value is only stored if the key does not exist by then.
+    """
+    if has_request_context():
+        _values()[key] = value if isinstance(value, bytes) else str(value).encode('utf-8')
+        _writes().append((key, value, ex, tags, nx))
+    else:
+        _write([(key, value, ex, tags, nx)])
+
+def flush():
+    """
+    Send all the writes (and hot key counts) deferred during the current request
+    in a single pipeline
+    """
+    writes = g.pop('cache_writes', None)
+    touches = g.pop('cache_touches', None)
+    if writes or touches:
+        _write(writes or [], touches)
+
+def _write(writes, touches=None):
+    redis_client = current_app.extensions['redis']
+    pipe = redis_client.pipeline(transaction=False)
+    now = time.time()
+    tag_keys = []
+    for key, value, ex, tags, nx in writes:
+        pipe.set(key, value, ex=ex, nx=nx)
+        for bibcode in tags:
+            tag_key = _tag_key(bibcode)
+            # Keys are scored with their expiration time
+            pipe.zadd(tag_key, {key: now + ex})
+            tag_keys.append(tag_key)
+    for tag_key in dict.fromkeys(tag_keys):
+        # Forget the keys that have already expired so that tags do not grow
+        # forever, and tags have to outlive any of the keys they refer to
+        pipe.zremrangebyscore(tag_key, "-inf", now)
+        pipe.expire(tag_key, current_app.config['REDIS_TAGS_EXPIRATION_TIME'])
+    if touches:
+        current_app.extensions['hot_keys'].record(pipe, touches)
+    pipe.execute()
+    local = _local()
+    if local:
+        try:
+            for key, value, ex, _, nx in writes:
+                if not nx:
+                    # Values written with nx may not have been stored in Redis
+                    local.set(key, value, ex=ex)
+        except Exception:
+            # Redis already has the values, the local tier is only a copy
+            current_app.logger.exception("Exception while storing values to the local cache")
+            if current_app.debug:
+                raise
+
+def purge(*bibcodes):
+    """
+    Delete all the keys (search results, abstracts and rendered pages) tagged with
+    any of the bibcodes, returns the number of deleted keys
+    """
+    redis_client = current_app.extensions['redis']
+    tag_keys = [_tag_key(bibcode) for bibcode in bibcodes]
+    pipe = redis_client.pipeline(transaction=False)
+    for tag_key in tag_keys:
+        pipe.zrange(tag_key, 0, -1)
+    keys = [key for members in pipe.execute() for key in members] + tag_keys
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.delete(key)
+    deleted = sum(pipe.execute()[:-len(tag_keys)])
+    local = _local()
+    if local:
+        # Other hosts will keep serving their copies for LOCAL_CACHE_EXPIRATION_TIME seconds at most
+        local.delete(keys)
+    current_app.logger.info("Purged %i keys for bibcodes '%s'", deleted, "', '".join(bibcodes))
+    return deleted
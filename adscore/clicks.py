@@ -0,0 +1,105 @@
+import os
+import queue
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from adscore import stats
+
+class ClickLogger(object):
+    """
+    Deliver link_gateway clicks from a background thread so that responses do
+    not wait for them. Clicks are kept in a bounded in-process queue: when it is
+    full, new clicks are dropped (and counted) instead of blocking the request.
+    """
+
+    def __init__(self, app=None):
+        self.queue_size = None
+        self.timeout = None
+        self.retries = None
+        self.logger = None
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # Counters are updated by the request threads and the delivery thread
+        self._stats_lock = threading.Lock()
+        self.logged = 0
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.queue_size = app.config['CLICKS_QUEUE_SIZE']
+        self.timeout = app.config['CLICKS_TIMEOUT']
+        self.retries = app.config['CLICKS_RETRIES']
+        self.logger = app.logger
+
+        if not hasattr(app, "extensions"):
+            app.extensions = {}
+        app.extensions['clicks'] = self
+        stats.register('clicks', self.stats)
+
+    def _start(self):
+        """
+        Create the queue and the delivery thread once per process (threads do not
+        survive a fork)
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.queue_size)
+                thread = threading.Thread(target=self._run, args=(self._queue,), name="clicks", daemon=True)
+                thread.start()
+                self._pid = os.getpid()
+        return self._queue
+
+    def log(self, url, headers, cookies):
+        try:
+            self._start().put_nowait((url, headers, cookies))
+            self._count('logged')
+        except queue.Full:
+            self._count('dropped')
+
+    def _count(self, counter):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _session(self):
+        """
+        Session that re-uses connections to link_gateway and retries on connection
+        errors and server errors
+        """
+        session = requests.Session()
+        retry = Retry(total=self.retries, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+        session.mount("http://", HTTPAdapter(max_retries=retry, pool_maxsize=1))
+        session.mount("https://", HTTPAdapter(max_retries=retry, pool_maxsize=1))
+        return session
+
+    def _run(self, clicks):
+        session = self._session()
+        while True:
+            url, headers, cookies = clicks.get()
+            try:
+                r = session.get(url, headers=headers, cookies=cookies, timeout=self.timeout, verify=False, allow_redirects=False)
+                if r.status_code >= 400:
+                    self._count('failed')
+                    self.logger.info("Click logging to '%s' ended with status code '%i'", url, r.status_code)
+                else:
+                    self._count('delivered')
+            except Exception:
+                self._count('failed')
+                self.logger.exception("Exception while logging click to '%s'", url)
+            finally:
+                clicks.task_done()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'queue_depth': self._queue.qsize() if self._pid == os.getpid() else 0,
+                'logged': self.logged,
+                'delivered': self.delivered,
+                'failed': self.failed,
+                'dropped': self.dropped,
+            }
@@ -0,0 +1,112 @@
+import os
+import sys
+import subprocess
+import urllib.parse
+import click
+from werkzeug.exceptions import HTTPException
+from adscore.app import app
+from adscore.api import API, RequestsManager
+from adscore.sitemap import SitemapWriter, render_snapshots
+from adscore import cache
+from adscore import routes
+
+@app.cli.command('purge')
+@click.argument('bibcodes', nargs=-1, required=True)
+def purge(bibcodes):
+    """
+    Delete every cached search result, abstract and rendered page that contains
+    any of the given bibcodes
+    """
+    deleted = cache.purge(*bibcodes)
+    click.echo("Purged {} keys".format(deleted))
+
+@app.cli.command('startup-report')
+@click.option('--top', default=20, help="Number of modules to show")
+def startup_report(top):
+    """
+    Import the application in a new interpreter and report the slowest imports
+    (cumulative time) and the resident memory once it is loaded
+    """
+    code = "import adscore, adscore.stats; print('RSS', adscore.stats.rss())"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, cwd=os.path.dirname(app.root_path))
+    if result.returncode != 0:
+        raise click.ClickException(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "Application could not be imported")
+    imports = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, module = line[len("import time:"):].split("|")
+            if cumulative.strip().isdigit():
+                imports.append((int(cumulative), module[1:].rstrip()))
+    total = sum(cumulative for cumulative, module in imports if not module.startswith(" "))
+    click.echo("Import time: {:.3f}s".format(total / 1e6))
+    click.echo("RSS after import: {:.1f} MiB".format(int(result.stdout.split()[-1]) / 1024. / 1024.))
+    for cumulative, module in sorted(imports, reverse=True)[:top]:
+        click.echo("{:>10.1f} ms  {}".format(cumulative / 1e3, module))
+
+@app.cli.command('sitemap')
+@click.argument('output_dir', type=click.Path(file_okay=False))
+@click.option('--query', default=None, help="Search query that selects the records (e.g., 'bibstem:ApJ')")
+@click.option('--bibcodes', 'bibcodes_file', type=click.File('r'), default=None, help="File with one bibcode per line ('-' for stdin)")
+@click.option('--base-url', required=True, help="Public URL of the site (e.g., https://ui.adsabs.harvard.edu/)")
+@click.option('--sitemaps-url', default=None, help="Public URL where the sitemap files are served (default: <base-url>sitemap/)")
+@click.option('--snapshots', is_flag=True, help="Also render static abstract pages into OUTPUT_DIR/abs/")
+@click.option('--workers', default=4, help="Abstract pages rendered at the same time")
+def sitemap(output_dir, query, bibcodes_file, base_url, sitemaps_url, snapshots, workers):
+    """
+    Write gzipped sitemap files (and an index) with the abstract page of every
+    record returned by a query or listed in a file, and optionally render the
+    abstract pages as static files
+    """
+    if bool(query) == bool(bibcodes_file):
+        raise click.UsageError("Either --query or --bibcodes has to be provided")
+    if not base_url.endswith("/"):
+        base_url += "/"
+    # Same access token as verified search engine bots
+    auth = {'access_token': app.config['VERIFIED_BOTS_ACCESS_TOKEN'], 'expire_in': "2050-01-01T00:00:00", 'bot': True}
+    RequestsManager.init(auth=auth, cookies={})
+    if query:
+        bibcodes = (doc['bibcode'] for doc in API().iterate(query, fields="bibcode") if 'bibcode' in doc)
+    else:
+        bibcodes = (line.strip() for line in bibcodes_file if line.strip())
+
+    writer = SitemapWriter(output_dir, base_url, sitemaps_url or base_url + "sitemap/")
+    def written(bibcodes):
+        for bibcode in bibcodes:
+            writer.add(bibcode)
+            yield bibcode
+
+    def render(bibcode):
+        path = app.config['SERVER_BASE_URL'] + "abs/" + urllib.parse.quote(bibcode, safe="") + "/abstract"
+        with app.test_request_context(path):
+            RequestsManager.init(auth=dict(auth), cookies={})
+            try:
+                page = routes._abstract(bibcode)
+            except HTTPException as e:
+                app.logger.info("Abstract page of '%s' could not be rendered (%s)", bibcode, e.code)
+                return None
+            except Exception:
+                app.logger.exception("Exception while rendering the abstract page of '%s'", bibcode)
+                return None
+            finally:
+                # Store the data retrieved for the page (deferred writes) so that
+                # the dynamic page is also served from the cache
+                try:
+                    cache.flush()
+                except Exception:
+                    app.logger.exception("Exception while storing deferred writes to cache")
+            if not isinstance(page, (str, bytes)):
+                # Redirection, it is not the canonical bibcode
+                app.logger.info("Abstract page of '%s' is a redirection", bibcode)
+                return None
+            return page
+
+    if snapshots:
+        rendered, failed = render_snapshots(written(bibcodes), render, output_dir, workers=workers)
+    else:
+        for _ in written(bibcodes):
+            pass
+    writer.close()
+    click.echo("Wrote {} URLs in {} sitemap files".format(writer.urls, len(writer.filenames)))
+    if snapshots:
+        click.echo("Rendered {} abstract pages ({} failed)".format(rendered, failed))
@@ -1,21 +1,22 @@
+import os
+import threading
+import concurrent.futures
 from flask import current_app
-import dns.name
-import dns.reversename
-import dns.resolver
-import dns.exception
+from adscore import cache
 from collections import OrderedDict
 
-GOOGLE = dns.name.from_text('google.com')
-GOOGLEBOT = dns.name.from_text('googlebot.com')
-APPLEBOT = dns.name.from_text('applebot.apple.com')
-BING = dns.name.from_text('search.msn.com')
-YAHOO = dns.name.from_text('crawl.yahoo.net')
-BAIDU_COM = dns.name.from_text('crawl.baidu.com')
-BAIDU_JP = dns.name.from_text('crawl.baidu.jp')
-YANDEX_RU = dns.name.from_text('yandex.ru')
-YANDEX_NET = dns.name.from_text('yandex.net')
-YANDEX_COM = dns.name.from_text('yandex.com')
-ALEXA = dns.name.from_text('alexa.com')
+# dnspython is imported only when a bot needs to be verified
+GOOGLE = 'google.com'
+GOOGLEBOT = 'googlebot.com'
+APPLEBOT = 'applebot.apple.com'
+BING = 'search.msn.com'
+YAHOO = 'crawl.yahoo.net'
+BAIDU_COM = 'crawl.baidu.com'
+BAIDU_JP = 'crawl.baidu.jp'
+YANDEX_RU = 'yandex.ru'
+YANDEX_NET = 'yandex.net'
+YANDEX_COM = 'yandex.com'
+ALEXA = 'alexa.com'
 
 SEARCH_ENGINE_BOTS = OrderedDict([
                         ("googlebot", {
@@ -114,6 +115,8 @@ VERIFIED_BOT = 0
 UNVERIFIABLE_BOT = 1
 POTENTIAL_MALICIOUS_BOT = 2
 POTENTIAL_USER = 3
+# Cached while the DNS verification of a bot is running in the background
+PENDING_VERIFICATION = 4
 
 def evaluate(remote_ip, user_agent):
     """
@@ -134,37 +137,58 @@ def evaluate(remote_ip, user_agent):
 
     remote_ip = remote_ip.strip()
 
-
+    key = cache_key(remote_ip, user_agent)
     try:
-        redis_client = current_app.extensions['redis']
-        result = redis_client.get("/".join((current_app.config['REDIS_REQUESTS_KEY_PREFIX'], remote_ip, user_agent)))
+        result = cache.get(key)
         if result:
             result = int(result.decode('utf-8'))
     except Exception:
         current_app.logger.exception("Exception while recovering bot results from cache")
         result = None
-        redis_client = None
         # Do not affect users if connection to Redis is lost in production
         if current_app.debug:
             raise
+    if result == PENDING_VERIFICATION:
+        # Treated as potentially malicious until the verdict is cached
+        return POTENTIAL_MALICIOUS_BOT
     if result is None or result not in (VERIFIED_BOT, UNVERIFIABLE_BOT, POTENTIAL_MALICIOUS_BOT, POTENTIAL_USER):
         result = _classify(remote_ip, user_agent)
         try:
-            if redis_client:
-                redis_client.set("/".join((current_app.config['REDIS_REQUESTS_KEY_PREFIX'], remote_ip, user_agent)), result, ex=current_app.config['REDIS_EXPIRATION_TIME'])
+            if result is None:
+                # DNS verification is running in the background, the verdict will
+                # be cached when it finishes (the pending mark is also kept for the
+                # rest of the request, so that it is not classified again)
+                cache.set(key, PENDING_VERIFICATION, ex=current_app.config['DNS_VERIFICATION_PENDING_TIME'], nx=True)
+            else:
+                cache.set(key, result, ex=current_app.config['REDIS_EXPIRATION_TIME'])
         except Exception:
             current_app.logger.exception("Exception while storing bot results to cache")
             # Do not affect users if connection to Redis is lost in production
             if current_app.debug:
                 raise
+        if result is None:
+            return POTENTIAL_MALICIOUS_BOT
     return result
 
+def cache_key(remote_ip, user_agent):
+    """
+    Redis key where the evaluation of a remote IP and user agent is cached
+    """
+    return "/".join((current_app.config['REDIS_REQUESTS_KEY_PREFIX'], remote_ip.strip(), user_agent or ""))
+
 def _classify(remote_ip, user_agent):
+    """
+    Classify the request, it returns None if the verification of a bot requires
+    DNS lookups (they are run in the background)
+    """
     bot_name, bot_verification_data = _find_bot(user_agent)
     if bot_name:
         if bot_verification_data.get('type') == 'Unverifiable':
             check_results = UNVERIFIABLE_BOT
             current_app.logger.info("Classified as 'UNVERIFIABLE_BOT'")
+        elif bot_verification_data.get('type') == 'DNS' and bot_verification_data.get('DNS'):
+            _verify_dns_in_background(remote_ip, user_agent, bot_verification_data['DNS'])
+            check_results = None
         elif _verify_bot(remote_ip, bot_verification_data):
             check_results = VERIFIED_BOT
             current_app.logger.info("Classified as 'VERIFIED_BOT'")
@@ -204,6 +228,91 @@ def _verify_bot(remote_ip, bot_verification_data):
             return _verify_ip(remote_ip, search_engine_bot_ips)
     return False
 
+# DNS verifications running in the background (per process): (remote IP, bot
+# domains) => cache keys that will receive the verdict
+_verifications = {}
+_verifications_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+_resolver = None
+
+def _verify_dns_in_background(remote_ip, user_agent, search_engine_bot_domains):
+    """
+    Verify the bot using reverse/forward DNS resolution in a thread pool shared
+    by all the requests of the process, concurrent requests from the same IP wait
+    for the same verification
+    """
+    global _executor, _executor_pid
+    app = current_app._get_current_object()
+    verification = (remote_ip, tuple(search_engine_bot_domains))
+    key = cache_key(remote_ip, user_agent)
+    with _verifications_lock:
+        if verification in _verifications:
+            _verifications[verification][1].add(key)
+        elif len(_verifications) >= app.config['DNS_VERIFICATION_MAX_PENDING']:
+            current_app.logger.warning("Too many pending DNS verifications, ignoring IP remote_ip='%s'", remote_ip)
+            return
+        else:
+            if _executor_pid != os.getpid():
+                # Threads do not survive a fork
+                _verifications.clear()
+                _executor = concurrent.futures.ThreadPoolExecutor(max_workers=app.config['DNS_VERIFICATION_WORKERS'], thread_name_prefix="dns")
+                _executor_pid = os.getpid()
+            keys = set([key])
+            future = _executor.submit(_run_verification, app, verification, keys)
+            _verifications[verification] = (future, keys)
+
+def _run_verification(app, verification, keys):
+    remote_ip, search_engine_bot_domains = verification
+    with app.app_context():
+        try:
+            if _verify_bot(remote_ip, {'type': 'DNS', 'DNS': search_engine_bot_domains}):
+                result = VERIFIED_BOT
+                app.logger.info("Classified as 'VERIFIED_BOT'")
+            else:
+                result = POTENTIAL_MALICIOUS_BOT
+                app.logger.info("Classified as 'POTENTIAL_MALICIOUS_BOT'")
+            # Requests from the same IP may join while the verdict is stored, the
+            # verification is forgotten only once every key has it
+            stored = set()
+            while True:
+                with _verifications_lock:
+                    pending = keys - stored
+                    if not pending:
+                        del _verifications[verification]
+                        break
+                for key in pending:
+                    cache.set(key, result, ex=app.config['REDIS_EXPIRATION_TIME'])
+                stored.update(pending)
+        except Exception:
+            app.logger.exception("Exception while verifying bot with IP remote_ip='%s'", remote_ip)
+            with _verifications_lock:
+                _verifications.pop(verification, None)
+
+def wait_for_verifications(timeout=None):
+    """
+    Wait until the DNS verifications running in the background have finished
+    """
+    with _verifications_lock:
+        futures = [future for future, _ in _verifications.values()]
+    concurrent.futures.wait(futures, timeout=timeout)
+
+def _get_resolver():
+    """
+    Resolver shared by all the verifications of the process (answers are cached)
+    """
+    global _resolver
+    if _resolver is None:
+        import dns.resolver
+        resolver = dns.resolver.Resolver()
+        # The total number of seconds to spend trying to get an answer to the question:
+        resolver.lifetime = current_app.config['DNS_LIFETIME']
+        # The number of seconds to wait for a response from a server, before timing out:
+        resolver.timeout = current_app.config['DNS_TIMEOUT']
+        resolver.cache = dns.resolver.LRUCache()
+        _resolver = resolver
+    return _resolver
+
 def _verify_ip(remote_ip, search_engine_bot_ips):
     """
     Check if remote IP is in the list of allowed IPs
@@ -214,6 +323,8 @@ def _verify_ip(remote_ip, search_engine_bot_ips):
     return False
 
 def _verify_dns(remote_ip, search_engine_bot_domains, retry_counter=0):
+    import dns.resolver
+    import dns.exception
     try:
         return _resolve(remote_ip, search_engine_bot_domains)
     except dns.resolver.NXDOMAIN:
@@ -233,14 +344,12 @@ def _resolve(remote_ip, search_engine_bot_domains):
     engine bot and verify that when the domain is resolved forward into an IP
     it coincides with the original IP.
     """
-    resolver = dns.resolver.Resolver()
-    # The total number of seconds to spend trying to get an answer to the question:
-    resolver.lifetime = current_app.config['DNS_LIFETIME']
-    # The number of seconds to wait for a response from a server, before timing out:
-    resolver.timeout = current_app.config['DNS_TIMEOUT']
+    import dns.name
+    import dns.reversename
+    resolver = _get_resolver()
     for ptr_record in resolver.query(dns.reversename.from_address(remote_ip), "PTR"):
         for search_engine_bot_domain in search_engine_bot_domains:
-            if dns.name.from_text(ptr_record.to_text()).is_subdomain(search_engine_bot_domain):
+            if dns.name.from_text(ptr_record.to_text()).is_subdomain(dns.name.from_text(search_engine_bot_domain)):
                 for remote_ip_check in resolver.query(ptr_record.to_text(), "A"):
                     remote_ip_coincides = remote_ip_check.to_text() == remote_ip
                     if remote_ip_coincides:
@@ -1,48 +1,290 @@
+import os
+import time
+import bisect
+import weakref
+import itertools
+import hashlib
+import urllib.parse
 import redis
-import fakeredis
+from flask import current_app
+from adscore import stats
+
+def _hash(key):
+    if not isinstance(key, bytes):
+        key = str(key).encode('utf-8')
+    return int.from_bytes(hashlib.md5(key).digest()[:8], 'big')
+
+# Commands without a key that are sent to every node, with their replies combined
+_broadcast_commands = {
+    'ping': all,
+    'flushdb': all,
+    'flushall': all,
+    'dbsize': sum,
+    'keys': lambda replies: [key for reply in replies for key in reply],
+    'scan_iter': itertools.chain.from_iterable,
+}
+
+# Commands without a key whose replies cannot be combined, they are sent to every
+# node and replied per node name
+_node_commands = {'info', 'scan', 'randomkey', 'time', 'lastsave', 'save', 'bgsave', 'config_get', 'config_set', 'memory_stats', 'slowlog_get', 'client_list'}
+
+class RedisNode(object):
+    """
+    Persistent client to one Redis node and its usage statistics
+    """
+
+    def __init__(self, url, client):
+        # Do not expose passwords in statistics or logs
+        parsed_url = urllib.parse.urlparse(url)
+        self.name = parsed_url._replace(netloc=parsed_url.netloc.rpartition('@')[2]).geturl()
+        self.client = client
+        self.down_until = 0
+        self.commands = 0
+        self.errors = 0
+        self.hits = 0
+        self.misses = 0
+
+    def is_up(self):
+        return self.down_until <= time.time()
+
+    def stats(self):
+        stats = {
+            'node': self.name,
+            'up': self.is_up(),
+            'commands': self.commands,
+            'errors': self.errors,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+        if self.is_up():
+            try:
+                stats['keys'] = self.client.dbsize()
+                stats['used_memory'] = self.client.info('memory').get('used_memory')
+            except Exception:
+                pass
+        return stats
+
+class ShardedRedis(object):
+    """
+    Spread keys among several Redis nodes using consistent hashing. When a node
+    cannot be reached, it is skipped for REDIS_NODE_RETRY_INTERVAL seconds and its
+    keys are handled by the next node in the ring (i.e., they become cache misses
+    instead of errors).
+
+    Commands are routed using their first argument as key, except for mget and
+    pipelines which are split among the nodes that own each key. Keyless
+    commands (e.g., dbsize or flushdb) are sent to every node and their replies
+    combined or, if they cannot be combined (e.g., info or scan), returned in a
+    dictionary by node name.
+    """
+
+    def __init__(self, nodes, virtual_nodes=160, retry_interval=30):
+        self.nodes = nodes
+        self.retry_interval = retry_interval
+        ring = sorted((_hash("{}#{}".format(node.name, i)), i, node) for node in nodes for i in range(virtual_nodes))
+        self._ring_hashes = [h for h, _, _ in ring]
+        self._ring_nodes = [node for _, _, node in ring]
+
+    def node(self, key):
+        """
+        Node that owns the key, skipping nodes that are down
+        """
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        start = bisect.bisect(self._ring_hashes, _hash(key))
+        for i in range(len(self._ring_nodes)):
+            node = self._ring_nodes[(start + i) % len(self._ring_nodes)]
+            if node.is_up():
+                return node
+        # All the nodes are down, try the owner anyway
+        return self._ring_nodes[start % len(self._ring_nodes)]
+
+    def _mark_down(self, node):
+        node.errors += 1
+        node.down_until = time.time() + self.retry_interval
+        current_app.logger.warning("Redis node '%s' is unreachable, skipping it for %i seconds", node.name, self.retry_interval)
+
+    def _execute(self, node, function, *args, **kwargs):
+        node.commands += 1
+        try:
+            return function(*args, **kwargs)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+            self._mark_down(node)
+            raise
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def command(*args, **kwargs):
+            nodes = self._keyless_nodes(name, args)
+            if nodes:
+                replies = [self._execute(node, getattr(node.client, name), *args, **kwargs) for node in nodes]
+                return self._combine(name, nodes, replies)
+            node = self.node(args[0])
+            result = self._execute(node, getattr(node.client, name), *args, **kwargs)
+            if name == 'get':
+                if result is None:
+                    node.misses += 1
+                else:
+                    node.hits += 1
+            return result
+        return command
+
+    def _keyless_nodes(self, name, args):
+        """
+        Nodes for commands without a key (None for any other command)
+        """
+        if name in _broadcast_commands or name in _node_commands or not args:
+            return self.nodes
+        return None
+
+    def _combine(self, name, nodes, replies):
+        """
+        Single reply for a command without a key sent to the nodes
+        """
+        if name in _broadcast_commands:
+            return _broadcast_commands[name](replies)
+        if len(nodes) == 1:
+            return replies[0]
+        return {node.name: reply for node, reply in zip(nodes, replies)}
+
+    def mget(self, keys, *args):
+        keys = list(keys) + list(args)
+        keys_by_node = {}
+        for key in keys:
+            keys_by_node.setdefault(self.node(key), []).append(key)
+        values = {}
+        for node, node_keys in keys_by_node.items():
+            try:
+                node_values = self._execute(node, node.client.mget, node_keys)
+            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+                # Degrade to cache misses
+                node_values = [None] * len(node_keys)
+            for key, value in zip(node_keys, node_values):
+                if value is None:
+                    node.misses += 1
+                else:
+                    node.hits += 1
+                values[key] = value
+        return [values[key] for key in keys]
+
+    def pipeline(self, transaction=False):
+        return ShardedPipeline(self)
+
+    def stats(self):
+        return [node.stats() for node in self.nodes]
+
+class ShardedPipeline(object):
+    """
+    Buffer commands and execute them with one pipeline per node
+    """
+
+    def __init__(self, sharded_redis):
+        self.sharded_redis = sharded_redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def command(*args, **kwargs):
+            keyless_nodes = self.sharded_redis._keyless_nodes(name, args)
+            self.commands.append((keyless_nodes or [self.sharded_redis.node(args[0])], name, args, kwargs, keyless_nodes is not None))
+            return self
+        return command
+
+    def execute(self):
+        commands_by_node = {}
+        for position, (nodes, name, args, kwargs, _) in enumerate(self.commands):
+            for node in nodes:
+                commands_by_node.setdefault(node, []).append((position, name, args, kwargs))
+        replies = {}
+        exception = None
+        for node, node_commands in commands_by_node.items():
+            pipe = node.client.pipeline(transaction=False)
+            for _, name, args, kwargs in node_commands:
+                getattr(pipe, name)(*args, **kwargs)
+            try:
+                node_results = self.sharded_redis._execute(node, pipe.execute)
+            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+                # Execute the commands of the rest of the nodes before raising
+                exception = e
+                continue
+            for (position, _, _, _), result in zip(node_commands, node_results):
+                replies[(position, node)] = result
+        results = []
+        for position, (nodes, name, _, _, keyless) in enumerate(self.commands):
+            node_replies = [replies.get((position, node)) for node in nodes]
+            results.append(self.sharded_redis._combine(name, nodes, node_replies) if keyless else node_replies[0])
+        self.commands = []
+        if exception:
+            raise exception
+        return results
+
+# Pools initialized in this process (not kept alive by this set)
+_pools = weakref.WeakSet()
+
+def _reset_pools():
+    for pool in list(_pools):
+        pool._reset()
+
+# Connections opened before a fork (e.g., gunicorn --preload) cannot be shared
+# by the workers (registered once, hooks cannot be unregistered)
+os.register_at_fork(after_in_child=_reset_pools)
 
 class FlaskRedisPool(object):
     def __init__(self, app=None):
-        self.connection_pool = None
-        self.fake_redis = None
+        self.client = None
 
         if app is not None:
             self.init_app(app)
 
     def init_app(self, app):
-        redis_url = app.config.get("REDIS_URL", "redis://localhost:6379/0")
-        if redis_url.startswith("fakeredis://"):
-            self.fake_redis = fakeredis.FakeStrictRedis()
-        else:
-            max_connections = app.config['REDIS_POOL_MAX_CONNECTIONS']
-            timeout = app.config['REDIS_TIMEOUT']
-            self.connection_pool = redis.BlockingConnectionPool.from_url(redis_url, max_connections=max_connections, timeout=timeout, socket_timeout=timeout, socket_connect_timeout=timeout, encoding='utf-8',)
+        redis_urls = app.config.get("REDIS_URLS") or [app.config.get("REDIS_URL", "redis://localhost:6379/0")]
+        nodes = [RedisNode(redis_url, self._create_client(app, redis_url)) for redis_url in redis_urls]
+        self.client = ShardedRedis(nodes, virtual_nodes=app.config.get('REDIS_VIRTUAL_NODES', 160), retry_interval=app.config.get('REDIS_NODE_RETRY_INTERVAL', 30))
 
         if not hasattr(app, "extensions"):
             app.extensions = {}
         app.extensions['redis'] = self
+        stats.register('redis', self.client.stats)
+        _pools.add(self)
 
-    def __getattr__(self, name):
-        if self.fake_redis:
-            return getattr(self.fake_redis, name)
+    def _reset(self):
+        """
+        Drop (without closing) the connections inherited from the parent process
+        """
+        for node in self.client.nodes:
+            connection_pool = getattr(node.client, 'connection_pool', None)
+            if connection_pool is not None:
+                connection_pool.reset()
+
+    def _create_client(self, app, redis_url):
+        """
+        Create a persistent client for one node, fake nodes do not share data
+        """
+        if redis_url.startswith("fakeredis://"):
+            import fakeredis
+            return fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
         else:
-            return getattr(redis.StrictRedis(connection_pool=self.connection_pool), name)
+            max_connections = app.config['REDIS_POOL_MAX_CONNECTIONS']
+            timeout = app.config['REDIS_TIMEOUT']
+            connection_pool = redis.BlockingConnectionPool.from_url(redis_url, max_connections=max_connections, timeout=timeout, socket_timeout=timeout, socket_connect_timeout=timeout, encoding='utf-8',)
+            return redis.StrictRedis(connection_pool=connection_pool)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.client, name)
 
     def __getitem__(self, name):
-        if self.fake_redis:
-            return self.fake_redis[name]
-        else:
-            return redis.StrictRedis(connection_pool=self.connection_pool)[name]
+        value = self.client.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
 
     def __setitem__(self, name, value):
-        if self.fake_redis:
-            self.fake_redis[name] = value
-        else:
-            redis.StrictRedis(connection_pool=self.connection_pool)[name] = value
+        self.client.set(name, value)
 
     def __delitem__(self, name):
-        if self.fake_redis:
-            del self.fake_redis[name]
-        else:
-            del redis.StrictRedis(connection_pool=self.connection_pool)[name]
-
+        if not self.client.delete(name):
+            raise KeyError(name)
@@ -1,7 +1,7 @@
 import re
 import werkzeug
 import urllib.parse
-from flask import g
+from flask import g, current_app
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, IntegerField, SelectField, BooleanField, TextAreaField
 from wtforms.validators import DataRequired
@@ -95,6 +95,7 @@ class ModernForm(FlaskForm):
 
 class PaperForm(FlaskForm):
     bibcodes = TextAreaField('bibcodes')
+    references = TextAreaField('references')
     bibstem = StringField('bibstem')
     year = IntegerField('year')
     volume = IntegerField('volume')
@@ -114,6 +115,18 @@ class PaperForm(FlaskForm):
                 return query
             else:
                 return ""
+        elif self.references.data:
+            references = [reference for reference in self.references.data.splitlines() if reference.strip()]
+            references = references[:current_app.config['REFERENCES_MAX_BULK']]
+            api = API()
+            bibcodes = [bibcode for bibcode in api.resolve_references(references) if bibcode]
+            if len(bibcodes) > 0:
+                # Store query and get QID
+                results = api.store_query(bibcodes)
+                query = "docs({})".format(results['qid'])
+                return query
+            else:
+                return ""
         else:
             query = []
             if self.bibstem.data:
@@ -158,7 +171,9 @@ class ClassicForm(FlaskForm):
 
     def _objects(self):
         # TODO: form.object_logic.data is not used (not even in BBB)
-        objects = self.object_names.data.splitlines()
+        # Ignore empty lines and repeated objects so that equivalent forms share
+        # the same cached translation
+        objects = list(dict.fromkeys(o.strip() for o in self.object_names.data.splitlines() if o.strip()))
         api = API()
         results = api.objects_query(objects)
         transformed_objects_query = results.get('query')
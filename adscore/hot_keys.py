@@ -0,0 +1,164 @@
+import os
+import time
+import threading
+from adscore import stats, json_codec
+from adscore.api import RequestsManager
+from adscore.api.search import Search
+from adscore.api.abstract import Abstract
+from adscore.tools import is_expired
+
+class HotKeys(object):
+    """
+    Count how often each search and abstract is requested (in a sorted set
+    shared by all the workers, with counts decaying by HOT_KEYS_DECAY every
+    HOT_KEYS_REFRESH_INTERVAL seconds) and rebuild the HOT_KEYS_TOP most
+    requested ones from a background thread when they are going to expire in
+    less than HOT_KEYS_REFRESH_BEFORE seconds, so that popular pages are never
+    cold. Only one worker refreshes per interval and it sends at most
+    HOT_KEYS_REFRESH_BUDGET requests per minute to the API (the most requested
+    keys first).
+
+    Rendered pages are not tracked separately, they are rendered again from the
+    refreshed data without sending any request to the API.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.top = None
+        self.max_tracked = None
+        self.decay = None
+        self.interval = None
+        self.refresh_before = None
+        self.budget = None
+        self._auth = {}
+        self._pid = None
+        self._lock = threading.Lock()
+        self.cycles = 0
+        self.refreshed = 0
+        self.over_budget = 0
+        self.failed = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.top = app.config['HOT_KEYS_TOP']
+        self.max_tracked = app.config['HOT_KEYS_MAX_TRACKED']
+        self.decay = app.config['HOT_KEYS_DECAY']
+        self.interval = app.config['HOT_KEYS_REFRESH_INTERVAL']
+        self.refresh_before = app.config['HOT_KEYS_REFRESH_BEFORE']
+        self.budget = app.config['HOT_KEYS_REFRESH_BUDGET']
+
+        if not hasattr(app, "extensions"):
+            app.extensions = {}
+        app.extensions['hot_keys'] = self
+        stats.register('hot_keys', self.stats)
+
+    def _key(self, name):
+        return "/".join((self.app.config['REDIS_HOT_KEYS_KEY_PREFIX'], name))
+
+    def _start(self):
+        """
+        Create the refresher thread once per process (threads do not survive a
+        fork)
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                thread = threading.Thread(target=self._run, name="hot-keys", daemon=True)
+                thread.start()
+                self._pid = os.getpid()
+
+    def record(self, pipe, touches):
+        """
+        Add the counts of the keys requested (and their recipes) to a pipeline
+        """
+        self._start()
+        for key, recipe in touches.items():
+            pipe.zincrby(self._key("SCORES"), 1, key)
+            pipe.hset(self._key("RECIPES"), key, json_codec.dumps(recipe))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.app.app_context():
+                try:
+                    self.refresh()
+                except Exception:
+                    self.app.logger.exception("Exception while refreshing hot keys")
+
+    def refresh(self):
+        """
+        Rebuild the most requested keys that are about to expire, unless another
+        worker already did it during the current interval
+        """
+        redis_client = self.app.extensions['redis']
+        if not redis_client.set(self._key("LOCK"), os.getpid(), nx=True, ex=self.interval):
+            return
+        self.cycles += 1
+        scores_key = self._key("SCORES")
+        recipes_key = self._key("RECIPES")
+        # Keys that are not requested anymore lose their place in the top
+        redis_client.zunionstore(scores_key, {scores_key: self.decay})
+        forgotten = redis_client.zrange(scores_key, 0, -(self.max_tracked + 1))
+        if forgotten:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.zrem(scores_key, *forgotten)
+            pipe.hdel(recipes_key, *forgotten)
+            pipe.execute()
+
+        hot = redis_client.zrevrange(scores_key, 0, self.top - 1)
+        if not hot:
+            return
+        candidates = []
+        for key, recipe in zip(hot, redis_client.hmget(recipes_key, hot)):
+            if recipe is None:
+                continue
+            recipe = json_codec.loads(recipe)
+            candidates.append((key.decode('utf-8'), recipe, None))
+            if 'abstract' in recipe:
+                # Sub-resources are only rebuilt if they were already cached
+                candidates.extend((Abstract.section_key(recipe['abstract'], section), recipe, section) for section in Abstract.sections)
+        pipe = redis_client.pipeline(transaction=False)
+        for key, _, _ in candidates:
+            pipe.ttl(key)
+        due = [(recipe, section) for (_, recipe, section), ttl in zip(candidates, pipe.execute())
+                    if 0 <= ttl < self.refresh_before or (ttl == -2 and section is None)]
+
+        budget = max(1, int(self.budget * self.interval / 60))
+        if len(due) > budget:
+            self.over_budget += len(due) - budget
+            due = due[:budget]
+        if not due:
+            return
+        if is_expired(self._auth):
+            # Bootstrap (once per token lifetime) with the first request
+            self._auth = {}
+        RequestsManager.init(self._auth, {})
+        for recipe, section in due:
+            try:
+                self._rebuild(recipe, section)
+                self.refreshed += 1
+            except Exception:
+                self.failed += 1
+                self.app.logger.exception("Exception while refreshing hot key '%s'", recipe)
+        self._auth = RequestsManager().auth
+
+    def _rebuild(self, recipe, section):
+        """
+        Outside of a request, rebuilt values are written to the cache immediately
+        """
+        if 'search' in recipe:
+            Search(refresh=True, **recipe['search'])
+        elif section is None:
+            Abstract(recipe['abstract'], refresh=True)
+        else:
+            Abstract(recipe['abstract']).refresh_section(section)
+
+    def stats(self):
+        return {
+            'cycles': self.cycles,
+            'refreshed': self.refreshed,
+            'over_budget': self.over_budget,
+            'failed': self.failed,
+        }
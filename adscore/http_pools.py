@@ -0,0 +1,188 @@
+import os
+import time
+import weakref
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from adscore import stats
+
+class PoolStats(object):
+    """
+    Counters shared by all the threads that use the pool
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.reused = 0
+        self.expired = 0
+        self.wait_time = 0.
+        self.max_wait_time = 0.
+
+    def record(self, wait_time, reused, expired):
+        with self._lock:
+            self.requests += 1
+            if reused:
+                self.reused += 1
+            if expired:
+                self.expired += 1
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'reused': self.reused,
+                'reuse_ratio': float(self.reused) / self.requests if self.requests else None,
+                'expired': self.expired,
+                'mean_wait_time': self.wait_time / self.requests if self.requests else None,
+                'max_wait_time': self.max_wait_time,
+            }
+
+class _InstrumentedPoolMixin(object):
+    """
+    Measure how long requests wait for a free connection and how many of them
+    re-use an open connection. Connections idle for more than keep_alive seconds
+    are closed instead of re-used (upstream servers may have closed them).
+    """
+    pool_stats = None
+    keep_alive = None
+
+    def _get_conn(self, timeout=None):
+        start = time.time()
+        conn = super(_InstrumentedPoolMixin, self)._get_conn(timeout=timeout)
+        wait_time = time.time() - start
+        expired = getattr(conn, 'sock', None) is not None and time.time() - getattr(conn, '_released_at', 0) > self.keep_alive
+        if expired:
+            conn.close()
+        self.pool_stats.record(wait_time, reused=getattr(conn, 'sock', None) is not None, expired=expired)
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn._released_at = time.time()
+        return super(_InstrumentedPoolMixin, self)._put_conn(conn)
+
+class _InstrumentedAdapter(HTTPAdapter):
+    def __init__(self, pool_stats, keep_alive, **kwargs):
+        self.pool_stats = pool_stats
+        self.keep_alive = keep_alive
+        super(_InstrumentedAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(_InstrumentedAdapter, self).init_poolmanager(*args, **kwargs)
+        attributes = {'pool_stats': self.pool_stats, 'keep_alive': self.keep_alive}
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': type('InstrumentedHTTPConnectionPool', (_InstrumentedPoolMixin, HTTPConnectionPool), attributes),
+            'https': type('InstrumentedHTTPSConnectionPool', (_InstrumentedPoolMixin, HTTPSConnectionPool), attributes),
+        }
+
+class HTTPPool(object):
+    """
+    Session with its own connection pool for one upstream service
+    """
+
+    def __init__(self, name, url, size, keep_alive, timeout, warm_up):
+        self.name = name
+        self.url = url
+        self.size = size
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.warm_up = warm_up
+        self.pool_stats = PoolStats()
+        self.session = self._create_session()
+
+    def _create_session(self):
+        session = requests.Session()
+        # Requests wait for a free connection instead of opening connections
+        # that would be discarded when they are returned to a full pool
+        adapter = _InstrumentedAdapter(self.pool_stats, self.keep_alive, pool_connections=1, pool_maxsize=self.size, pool_block=True)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def reset(self):
+        """
+        Replace the session without closing the connections (they may be shared
+        with the parent process after a fork)
+        """
+        self.session = self._create_session()
+
+    def stats(self):
+        return dict(self.pool_stats.to_dict(), url=self.url, size=self.size, keep_alive=self.keep_alive, timeout=self.timeout)
+
+# Pools initialized in this process (not kept alive by this set)
+_http_pools = weakref.WeakSet()
+
+def _reset_http_pools():
+    for http_pools in list(_http_pools):
+        http_pools.reset()
+
+# Connections opened before a fork (e.g., gunicorn --preload) cannot be shared
+# by the workers (registered once, hooks cannot be unregistered)
+os.register_at_fork(after_in_child=_reset_http_pools)
+
+class HTTPPools(object):
+    """
+    Connection pools for each upstream service listed in HTTP_POOLS (keyed by the
+    name of their setting, e.g. SEARCH_SERVICE), requests to any other URL use
+    the default pool. Pools can be warmed up when a worker starts so that the
+    first requests do not pay for TCP and TLS handshakes.
+    """
+
+    def __init__(self, app=None):
+        self.pools = []
+        self.default = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        settings = app.config['HTTP_POOLS']
+        defaults = dict(settings['default'])
+        self.default = HTTPPool('default', app.config['API_URL'], **defaults)
+        for name, pool_settings in settings.items():
+            if name != 'default':
+                self.pools.append(HTTPPool(name, app.config[name], **dict(defaults, **pool_settings)))
+        # Longest URLs first so that the most specific service matches
+        self.pools.sort(key=lambda pool: len(pool.url), reverse=True)
+
+        if not hasattr(app, "extensions"):
+            app.extensions = {}
+        app.extensions['http_pools'] = self
+        stats.register('http_pools', self.stats)
+        _http_pools.add(self)
+
+    def pool(self, url):
+        for pool in self.pools:
+            if url.startswith(pool.url):
+                return pool
+        return self.default
+
+    def reset(self):
+        for pool in self.pools + [self.default]:
+            pool.reset()
+
+    def warm_up(self, background=True):
+        """
+        Open warm_up connections per pool with HEAD requests (whatever the status
+        code of the response is, the connection is kept in the pool)
+        """
+        def open_connection(pool):
+            try:
+                pool.session.head(pool.url, timeout=pool.timeout, verify=False, allow_redirects=False)
+            except Exception:
+                pass
+
+        threads = [threading.Thread(target=open_connection, args=(pool,), name="warm-up", daemon=True)
+                   for pool in self.pools + [self.default] for _ in range(min(pool.warm_up, pool.size))]
+        for thread in threads:
+            thread.start()
+        if not background:
+            for thread in threads:
+                thread.join()
+
+    def stats(self):
+        return {pool.name: pool.stats() for pool in self.pools + [self.default]}
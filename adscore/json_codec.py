@@ -0,0 +1,70 @@
+import json
+from flask import current_app
+
+class StdlibCodec(object):
+    name = "json"
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+class OrjsonCodec(object):
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self.loads = orjson.loads
+        self.dumps = orjson.dumps
+
+class UjsonCodec(object):
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+        self.loads = ujson.loads
+
+    def dumps(self, obj):
+        return self._ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+CODECS = {
+    "orjson": OrjsonCodec,
+    "ujson": UjsonCodec,
+    "json": StdlibCodec,
+}
+
+_codecs = {}
+
+def get_codec(name="auto"):
+    """
+    Codec instance for the given name, "auto" selects the fastest one that is
+    installed (orjson, ujson or the standard library)
+    """
+    if name not in _codecs:
+        if name == "auto":
+            for codec_class in CODECS.values():
+                try:
+                    _codecs[name] = codec_class()
+                    break
+                except ImportError:
+                    continue
+        else:
+            _codecs[name] = CODECS[name]()
+    return _codecs[name]
+
+def loads(data):
+    """
+    Decode JSON from bytes or str using the JSON_CODEC codec, invalid JSON raises
+    ValueError (whatever codec is used)
+    """
+    return get_codec(current_app.config['JSON_CODEC']).loads(data)
+
+def dumps(obj):
+    """
+    Encode to UTF-8 JSON bytes using the JSON_CODEC codec
+    """
+    return get_codec(current_app.config['JSON_CODEC']).dumps(obj)
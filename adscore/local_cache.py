@@ -0,0 +1,192 @@
+import os
+import time
+import weakref
+import threading
+import itertools
+import struct
+import hashlib
+from flask import current_app
+from adscore import stats
+
+# Local caches initialized in this process (not kept alive by this set)
+_local_caches = weakref.WeakSet()
+
+def _close_local_caches():
+    for local_cache in list(_local_caches):
+        local_cache.close()
+
+# LMDB environments cannot be used after a fork, the parent (e.g., the gunicorn
+# master) closes them and every process re-opens them when needed (registered
+# once, hooks cannot be unregistered)
+os.register_at_fork(before=_close_local_caches)
+
+class LocalCache(object):
+    """
+    Cache tier shared by all the worker processes of a host, stored in a memory
+    mapped LMDB database so that hot keys do not need to be retrieved from Redis
+    by every worker. The database cannot grow beyond LOCAL_CACHE_MAP_SIZE bytes:
+    when it is full, the entries that expire sooner are evicted.
+    """
+
+    # Values are prefixed with their expiration time (epoch)
+    header = struct.Struct('>d')
+    # LMDB keys cannot be longer than 511 bytes
+    max_key_size = 511
+    # Evict before the database is completely full (LMDB needs free pages even
+    # to delete entries)
+    high_watermark = 0.8
+
+    def __init__(self, app=None):
+        self.path = None
+        self.map_size = None
+        self.expiration_time = None
+        self._env = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.path = app.config['LOCAL_CACHE_PATH']
+        self.map_size = app.config['LOCAL_CACHE_MAP_SIZE']
+        self.expiration_time = app.config['LOCAL_CACHE_EXPIRATION_TIME']
+        self.eviction_batch = app.config['LOCAL_CACHE_EVICTION_BATCH']
+
+        if not hasattr(app, "extensions"):
+            app.extensions = {}
+        app.extensions['local_cache'] = self
+        stats.register('local_cache', self.stats)
+        _local_caches.add(self)
+
+    def _open(self):
+        """
+        Open the database once per process (LMDB refuses to open the same
+        environment twice in a process, so threads have to wait for the first one)
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    import lmdb
+                    os.makedirs(self.path, exist_ok=True)
+                    self._env = lmdb.open(self.path, map_size=self.map_size, max_dbs=2, metasync=False, sync=False, readahead=False)
+                    self._values = self._env.open_db(b'values')
+                    # Index sorted by expiration time, used for eviction
+                    self._expirations = self._env.open_db(b'expirations')
+                    self._pid = os.getpid()
+        return self._env
+
+    def close(self):
+        with self._lock:
+            if self._env is not None:
+                self._env.close()
+                self._env = None
+                self._pid = None
+
+    def _key(self, key):
+        if not isinstance(key, bytes):
+            key = str(key).encode('utf-8')
+        if len(key) > self.max_key_size - self.header.size:
+            key = hashlib.sha1(key).hexdigest().encode('utf-8')
+        return key
+
+    def get_many(self, keys):
+        """
+        Retrieve several keys in one read transaction, missing or expired keys
+        are returned as None
+        """
+        env = self._open()
+        now = time.time()
+        values = []
+        with env.begin(db=self._values) as txn:
+            for key in keys:
+                value = txn.get(self._key(key))
+                if value is not None and self.header.unpack_from(value)[0] > now:
+                    values.append(bytes(value[self.header.size:]))
+                    self.hits += 1
+                else:
+                    values.append(None)
+                    self.misses += 1
+        return values
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def set_many(self, items, ex):
+        """
+        Store several (key, value) pairs in one write transaction, the expiration
+        time is capped to LOCAL_CACHE_EXPIRATION_TIME to limit how long a host can
+        serve data that was purged from Redis
+        """
+        env = self._open()
+        expires_at = time.time() + min(ex, self.expiration_time)
+        if self._used_bytes(env) > self.high_watermark * self.map_size:
+            self._evict(env)
+        self._write(env, items, expires_at)
+
+    def set(self, key, value, ex):
+        self.set_many([(key, value)], ex)
+
+    def _write(self, env, items, expires_at):
+        header = self.header.pack(expires_at)
+        with env.begin(write=True) as txn:
+            for key, value in items:
+                key = self._key(key)
+                if not isinstance(value, bytes):
+                    value = str(value).encode('utf-8')
+                self._delete(txn, key)
+                txn.put(key, header + value, db=self._values)
+                txn.put(header + key, b'', db=self._expirations)
+
+    def _delete(self, txn, key):
+        previous = txn.get(key, db=self._values)
+        if previous is not None:
+            txn.delete(bytes(previous[:self.header.size]) + key, db=self._expirations)
+            txn.delete(key, db=self._values)
+
+    def delete(self, keys):
+        env = self._open()
+        with env.begin(write=True) as txn:
+            for key in keys:
+                self._delete(txn, self._key(key))
+
+    def _used_bytes(self, env):
+        """
+        Size of the pages in use (pages freed by deletions can be re-used)
+        """
+        with env.begin() as txn:
+            page_stats = [txn.stat(db) for db in (self._values, self._expirations)]
+        return sum((s['branch_pages'] + s['leaf_pages'] + s['overflow_pages']) * s['psize'] for s in page_stats)
+
+    def _evict(self, env):
+        """
+        Remove the entries that expire sooner (starting with already expired ones)
+        """
+        with env.begin(write=True) as txn:
+            cursor = txn.cursor(db=self._expirations)
+            cursor.first()
+            index_keys = list(itertools.islice(cursor.iternext(values=False), max(self.eviction_batch, 1)))
+            for index_key in index_keys:
+                txn.delete(index_key, db=self._expirations)
+                txn.delete(index_key[self.header.size:], db=self._values)
+        evicted = len(index_keys)
+        self.evictions += evicted
+        current_app.logger.info("Evicted %i entries from the local cache", evicted)
+
+    def stats(self):
+        env = self._open()
+        with env.begin() as txn:
+            entries = txn.stat(self._values)['entries']
+        return {
+            'path': self.path,
+            'entries': entries,
+            'used_bytes': self._used_bytes(env),
+            'map_size': self.map_size,
+            'pid': self._pid,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,168 @@
+import os
+import hashlib
+import threading
+import concurrent.futures
+from adscore import stats
+from adscore.api import RequestsManager
+from adscore.api.search import Search
+from adscore.api.api import SEARCH_FIELDS
+
+class SearchPrefetcher(object):
+    """
+    Warm the cache with the next page of search results from background threads
+    after a page is served, so that users (and crawlers) paging through results
+    do not wait for the search service.
+
+    At most SEARCH_PREFETCH_MAX_CONCURRENT pages are prefetched at the same time
+    per process (new prefetches are skipped while all the slots are busy) and the
+    same page is not prefetched again by any worker for SEARCH_PREFETCH_INTERVAL
+    seconds. Prefetched pages are marked in Redis to measure how many of them
+    are actually requested (counted in Redis for all the workers). Redis is
+    only used from the background threads, never from the response path.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.max_concurrent = None
+        self.interval = None
+        self._slots = None
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.prefetched = 0
+        self.already_cached = 0
+        self.hits = 0
+        self.throttled = 0
+        self.skipped = 0
+        self.failed = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.max_concurrent = app.config['SEARCH_PREFETCH_MAX_CONCURRENT']
+        self.interval = app.config['SEARCH_PREFETCH_INTERVAL']
+        self._slots = threading.BoundedSemaphore(self.max_concurrent)
+
+        if not hasattr(app, "extensions"):
+            app.extensions = {}
+        app.extensions['search_prefetcher'] = self
+        stats.register('search_prefetch', self.stats)
+
+    def _start(self):
+        """
+        Create the thread pool once per process (threads do not survive a fork)
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # One more thread than prefetch slots, so that the bookkeeping of
+                # served pages never waits for a prefetch
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrent + 1, thread_name_prefix="prefetch")
+                self._pid = os.getpid()
+        return self._executor
+
+    def _key(self, kind, data_key=None):
+        if data_key is None:
+            return "/".join((self.app.config['REDIS_PREFETCH_KEY_PREFIX'], kind))
+        return "/".join((self.app.config['REDIS_PREFETCH_KEY_PREFIX'], kind, hashlib.sha1(data_key.encode('utf-8')).hexdigest()))
+
+    def served(self, q, rows, start, sort, results):
+        """
+        Schedule the bookkeeping of the served page (counting it if it was
+        prefetched) and the prefetch of the next page (if any), nothing is sent to
+        Redis from the response path
+        """
+        next_start = start + rows
+        prefetch = 'error' not in results and next_start < results.get('response', {}).get('numFound', 0)
+        manager = RequestsManager()
+        if prefetch and not manager.auth.get('access_token'):
+            # Never bootstrap from the background
+            prefetch = False
+        if prefetch and not self._slots.acquire(blocking=False):
+            self.skipped += 1
+            prefetch = False
+        try:
+            self._start().submit(self._served, dict(manager.auth), dict(manager.cookies), q, rows, start, sort, prefetch)
+        except Exception:
+            if prefetch:
+                self._slots.release()
+            raise
+
+    def _served(self, auth, cookies, q, rows, start, sort, prefetch):
+        """
+        The prefetch slot (if any) is released here unless the next page is
+        prefetched (which releases it when done)
+        """
+        with self.app.app_context():
+            held, prefetch = prefetch, False
+            try:
+                redis_client = self.app.extensions['redis']
+                pipe = redis_client.pipeline(transaction=False)
+                pipe.delete(self._key("PREFETCHED", Search.cache_key(q, rows=rows, start=start, sort=sort, fields=SEARCH_FIELDS, count=False)))
+                if held:
+                    pipe.set(self._key("LOCK", Search.cache_key(q, rows=rows, start=start + rows, sort=sort, fields=SEARCH_FIELDS, count=False)), 1, nx=True, ex=self.interval)
+                replies = pipe.execute()
+                if replies[0]:
+                    self.hits += 1
+                    # Shared by all the workers, a page is often prefetched by
+                    # one worker and requested from another one
+                    redis_client.hincrby(self._key("STATS"), "hits", 1)
+                if held:
+                    prefetch = bool(replies[1])
+                    if not prefetch:
+                        self.throttled += 1
+            except Exception:
+                self.failed += 1
+                self.app.logger.exception("Exception while counting served search results for '%s' (start %i)", q, start)
+            finally:
+                if held and not prefetch:
+                    self._slots.release()
+        if prefetch:
+            self._prefetch(auth, cookies, q, rows, start + rows, sort)
+
+    def _prefetch(self, auth, cookies, q, rows, start, sort):
+        with self.app.app_context():
+            try:
+                RequestsManager.init(auth, cookies)
+                redis_client = self.app.extensions['redis']
+                key = Search.cache_key(q, rows=rows, start=start, sort=sort, fields=SEARCH_FIELDS, count=False)
+                if redis_client.exists(key):
+                    self.already_cached += 1
+                else:
+                    # Outside of a request, the results are written to the cache immediately
+                    Search(q, rows=rows, start=start, sort=sort, fields=SEARCH_FIELDS)
+                    pipe = redis_client.pipeline(transaction=False)
+                    pipe.set(self._key("PREFETCHED", key), 1, ex=self.app.config['REDIS_EXPIRATION_TIME'])
+                    pipe.hincrby(self._key("STATS"), "prefetched", 1)
+                    pipe.execute()
+                    self.prefetched += 1
+            except Exception:
+                self.failed += 1
+                self.app.logger.exception("Exception while prefetching search results for '%s' (start %i)", q, start)
+            finally:
+                self._slots.release()
+
+    def stats(self):
+        """
+        Counters of the current process, except the hit rate that is computed
+        from the counters shared by all the workers
+        """
+        try:
+            shared = self.app.extensions['redis'].hgetall(self._key("STATS"))
+        except Exception:
+            self.app.logger.exception("Exception while recovering search prefetch statistics")
+            shared = {}
+        total_prefetched = int(shared.get(b'prefetched', 0))
+        total_hits = int(shared.get(b'hits', 0))
+        return {
+            'prefetched': self.prefetched,
+            'already_cached': self.already_cached,
+            'hits': self.hits,
+            'total_prefetched': total_prefetched,
+            'total_hits': total_hits,
+            'hit_rate': float(total_hits) / total_prefetched if total_prefetched else None,
+            'throttled': self.throttled,
+            'skipped': self.skipped,
+            'failed': self.failed,
+        }
@@ -0,0 +1,158 @@
+import os
+import sys
+import time
+import random
+import threading
+import collections
+from flask import g
+from adscore import stats
+
+class ProfilingSession(object):
+    def __init__(self, until, rate):
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.until = until
+        self.rate = rate
+        self.samples = collections.Counter()
+
+class SamplingProfiler(object):
+    """
+    Sample every PROFILER_INTERVAL seconds the stacks of the threads that are
+    handling requests (routes, requests to the API, template rendering...) and
+    write them to PROFILER_OUTPUT_DIR as collapsed stacks, one "frame;frame;...
+    count" line per stack as read by flame graph tools (e.g., flamegraph.pl or
+    speedscope).
+
+    Profiling is started in the current worker for a number of seconds and for a
+    fraction of the requests with start() (e.g., from the admin endpoint), or
+    permanently in every worker with PROFILER_ENABLED (writing a file every
+    PROFILER_DURATION seconds). While it is off, requests only check a flag.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = None
+        self.interval = None
+        self.duration = None
+        self.rate = None
+        self.output_dir = None
+        self._session = None
+        self._threads = set()
+        self._lock = threading.Lock()
+        self.samples = 0
+        self.files = collections.deque(maxlen=10)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config['PROFILER_ENABLED']
+        self.interval = app.config['PROFILER_INTERVAL']
+        self.duration = app.config['PROFILER_DURATION']
+        self.rate = app.config['PROFILER_RATE']
+        self.output_dir = app.config['PROFILER_OUTPUT_DIR']
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+        if not hasattr(app, "extensions"):
+            app.extensions = {}
+        app.extensions['profiler'] = self
+        stats.register('profiler', self.stats)
+
+    def start(self, duration=None, rate=None):
+        """
+        Profile the requests served by the current process during duration
+        seconds (forever if it is None), returns False if it is already running
+        """
+        with self._lock:
+            if self._is_running():
+                return False
+            until = time.time() + duration if duration is not None else float('inf')
+            session = ProfilingSession(until, rate if rate is not None else self.rate)
+            self._session = session
+            thread = threading.Thread(target=self._run, args=(session,), name="profiler", daemon=True)
+            thread.start()
+        return True
+
+    def _is_running(self):
+        # Sessions (and their threads) do not survive a fork
+        session = self._session
+        return session is not None and session.pid == os.getpid() and session.until > time.time()
+
+    def _before_request(self):
+        session = self._session
+        if session is None or session.pid != os.getpid():
+            if not self.enabled:
+                return
+            self.start()
+            session = self._session
+        if session.rate >= 1 or random.random() < session.rate:
+            g.profiled = True
+            self._threads.add(threading.get_ident())
+
+    def _teardown_request(self, exception):
+        if g.pop('profiled', False):
+            self._threads.discard(threading.get_ident())
+
+    def _run(self, session):
+        write_at = time.time() + self.duration
+        while True:
+            time.sleep(self.interval)
+            self._sample(session)
+            now = time.time()
+            if now >= session.until or now >= write_at:
+                try:
+                    self._write(session)
+                except Exception:
+                    self.app.logger.exception("Exception while writing profile")
+                session.samples.clear()
+                write_at = now + self.duration
+            if now >= session.until:
+                with self._lock:
+                    if self._session is session:
+                        self._session = None
+                        self._threads.clear()
+                break
+
+    def _sample(self, session):
+        frames = sys._current_frames()
+        for ident in list(self._threads):
+            frame = frames.get(ident)
+            if frame is not None:
+                session.samples[self._collapse(frame)] += 1
+                self.samples += 1
+
+    @staticmethod
+    def _collapse(frame):
+        """
+        Stack as module:function frames from the outermost one
+        """
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("{}:{}".format(frame.f_globals.get('__name__', code.co_filename), code.co_name))
+            frame = frame.f_back
+        return ";".join(reversed(stack))
+
+    def _write(self, session):
+        if not session.samples:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, "profile-{}-{}.collapsed".format(session.pid, time.strftime("%Y%m%d%H%M%S")))
+        with open(path, "w") as f:
+            for stack, count in session.samples.most_common():
+                f.write("{} {}\n".format(stack, count))
+        self.files.append(path)
+        self.app.logger.info("Profile with %i samples written to '%s'", sum(session.samples.values()), path)
+
+    def stats(self):
+        session = self._session if self._is_running() else None
+        return {
+            'running': session is not None,
+            'pid': os.getpid(),
+            'rate': session.rate if session else None,
+            'remaining': session.until - time.time() if session and session.until != float('inf') else None,
+            'samples': self.samples,
+            'files': list(self.files),
+        }
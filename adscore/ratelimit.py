@@ -0,0 +1,199 @@
+import time
+import redis
+import limits
+import flask_limiter.util
+from flask import current_app, request, abort
+from limits.storage import Storage
+
+def get_remote_address():
+    return request.headers.get('X-Original-Forwarded-For', flask_limiter.util.get_remote_address())
+
+# Sliding window counter: the hits of the previous fixed window are weighted by
+# how much of it still overlaps with the sliding window. Pending hits that were
+# already accepted locally are always added, the new hit only if it fits.
+SLIDING_WINDOW_SCRIPT = """
+local current_key = KEYS[1]
+local previous_key = KEYS[2]
+local limit = tonumber(ARGV[1])
+local expiry = tonumber(ARGV[2])
+local elapsed_ratio = tonumber(ARGV[3])
+local pending = tonumber(ARGV[4])
+local current = tonumber(redis.call('get', current_key) or '0') + pending
+local previous = tonumber(redis.call('get', previous_key) or '0')
+local count = math.floor(previous * (1 - elapsed_ratio)) + current
+local allowed = 0
+if count + 1 <= limit then
+    current = current + 1
+    count = count + 1
+    allowed = 1
+end
+if current > 0 then
+    redis.call('set', current_key, current, 'ex', expiry * 2)
+end
+return {allowed, count}
+"""
+
+class _LocalBucket(object):
+    """
+    Tokens that allow a worker to accept hits without reaching Redis, they are
+    granted when the last known count is clearly under the limit
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.pending = 0
+        self.tokens = 0
+        self.synced_at = 0
+        self.window = None
+
+class SlidingWindowRedisStorage(Storage):
+    """
+    Rate limit storage shared by all the workers through Redis that implements
+    a sliding window with one atomic Lua script per synchronization.
+
+    Each worker keeps a local token bucket per key: while the count retrieved
+    in the last synchronization is below `local_fraction` of the limit, up to
+    `local_batch` hits (or any number of hits during `local_interval` seconds)
+    are accepted without reaching Redis and are added to the shared counter in
+    the next synchronization.
+
+    Use with RATELIMIT_STRATEGY = "moving-window" and a storage URL such as
+    "sliding+redis://localhost:6379/0" ("sliding+fakeredis://" for tests).
+    """
+
+    STORAGE_SCHEME = ["sliding+redis", "sliding+rediss", "sliding+fakeredis"]
+
+    def __init__(self, uri, local_fraction=0.5, local_batch=10, local_interval=5, local_max_keys=10000, **options):
+        super(SlidingWindowRedisStorage, self).__init__()
+        uri = uri.replace("sliding+", "", 1)
+        if uri.startswith("fakeredis://"):
+            import fakeredis
+            self.storage = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+        else:
+            self.storage = redis.from_url(uri, **options)
+        self.script = self.storage.register_script(SLIDING_WINDOW_SCRIPT)
+        self.local_fraction = local_fraction
+        self.local_batch = local_batch
+        self.local_interval = local_interval
+        self.local_max_keys = local_max_keys
+        self.buckets = {}
+        self.local_hits = 0
+        self.redis_hits = 0
+
+    def _window_keys(self, key, expiry, now):
+        window = int(now // expiry)
+        return window, "{}/{}".format(key, window), "{}/{}".format(key, window - 1)
+
+    def acquire_entry(self, key, limit, expiry, no_add=False):
+        now = time.time()
+        window, current_key, previous_key = self._window_keys(key, expiry, now)
+        with self.lock:
+            if key not in self.buckets and len(self.buckets) >= self.local_max_keys:
+                self._prune(now)
+            bucket = self.buckets.setdefault(key, _LocalBucket())
+            if bucket.window != window:
+                # The local count and the hits accepted locally in an expired
+                # fixed window are meaningless in a new one
+                bucket.tokens = 0
+                bucket.pending = 0
+            if bucket.tokens > 0 and now - bucket.synced_at < self.local_interval:
+                bucket.tokens -= 1
+                bucket.pending += 1
+                self.local_hits += 1
+                return True
+            pending = bucket.pending
+        allowed, count = self.script(keys=[current_key, previous_key], args=[limit, expiry, (now % expiry) / expiry, pending])
+        with self.lock:
+            # Pending hits are kept if Redis cannot be reached, hits accepted
+            # locally in the meantime are sent in the next synchronization
+            bucket.pending = max(0, bucket.pending - pending)
+            self.redis_hits += 1
+            bucket.count = count
+            bucket.window = window
+            bucket.synced_at = now
+            bucket.tokens = max(0, min(self.local_batch, int(limit * self.local_fraction) - count))
+        return bool(allowed)
+
+    def _prune(self, now):
+        """
+        Forget buckets without pending hits that have not been used recently
+        """
+        for key in [key for key, bucket in self.buckets.items() if bucket.pending == 0 and now - bucket.synced_at >= self.local_interval]:
+            del self.buckets[key]
+
+    def get_moving_window(self, key, limit, expiry):
+        """
+        Window start and number of hits, based on the last synchronization (it
+        is used to build the rate limit headers)
+        """
+        now = time.time()
+        window, current_key, previous_key = self._window_keys(key, expiry, now)
+        bucket = self.buckets.get(key)
+        if bucket is None or bucket.window != window:
+            current, previous = self.storage.mget([current_key, previous_key])
+            count = int(int(previous or 0) * (1 - (now % expiry) / expiry)) + int(current or 0)
+        else:
+            count = bucket.count + bucket.pending
+        return window * expiry, count
+
+    def incr(self, key, expiry, elastic_expiry=False):
+        """
+        Fixed window counter (only used by the fixed window strategies)
+        """
+        value = self.storage.incr(key)
+        if elastic_expiry or value == 1:
+            self.storage.expire(key, expiry)
+        return value
+
+    def get(self, key):
+        return int(self.storage.get(key) or 0)
+
+    def get_expiry(self, key):
+        return int(max(self.storage.ttl(key), 0) + time.time())
+
+    def check(self):
+        try:
+            return self.storage.ping()
+        except Exception:
+            return False
+
+    def reset(self):
+        with self.lock:
+            self.buckets.clear()
+        for key in self.storage.scan_iter("LIMITER*"):
+            self.storage.delete(key)
+
+    def clear(self, key):
+        with self.lock:
+            self.buckets.pop(key, None)
+        for window_key in self.storage.scan_iter("{}*".format(key)):
+            self.storage.delete(window_key)
+
+    def stats(self):
+        return {
+            'keys': len(self.buckets),
+            'local_hits': self.local_hits,
+            'redis_hits': self.redis_hits,
+        }
+
+def hit(limit, scope):
+    """
+    Count a hit of the remote address against a limit (e.g., "400 per 1 day")
+    at any point of a request instead of before the request (e.g., only when
+    something expensive is going to happen), it aborts with 429 when the limit
+    is exceeded. Request filters (e.g., sessions or bots) do not apply.
+    """
+    limiter = current_app.extensions['limiter']
+    if not limit or not limiter.enabled:
+        return
+    item = limits.parse(limit)
+    identifiers = [current_app.config['RATELIMIT_KEY_PREFIX'], get_remote_address(), scope]
+    try:
+        allowed = limiter.limiter.hit(item, *[identifier for identifier in identifiers if identifier])
+    except Exception:
+        current_app.logger.exception("Exception while checking rate limit '%s'", limit)
+        if not current_app.config['RATELIMIT_SWALLOW_ERRORS']:
+            raise
+        allowed = True
+    if not allowed:
+        abort(429, description=str(item))
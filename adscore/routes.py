@@ -1,9 +1,16 @@
+import re
+import hmac
 import time
 import urllib.parse
-from flask import render_template, session, request, redirect, g, current_app, url_for, abort
-from adscore.app import app, limiter, redis_client, get_remote_address
+from werkzeug.exceptions import HTTPException
+from flask import render_template, session, request, redirect, g, current_app, url_for, abort, jsonify, Response, stream_with_context
+from adscore.app import app, limiter, get_remote_address
 from adscore.api import API, RequestsManager
+from adscore.api.abstract import Abstract
 from adscore import crawlers
+from adscore import ratelimit
+from adscore import cache
+from adscore import stats
 from adscore.forms import ModernForm, PaperForm, ClassicForm
 from adscore.tools import is_expired
 
@@ -16,12 +23,19 @@ def _url_for(*args, **kwargs):
         kwargs.update({'_external': True, '_scheme': 'https'})
     return url_for(*args, **kwargs)
 
+def _is_probe_or_admin():
+    """
+    Readiness/liveness probes and admin endpoints do not need API tokens
+    """
+    return request.path in ('/ready', '/alive') or request.path.startswith(app.config['SERVER_BASE_URL']+'admin/')
+
 @limiter.request_filter
 def probes():
     """
-    If the request is related to the readiness/liveness probe, do not rate limit.
+    If the request is related to the readiness/liveness probe or an admin
+    endpoint, do not rate limit.
     """
-    return request.path in ('/ready', '/alive')
+    return _is_probe_or_admin()
 
 @limiter.request_filter
 def header_whitelist():
@@ -32,7 +46,8 @@ def header_whitelist():
     cookies set by ADS Core and thus, we do not want to rate limit them.
 
     Rate limits are only to protect us from bootstrapping thousands of access
-    tokens in the database.
+    tokens in the database (bootstraps are also limited by RATELIMIT_BOOTSTRAP
+    when they actually happen).
     """
     if 'auth' in session:
         return True
@@ -56,13 +71,11 @@ def before_request():
     """
     Store API anonymous cookie in session or if it exists, check if it has expired
     """
-    if request.path in ('/ready', '/alive'):
+    if _is_probe_or_admin():
         # Do not bootstrap readiness/liveness probes
         return
     g.request_start_time = time.time()
     g.request_time = lambda: "{:.3f}s".format((time.time() - g.request_start_time))
-    if 'cookies' not in session:
-        session['cookies'] = {}
 
     if 'auth' not in session or is_expired(session['auth']):
         user_agent = request.headers.get('User-Agent')
@@ -93,7 +106,7 @@ def before_request():
             # - Ignore any previous bootstrapped access token
             RequestsManager.init(auth={}, cookies={'session': request.cookies.get('session')})
         elif 'auth' not in session:
-            # No BBB or core session, API will bootstrap
+            # No BBB or core session, API will bootstrap (if any request is needed)
             RequestsManager.init(auth={}, cookies={})
         else:
             # We have a core session and no BBB session, this is the only situation
@@ -102,13 +115,98 @@ def before_request():
 
 @app.after_request
 def after_request(response):
+    cacheable = _is_cacheable(response)
     # Store up-to-date auth data in cookie session
     if RequestsManager.is_initialized():
         manager = RequestsManager()
-        session.clear()
-        session['auth'] = manager.auth
+        if not manager.auth or session.get('auth') == manager.auth:
+            # Nothing was bootstrapped (e.g., the page was served from the cache)
+            # or the auth data did not change, avoid re-signing the session and
+            # sending a Set-Cookie header
+            pass
+        elif cacheable and manager.auth.get('bot', False):
+            # Shared caches must never store a response with a Set-Cookie header
+            # and bot auth data is re-created on every request (no bootstrap involved)
+            pass
+        else:
+            session.clear()
+            session['auth'] = manager.auth
+    if cacheable and not session.modified:
+        response.headers['Cache-Control'] = "public, max-age={}, s-maxage={}".format(current_app.config['CACHE_CONTROL_MAX_AGE'], current_app.config['CACHE_CONTROL_S_MAXAGE'])
+        response.headers['Surrogate-Key'] = " ".join(g.surrogate_keys)
+        if g.get('cookie_dependent'):
+            # The same URL redirects users with the 'core' cookie set to 'always'
+            response.vary.add('Cookie')
+    elif session.modified:
+        response.headers['Cache-Control'] = "private"
     return response
 
+def _is_cacheable(response):
+    """
+    Only anonymous responses to pages that are the same for every user (i.e.,
+    they were marked with surrogate keys) can be stored by a shared cache such as
+    nginx or a CDN. A BBB session cookie means that the user may be authenticated.
+    Degraded pages (missing parts due to overloaded services) are never shared.
+    """
+    return current_app.config['CACHE_CONTROL_ENABLED'] \
+            and 'surrogate_keys' in g \
+            and request.method in ('GET', 'HEAD') \
+            and response.status_code == 200 \
+            and not g.get('degraded') \
+            and not request.cookies.get('session')
+
+def _surrogate_keys(bibcode, section, cookie_dependent=False):
+    """
+    Mark the response as cacheable by shared caches, tagged with keys that allow
+    purging all the cached pages of a given bibcode at once. Shared caches store
+    pages that depend on cookies separately for every Cookie header.
+    """
+    g.surrogate_keys = (bibcode, "/".join((bibcode, section)))
+    g.cookie_dependent = cookie_dependent
+
+@app.url_value_preprocessor
+def prefetch(endpoint, values):
+    """
+    Retrieve from Redis with a single round trip the keys that the request is
+    going to need (url value preprocessors run before any before_request
+    function, including the rate limiter request filters)
+    """
+    if _is_probe_or_admin():
+        return
+    keys = []
+    if 'auth' not in session or is_expired(session['auth']):
+        keys.append(crawlers.cache_key(get_remote_address() or "", request.headers.get('User-Agent')))
+    if endpoint == 'abs' and values:
+        identifier, section = _split_abs_path(**values)
+        if identifier and _is_valid_identifier(identifier):
+            keys.append(identifier)
+            keys.append(Abstract.alias_key(identifier))
+            keys.append(Abstract.missing_key(identifier))
+            keys.append(_render_key(identifier, ABSTRACT_RENDER_NAMES[section]))
+            # Sub-resources used by the templates if the page is not already
+            # rendered (most requests use the bibcode as identifier)
+            sections = ("associated", "graphics", "metrics", "export") if section == "exportcitation" else ("associated", "graphics", "metrics")
+            keys.extend(Abstract.section_key(identifier, name) for name in sections)
+    try:
+        cache.prefetch(keys)
+    except Exception:
+        app.logger.exception("Exception while prefetching keys from cache")
+        # Do not affect users if connection to Redis is lost in production
+        if app.debug:
+            raise
+
+@app.teardown_request
+def teardown_request(exception):
+    """
+    Send all the Redis writes deferred during the request in a single pipeline
+    """
+    try:
+        cache.flush()
+    except Exception:
+        app.logger.exception("Exception while storing deferred writes to cache")
+        # Do not affect users if connection to Redis is lost in production
+        if app.debug:
+            raise
 
 @app.errorhandler(429)
 def ratelimit_handler(e):
@@ -141,11 +239,54 @@ def page_not_found(e):
     form = ModernForm()
     return _render_template('404.html', request_path=request.path[1:], form=form, code=404), 404
 
+@app.errorhandler(503)
+def service_unavailable(e):
+    form = ModernForm()
+    return _render_template('503.html', request_path=request.path[1:], form=form, code=503), 503
+
 @app.errorhandler(500)
 def internal_error(e):
     form = ModernForm()
     return _render_template('500.html', request_path=request.path[1:], form=form, code=500), 500
 
+@app.route(app.config['SERVER_BASE_URL']+'admin/stats', methods=['GET'])
+def admin_stats():
+    """
+    Statistics of internal components (e.g., redis nodes) for operators
+    """
+    _check_admin_token()
+    return jsonify(stats.collect())
+
+@app.route(app.config['SERVER_BASE_URL']+'admin/profiler', methods=['GET', 'POST'])
+def admin_profiler():
+    """
+    Status of the sampling profiler of the worker that answers, a POST starts
+    profiling its requests (optional duration in seconds and rate as the
+    fraction of requests to sample)
+    """
+    _check_admin_token()
+    profiler = current_app.extensions['profiler']
+    if request.method == 'POST':
+        try:
+            duration = float(request.values.get('duration', current_app.config['PROFILER_DURATION']))
+            rate = float(request.values.get('rate', current_app.config['PROFILER_RATE']))
+        except ValueError:
+            abort(400)
+        if not 0 < duration <= current_app.config['PROFILER_MAX_DURATION'] or not 0 < rate <= 1:
+            abort(400)
+        if not profiler.start(duration=duration, rate=rate):
+            return jsonify(profiler.stats()), 409
+    return jsonify(profiler.stats())
+
+def _check_admin_token():
+    """
+    Admin endpoints are only available if ADMIN_ACCESS_TOKEN is configured and
+    sent as a bearer token
+    """
+    token = current_app.config['ADMIN_ACCESS_TOKEN']
+    if not token or not hmac.compare_digest(request.headers.get('Authorization', ''), "Bearer {}".format(token)):
+        abort(404)
+
 @app.route(app.config['SERVER_BASE_URL']+'unavailable', methods=['GET', 'POST', 'PUT', 'DELETE'], strict_slashes=False)
 @app.route(app.config['SERVER_BASE_URL']+'v1', methods=['GET', 'POST', 'PUT', 'DELETE'], strict_slashes=False)
 @app.route(app.config['SERVER_BASE_URL']+'v1/<path:endpoint>', methods=['GET', 'POST', 'PUT', 'DELETE'], strict_slashes=False)
@@ -185,11 +326,64 @@ def search(params=None):
                 form.sort.data = "first_author asc"
         api = API()
         results = api.search(form.q.data, rows=form.rows.data, start=form.start.data, sort=form.sort.data)
+        prefetcher = current_app.extensions.get('search_prefetcher')
+        if prefetcher:
+            try:
+                prefetcher.served(form.q.data, form.rows.data, form.start.data, form.sort.data, results)
+            except Exception:
+                current_app.logger.exception("Exception while scheduling search results prefetch")
+                # Do not affect users if connection to Redis is lost in production
+                if current_app.debug:
+                    raise
         qtime = "{:.3f}s".format(float(results.get('responseHeader', {}).get('QTime', 0)) / 1000)
         return _render_template('search-results.html', form=form, results=results.get('response'), stats=results.get('stats'), error=results.get('error'), qtime=qtime, sort_options=current_app.config['SORT_OPTIONS'])
     else:
         return redirect(_url_for('index'))
 
+@app.route(app.config['SERVER_BASE_URL']+'search/export', methods=['GET'], strict_slashes=False)
+def search_export():
+    """
+    Stream the BibTeX export of the search results (up to EXPORT_MAX_RECORDS),
+    bulk exports are not available to crawlers and every client (including the
+    ones with a session) is limited by EXPORT_RATELIMIT
+    """
+    q = request.args.get('q')
+    if not q:
+        return redirect(_url_for('index'))
+    evaluation = crawlers.evaluate(get_remote_address(), request.headers.get('User-Agent'))
+    if evaluation in (crawlers.VERIFIED_BOT, crawlers.UNVERIFIABLE_BOT, crawlers.POTENTIAL_MALICIOUS_BOT):
+        abort(403)
+    # Request filters exempt sessions and bots from the limits declared with
+    # the limiter, exports count against their own limit
+    ratelimit.hit(current_app.config['EXPORT_RATELIMIT'], "export")
+    sort = request.args.get('sort') or "date desc"
+    api = API()
+    chunks = api.export(q, sort=sort)
+    # The first batch is exported before sending the headers so that the session
+    # is stored if the API bootstraps and query errors are shown by the search page
+    try:
+        first_chunk = next(chunks, "")
+    except HTTPException:
+        raise
+    except Exception:
+        current_app.logger.exception("Exception while starting the export of '%s'", q)
+        return redirect(_url_for('search', q=q, sort=sort))
+
+    def stream():
+        yield first_chunk
+        try:
+            for chunk in chunks:
+                yield chunk
+        except Exception:
+            current_app.logger.exception("Exception while exporting '%s'", q)
+            yield "\n% The export was interrupted by an error, it is incomplete\n"
+
+    response = Response(stream_with_context(stream()), mimetype="text/plain")
+    response.headers['Content-Disposition'] = 'attachment; filename="export.bib"'
+    if api.is_export_truncated():
+        response.headers['X-Export-Truncated'] = "{} of {} records".format(current_app.config['EXPORT_MAX_RECORDS'], api.num_found)
+    return response
+
 @app.route(app.config['SERVER_BASE_URL']+'classic-form', methods=['GET'], strict_slashes=False)
 def classic_form():
     """
@@ -215,20 +409,22 @@ def paper_form():
         query = None
         form = PaperForm(request.args)
         api = API()
-        results = api.resolve_reference(request.args.get('reference'))
-        if results.get('resolved', {}).get('bibcode'):
-            query = "bibcode:{}".format(results.get('resolved', {}).get('bibcode'))
+        bibcode = api.resolve_reference(request.args.get('reference'))
+        if bibcode:
+            query = "bibcode:{}".format(bibcode)
         else:
             reference_error = "Error occurred resolving reference"
     else:
         reference_error = None
         if request.method == 'POST':
-            # Bottom form with bibcode list
+            # Bottom forms with bibcode or reference list
             form = PaperForm(request.form)
         else: # GET
             # Top form with fields
             form = PaperForm(request.args)
         query = form.build_query()
+        if not query and form.references.data:
+            reference_error = "None of the references could be resolved"
     if query:
         return redirect(_url_for('search', q=query))
     else:
@@ -242,6 +438,44 @@ def public_libraries(identifier):
     #return redirect(_url_for('search', q=f"docs(library/{identifier})"))
     return search(params=f"q=docs(library/{identifier})")
 
+# Name used in the render cache key for each abstract section
+ABSTRACT_RENDER_NAMES = {
+    "abstract": "abstract",
+    "citations": "citations",
+    "references": "references",
+    "coreads": "trending",
+    "similar": "similar",
+    "toc": "toc",
+    "exportcitation": "export",
+    "graphics": "graphics",
+    "metrics": "metrics",
+}
+
+def _split_abs_path(identifier=None, section=None, alt_identifier=None):
+    """
+    Identifier and section that abs() will serve for the given URL values, it
+    does not validate the identifier
+    """
+    if section is not None and section not in ABSTRACT_RENDER_NAMES:
+        alt_identifier = identifier + "/" + section
+        identifier = None
+    if alt_identifier:
+        splitted_alt_identifier = alt_identifier.split("/")
+        if len(splitted_alt_identifier) > 1 and splitted_alt_identifier[-1] in ABSTRACT_RENDER_NAMES:
+            return "/".join(splitted_alt_identifier[:-1]), splitted_alt_identifier[-1]
+        return alt_identifier, "abstract"
+    return identifier, section or "abstract"
+
+# Wildcards, quotes, whitespace and control characters
+_INVALID_IDENTIFIER_CHARACTERS = re.compile(r'[*?"\s\x00-\x1f\x7f]')
+
+def _is_valid_identifier(identifier):
+    """
+    Cheap syntactic checks to reject identifiers that cannot match any record
+    before retrieving anything
+    """
+    return len(identifier) <= current_app.config['IDENTIFIER_MAX_LENGTH'] and not _INVALID_IDENTIFIER_CHARACTERS.search(identifier)
+
 @app.route(app.config['SERVER_BASE_URL']+'abs/<path:alt_identifier>', methods=['GET'])
 @app.route(app.config['SERVER_BASE_URL']+'abs/<identifier>/<section>', methods=['GET'])
 @app.route(app.config['SERVER_BASE_URL']+'abs/<identifier>', methods=['GET'], strict_slashes=False)
@@ -269,13 +503,17 @@ def abs(identifier=None, section=None, alt_identifier=None):
         identifier = None
 
     if identifier:
-        if (section in abs.sections and len(identifier) < 15) or "*" in identifier or "?" in identifier:
+        if (section in abs.sections and len(identifier) < 15) or not _is_valid_identifier(identifier):
             # - We do not have identifiers smaller than 15 characters,
             #   bibcodes are 19 (2020arXiv200410735B) and current arXiv are 16
             #   (arXiv:2004.10735)
-            # - Identifiers do not contain wildcards (*, ?)
+            # - Identifiers do not contain wildcards (*, ?), quotes, whitespace
+            #   or control characters, and they are not very long
             abort(404)
             section in ("abstract", "citations", "references", "coreads")
+        bibcode = Abstract.alias(identifier)
+        if bibcode:
+            return _redirect_alias(bibcode, section or "abstract")
         if section is None:
             return _abstract(identifier)
         elif section in abs.sections:
@@ -284,29 +522,41 @@ def abs(identifier=None, section=None, alt_identifier=None):
             # An alternative identifier mistaken by a composition of id + section
             return _abstract(identifier+'/'+section)
     elif alt_identifier:
-        if "*" in alt_identifier or "?" in alt_identifier:
-            # - Identifiers do not contain wildcards (*, ?)
+        if not _is_valid_identifier(alt_identifier):
+            # - Identifiers do not contain wildcards (*, ?), quotes, whitespace
+            #   or control characters, and they are not very long
             abort(404)
         splitted_alt_identifier = alt_identifier.split("/")
         if len(splitted_alt_identifier) > 1 and splitted_alt_identifier[-1] in abs.sections.keys():
             # Example: https://ui.adsabs.harvard.edu/abs/10.1051/0004-6361:20066170/abstract
             alt_identifier = "/".join(splitted_alt_identifier[:-1])
             section = splitted_alt_identifier[-1]
-            return abs.sections[section](alt_identifier)
-        # Alternative identifiers such as DOIs (e.g., /abs/10.1051/0004-6361/201423945)
-        return _abstract(alt_identifier)
+        else:
+            # Alternative identifiers such as DOIs (e.g., /abs/10.1051/0004-6361/201423945)
+            section = "abstract"
+        bibcode = Abstract.alias(alt_identifier)
+        if bibcode:
+            return _redirect_alias(bibcode, section)
+        return abs.sections[section](alt_identifier)
     else:
         abort(404)
 
+def _redirect_alias(bibcode, section):
+    """
+    Redirect an alternative identifier that is already known (e.g., DOI) to the
+    page of its bibcode without retrieving the record
+    """
+    target_url = _url_for('abs', identifier=bibcode, section=section)
+    return redirect(target_url, code=301)
+
 def _cached_render_template(key, *args, **kwargs):
     """
     Cache only the template rendering so that other parts of the code get executed
     such as connecting to link_gateway to register clicks
     """
     try:
-        rendered_template = redis_client.get(key)
-        if rendered_template:
-            rendered_template = rendered_template.decode('utf-8')
+        # Bytes are sent as they are, without decoding and re-encoding them
+        rendered_template = cache.get(key)
     except Exception:
         # Do not affect users if connection to Redis is lost in production
         if app.debug:
@@ -315,15 +565,24 @@ def _cached_render_template(key, *args, **kwargs):
 
     if not rendered_template:
         rendered_template = _render_template(*args, **kwargs)
-
-    try:
-        redis_client.set(key, rendered_template, ex=app.config['REDIS_EXPIRATION_TIME'])
-    except Exception:
-        # Do not affect users if connection to Redis is lost in production
-        if app.debug:
-            raise
+        if g.get('degraded'):
+            # Some parts of the page are missing because of overloaded services
+            return rendered_template
+        try:
+            tags = (kwargs['doc']['bibcode'],) if 'bibcode' in kwargs.get('doc', {}) else ()
+            cache.set(key, rendered_template, ex=app.config['REDIS_EXPIRATION_TIME'], tags=tags)
+        except Exception:
+            # Do not affect users if connection to Redis is lost in production
+            if app.debug:
+                raise
     return rendered_template
 
+def _render_key(identifier, name):
+    """
+    Redis key where the rendered template of an abstract section is cached
+    """
+    return "/".join((app.config['REDIS_RENDER_KEY_PREFIX'], identifier, name))
+
 def _render_template(*args, **kwargs):
     """
     Wrapper to render template with multiple default variables
@@ -353,7 +612,8 @@ def _abstract(identifier, section=None):
             return redirect(target_url, code=301)
         if _register_click():
             api.link_gateway(doc['bibcode'], "abstract")
-        key = "/".join((app.config['REDIS_RENDER_KEY_PREFIX'], identifier, 'abstract'))
+        key = _render_key(identifier, 'abstract')
+        _surrogate_keys(doc['bibcode'], 'abstract')
         return _cached_render_template(key, 'abstract.html', doc=doc)
     else:
         abort(404)
@@ -377,7 +637,8 @@ def _operation(operation, identifier):
         if request.cookies.get('core', 'never') == 'always':
             return redirect(target_url)
         else:
-            key = "/".join((app.config['REDIS_RENDER_KEY_PREFIX'], identifier, operation))
+            key = _render_key(identifier, operation)
+            _surrogate_keys(doc['bibcode'], operation, cookie_dependent=True)
             return _cached_render_template(key, 'abstract-empty.html', doc=doc)
     else:
         abort(404)
@@ -395,7 +656,8 @@ def _toc(identifier):
         if request.cookies.get('core', 'never') == 'always':
             return redirect(target_url)
         else:
-            key = "/".join((app.config['REDIS_RENDER_KEY_PREFIX'], identifier, 'toc'))
+            key = _render_key(identifier, 'toc')
+            _surrogate_keys(doc['bibcode'], 'toc', cookie_dependent=True)
             return _cached_render_template(key, 'abstract-empty.html', doc=doc)
     else:
         abort(404)
@@ -412,7 +674,8 @@ def _export(identifier):
     if doc.get('export'):
         if 'bibcode' in doc and _register_click():
             api.link_gateway(doc['bibcode'], "exportcitation")
-        key = "/".join((app.config['REDIS_RENDER_KEY_PREFIX'], identifier, 'export'))
+        key = _render_key(identifier, 'export')
+        _surrogate_keys(doc['bibcode'], 'export')
         return _cached_render_template(key, 'abstract-export.html', doc=doc)
     else:
         abort(404)
@@ -429,7 +692,8 @@ def _graphics(identifier):
     if len(doc.get('graphics', {}).get('figures', [])) > 0:
         if 'bibcode' in doc and _register_click():
             api.link_gateway(doc['bibcode'], "graphics")
-        key = "/".join((app.config['REDIS_RENDER_KEY_PREFIX'], identifier, 'graphics'))
+        key = _render_key(identifier, 'graphics')
+        _surrogate_keys(doc['bibcode'], 'graphics')
         return _cached_render_template(key, 'abstract-graphics.html', doc=doc)
     else:
         abort(404)
@@ -446,7 +710,8 @@ def _metrics(identifier):
     if int(doc.get('metrics', {}).get('citation stats', {}).get('total number of citations', 0)) > 0 or int(doc.get('metrics', {}).get('basic stats', {}).get('total number of reads', 0)) > 0:
         if 'bibcode' in doc and _register_click():
             api.link_gateway(doc['bibcode'], "metrics")
-        key = "/".join((app.config['REDIS_RENDER_KEY_PREFIX'], identifier, 'metrics'))
+        key = _render_key(identifier, 'metrics')
+        _surrogate_keys(doc['bibcode'], 'metrics')
         return _cached_render_template(key, 'abstract-metrics.html', doc=doc)
     else:
         abort(404)
@@ -0,0 +1,104 @@
+import os
+import gzip
+import datetime
+import threading
+import urllib.parse
+import concurrent.futures
+from xml.sax.saxutils import escape
+
+# Limit of URLs per sitemap file (https://www.sitemaps.org/protocol.html)
+MAX_URLS_PER_SITEMAP = 50000
+
+class SitemapWriter(object):
+    """
+    Write abstract URLs into gzipped sitemap files of at most urls_per_file URLs
+    as they are received, and a sitemap index that lists all of them
+    """
+
+    def __init__(self, output_dir, base_url, sitemaps_url, urls_per_file=MAX_URLS_PER_SITEMAP):
+        self.output_dir = output_dir
+        self.base_url = base_url
+        self.sitemaps_url = sitemaps_url
+        self.urls_per_file = min(urls_per_file, MAX_URLS_PER_SITEMAP)
+        self.filenames = []
+        self.urls = 0
+        self._file = None
+        self._file_urls = 0
+        os.makedirs(output_dir, exist_ok=True)
+
+    def add(self, bibcode):
+        if self._file is None or self._file_urls >= self.urls_per_file:
+            self._next_file()
+        url = self.base_url + "abs/" + urllib.parse.quote(bibcode, safe="") + "/abstract"
+        self._file.write("<url><loc>{}</loc></url>\n".format(escape(url)))
+        self._file_urls += 1
+        self.urls += 1
+
+    def _next_file(self):
+        self._close_file()
+        filename = "sitemap-{:05d}.xml.gz".format(len(self.filenames) + 1)
+        self.filenames.append(filename)
+        self._file = gzip.open(os.path.join(self.output_dir, filename), "wt", encoding="utf-8")
+        self._file.write('<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        self._file_urls = 0
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.write("</urlset>\n")
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        """
+        Finish the last sitemap file and write the index
+        """
+        self._close_file()
+        lastmod = datetime.date.today().isoformat()
+        with open(os.path.join(self.output_dir, "sitemap.xml"), "w", encoding="utf-8") as index:
+            index.write('<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+            for filename in self.filenames:
+                index.write("<sitemap><loc>{}</loc><lastmod>{}</lastmod></sitemap>\n".format(escape(self.sitemaps_url + filename), lastmod))
+            index.write("</sitemapindex>\n")
+
+def snapshot_path(output_dir, bibcode):
+    """
+    Path of the static abstract page, it matches the URL path of the dynamic page
+    plus '.html' (e.g., abs/2019A&A...629L...7C/abstract.html)
+    """
+    return os.path.join(output_dir, "abs", bibcode, "abstract.html")
+
+def render_snapshots(bibcodes, render, output_dir, workers=4):
+    """
+    Render and write the abstract page of every bibcode with at most `workers`
+    pages being rendered at the same time. Bibcodes are consumed as pages are
+    completed, so memory does not grow with the number of bibcodes. The render
+    function returns the page (bytes or str) or None if it cannot be rendered.
+    Returns the number of written and failed pages.
+    """
+    slots = threading.BoundedSemaphore(workers)
+    counters = {'written': 0, 'failed': 0}
+    lock = threading.Lock()
+
+    def snapshot(bibcode):
+        try:
+            page = render(bibcode)
+            if page is None:
+                result = 'failed'
+            else:
+                path = snapshot_path(output_dir, bibcode)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as f:
+                    f.write(page if isinstance(page, bytes) else page.encode('utf-8'))
+                result = 'written'
+        except Exception:
+            result = 'failed'
+        finally:
+            slots.release()
+        with lock:
+            counters[result] += 1
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for bibcode in bibcodes:
+            slots.acquire()
+            executor.submit(snapshot, bibcode)
+    return counters['written'], counters['failed']
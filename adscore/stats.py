@@ -0,0 +1,34 @@
+import os
+import gc
+import resource
+from collections import OrderedDict
+
+_providers = OrderedDict()
+
+def register(name, provider):
+    """
+    Register a function that returns the statistics of a component (e.g., redis
+    nodes, queues or connection pools) to be reported by the stats endpoint
+    """
+    _providers[name] = provider
+
+def collect():
+    return {name: provider() for name, provider in _providers.items()}
+
+def rss():
+    """
+    Resident set size of the current process in bytes
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        # /proc is not available (e.g., macOS), fall back to the peak size
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def process():
+    return {
+        'pid': os.getpid(),
+        'rss': rss(),
+        'gc_frozen_objects': gc.get_freeze_count(),
+    }
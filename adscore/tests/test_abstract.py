@@ -0,0 +1,67 @@
+from flask import g, abort
+from adscore import cache
+from adscore.api import RequestsManager
+from adscore.api.abstract import Abstract
+from adscore.tests import ADSCoreTestCase
+import unittest
+
+class TestAbstractSections(ADSCoreTestCase):
+
+    record = {'bibcode': "2019A&A...629L...7C", 'identifier': ["2019A&A...629L...7C"], 'title': ["A title"], 'property': [], '[citations]': {'num_references': 1, 'num_citations': 1}}
+
+    def setUp(self):
+        self.requests = []
+        self.metrics = {'basic stats': {'total number of reads': 1}}
+        RequestsManager.init(auth={'access_token': "token", 'expire_in': "2050-01-01T00:00:00", 'bot': False}, cookies={})
+        g.manager_instance.request = self._request
+
+    def _request(self, endpoint, params, method="GET", **kwargs):
+        self.requests.append(endpoint)
+        if endpoint.startswith(self.app.config['SEARCH_SERVICE']):
+            return {'responseHeader': {'QTime': 1}, 'response': {'numFound': 1, 'docs': [dict(self.record)]}}
+        if endpoint.startswith(self.app.config['METRICS_SERVICE']):
+            if self.metrics is None:
+                abort(503)
+            return self.metrics
+        if endpoint.startswith(self.app.config['EXPORT_SERVICE']):
+            return {"error": "Export is not available"}
+        return {}
+
+    def ttl(self, section):
+        return self.app.extensions['redis'].ttl(Abstract.section_key("2019A&A...629L...7C", section))
+
+    def test_core_fields(self):
+        doc = Abstract("2019A&A...629L...7C")
+        assert doc['title'] == ["A title"]
+        assert self.requests == [self.app.config['SEARCH_SERVICE']]
+
+    def test_sections(self):
+        doc = Abstract("2019A&A...629L...7C")
+        assert doc['metrics'] == self.metrics
+        # Errors are cached (as empty values) for a shorter time
+        assert doc['export'] is None
+        assert len(self.requests) == 3
+        cache.flush()
+        expiration_times = self.app.config['REDIS_ABSTRACT_SECTIONS_EXPIRATION_TIME']
+        assert expiration_times['metrics'] - 5 < self.ttl('metrics') <= expiration_times['metrics']
+        assert 0 < self.ttl('export') <= self.app.config['REDIS_EXPIRATION_TIME']
+        assert self.ttl('graphics') == -2
+        # Sections are shared with other requests
+        with self.app.app_context(), self.app.test_request_context():
+            RequestsManager.init(auth={'access_token': "token"}, cookies={})
+            g.manager_instance.request = self._request
+            doc = Abstract("2019A&A...629L...7C")
+            assert doc['metrics'] == self.metrics
+        assert len(self.requests) == 3
+
+    def test_unavailable_section(self):
+        self.metrics = None
+        doc = Abstract("2019A&A...629L...7C")
+        assert doc['metrics'] == {}
+        assert g.degraded
+        cache.flush()
+        assert self.ttl('metrics') == -2
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import time
+import threading
+from adscore.admission import Upstream, Overloaded
+from adscore.tests import ADSCoreTestCase
+import unittest
+
+class TestUpstream(ADSCoreTestCase):
+
+    def _wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        assert condition()
+
+    def _acquire_in_thread(self, upstream, results):
+        def acquire():
+            try:
+                with upstream:
+                    results.append("admitted")
+            except Overloaded:
+                results.append("shed")
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        return thread
+
+    def test_queueing(self):
+        upstream = Upstream("test", "http://upstream/", concurrency=1, queue_timeout=5, max_queue=1)
+        results = []
+        upstream.acquire()
+        thread = self._acquire_in_thread(upstream, results)
+        self._wait_for(lambda: upstream.waiting == 1)
+        assert upstream.in_flight == 1
+        # The waiting request gets the slot as soon as it is released
+        upstream.release()
+        thread.join()
+        assert results == ["admitted"]
+        stats = upstream.stats()
+        assert stats['admitted'] == 2 and stats['shed'] == 0 and stats['max_waiting'] == 1
+        assert stats['in_flight'] == 0 and stats['waiting'] == 0
+
+    def test_shedding(self):
+        upstream = Upstream("test", "http://upstream/", concurrency=1, queue_timeout=0.2, max_queue=1)
+        results = []
+        upstream.acquire()
+        thread = self._acquire_in_thread(upstream, results)
+        self._wait_for(lambda: upstream.waiting == 1)
+        # The queue is full, it does not wait
+        start = time.time()
+        with self.assertRaises(Overloaded):
+            upstream.acquire()
+        assert time.time() - start < 0.1
+        # The queued request waits at most queue_timeout seconds
+        thread.join()
+        assert results == ["shed"]
+        upstream.release()
+        stats = upstream.stats()
+        assert stats['admitted'] == 1 and stats['shed'] == 2
+        assert stats['in_flight'] == 0 and stats['waiting'] == 0
+        with upstream:
+            assert upstream.in_flight == 1
+
+    def test_upstreams(self):
+        admission = self.app.extensions['admission']
+        assert admission.upstream(self.app.config['SEARCH_SERVICE'] + "?q=star").name == "SEARCH_SERVICE"
+        assert admission.upstream(self.app.config['EXPORT_SERVICE']).concurrency == self.app.config['UPSTREAM_LIMITS']['EXPORT_SERVICE']['concurrency']
+        assert admission.upstream(self.app.config['API_URL'] + "unknown").name == "default"
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+from flask import g
+from adscore import cache
+from adscore.api import API, RequestsManager
+from adscore.tests import ADSCoreTestCase
+import unittest
+
+class TestStoreQuery(ADSCoreTestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.vault_error = False
+        RequestsManager.init(auth={'access_token': "token", 'expire_in': "2050-01-01T00:00:00", 'bot': False}, cookies={})
+        g.manager_instance.request = self._request
+
+    def _request(self, endpoint, params, method="GET", **kwargs):
+        self.requests.append(params)
+        if self.vault_error:
+            return {"error": "Vault is not available"}
+        return {'qid': "qid-{}".format(len(self.requests))}
+
+    def test_identical_bibcodes(self):
+        api = API()
+        assert api.store_query(["2020ApJ...900...1A", "2019A&A...629L...7C"]) == {'qid': "qid-1"}
+        # Order and repeated bibcodes do not matter
+        assert api.store_query(["2019A&A...629L...7C", "2020ApJ...900...1A", "2019A&A...629L...7C"]) == {'qid': "qid-1"}
+        assert len(self.requests) == 1
+        assert self.requests[0]['bigquery'] == ["bibcode\n2019A&A...629L...7C\n2020ApJ...900...1A"]
+        assert api.store_query(["2019A&A...629L...7C"]) == {'qid': "qid-2"}
+        assert api.store_query(["2019A&A...629L...7C", "2020ApJ...900...1A"], sort="date asc") == {'qid': "qid-3"}
+
+    def test_shared_qid(self):
+        API().store_query(["2019A&A...629L...7C"])
+        cache.flush()
+        # Other requests find the QID in Redis
+        with self.app.app_context(), self.app.test_request_context():
+            RequestsManager.init(auth={'access_token': "token"}, cookies={})
+            g.manager_instance.request = self._request
+            assert API().store_query(["2019A&A...629L...7C"]) == {'qid': "qid-1"}
+        assert len(self.requests) == 1
+
+    def test_errors_are_not_cached(self):
+        self.vault_error = True
+        assert 'error' in API().store_query(["2019A&A...629L...7C"])
+        self.vault_error = False
+        assert API().store_query(["2019A&A...629L...7C"]) == {'qid': "qid-2"}
+
+
+if __name__ == '__main__':
+    unittest.main()
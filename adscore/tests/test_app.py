@@ -0,0 +1,38 @@
+import os
+import sys
+import subprocess
+from adscore import stats
+from adscore.tests import ADSCoreTestCase
+import unittest
+
+class TestPreload(ADSCoreTestCase):
+
+    def test_lazy_imports(self):
+        # Modules only needed by bots, the CLI or optional features are not
+        # imported by the workers
+        lazy_modules = ["dns.resolver", "flask_minify", "adscore.commands", "adscore.sitemap"]
+        code = "import sys, adscore; print(' '.join(name for name in {!r} if name in sys.modules))".format(lazy_modules)
+        output = subprocess.check_output([sys.executable, "-c", code], env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)), stderr=subprocess.DEVNULL)
+        assert output.decode('utf-8').strip() == ""
+
+    def test_fork(self):
+        http_pools = self.app.extensions['http_pools']
+        sessions = [pool.session for pool in http_pools.pools + [http_pools.default]]
+        pid = os.fork()
+        if pid == 0:
+            # Child process: connections inherited from the parent are not re-used
+            new_sessions = [pool.session for pool in http_pools.pools + [http_pools.default]]
+            os._exit(0 if all(new is not old for new, old in zip(new_sessions, sessions)) else 1)
+        _, status = os.waitpid(pid, 0)
+        assert os.WEXITSTATUS(status) == 0
+        # The parent process keeps its connections
+        assert [pool.session for pool in http_pools.pools + [http_pools.default]] == sessions
+
+    def test_process_stats(self):
+        process = stats.process()
+        assert process['pid'] == os.getpid()
+        assert process['rss'] > 0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import time
+from adscore import cache
+from adscore.tests import ADSCoreTestCase
+import unittest
+
+class TestCache(ADSCoreTestCase):
+
+    def test_deferred_writes(self):
+        redis_client = self.app.extensions['redis']
+        cache.set("CORE/key", "value", ex=60)
+        # Within a request, writes wait until the end of it...
+        assert redis_client.get("CORE/key") is None
+        assert cache.get("CORE/key") == b"value"
+        cache.flush()
+        # ...and are sent in a single pipeline
+        assert redis_client.get("CORE/key") == b"value"
+        assert 0 < redis_client.ttl("CORE/key") <= 60
+
+    def test_tags(self):
+        redis_client = self.app.extensions['redis']
+        cache.set("CORE/search", "value", ex=60, tags=("2019A&A...629L...7C", "2020ApJ...900...1A"))
+        cache.set("CORE/abstract", "value", ex=120, tags=("2019A&A...629L...7C",))
+        cache.flush()
+        tag_key = cache._tag_key("2019A&A...629L...7C")
+        assert sorted(redis_client.zrange(tag_key, 0, -1)) == [b"CORE/abstract", b"CORE/search"]
+        # Tags outlive the keys they refer to
+        assert redis_client.ttl(tag_key) >= 120
+        assert redis_client.zscore(tag_key, "CORE/abstract") > redis_client.zscore(tag_key, "CORE/search")
+
+    def test_tags_forget_expired_keys(self):
+        redis_client = self.app.extensions['redis']
+        cache.set("CORE/short", "value", ex=1, tags=("2019A&A...629L...7C",))
+        cache.flush()
+        time.sleep(1.1)
+        cache.set("CORE/long", "value", ex=60, tags=("2019A&A...629L...7C",))
+        cache.flush()
+        assert redis_client.zrange(cache._tag_key("2019A&A...629L...7C"), 0, -1) == [b"CORE/long"]
+
+    def test_purge(self):
+        redis_client = self.app.extensions['redis']
+        cache.set("CORE/search-1", "value", ex=60, tags=("2019A&A...629L...7C", "2020ApJ...900...1A"))
+        cache.set("CORE/search-2", "value", ex=60, tags=("2020ApJ...900...1A",))
+        cache.set("CORE/abstract", "value", ex=60, tags=("2019A&A...629L...7C",))
+        cache.set("CORE/untagged", "value", ex=60)
+        cache.flush()
+        assert cache.purge("2019A&A...629L...7C") == 2
+        assert redis_client.get("CORE/search-1") is None
+        assert redis_client.get("CORE/abstract") is None
+        assert redis_client.get("CORE/search-2") == b"value"
+        assert redis_client.get("CORE/untagged") == b"value"
+        assert not redis_client.exists(cache._tag_key("2019A&A...629L...7C"))
+        # Keys that were already deleted are not counted
+        assert cache.purge("2020ApJ...900...1A", "1999Missing..1....A") == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
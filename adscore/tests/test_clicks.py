@@ -0,0 +1,60 @@
+import time
+import threading
+import http.server
+from adscore.clicks import ClickLogger
+from adscore.tests import ADSCoreTestCase
+import unittest
+
+class TestClickLogger(ADSCoreTestCase):
+
+    def setUp(self):
+        self.paths = []
+        self.release = threading.Event()
+        self.release.set()
+        test = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                test.release.wait(10)
+                test.paths.append(self.path)
+                self.send_response(404 if self.path == "/missing" else 302)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        self.app.config['CLICKS_RETRIES'] = 0
+
+    def test_delivery(self):
+        clicks = ClickLogger(self.app)
+        clicks.log(self.url + "/link_gateway/2019A&A...629L...7C/PUB_PDF", {}, {})
+        clicks.log(self.url + "/missing", {}, {})
+        clicks._queue.join()
+        assert self.paths == ["/link_gateway/2019A&A...629L...7C/PUB_PDF", "/missing"]
+        assert clicks.stats() == {'queue_depth': 0, 'logged': 2, 'delivered': 1, 'failed': 1, 'dropped': 0}
+
+    def test_full_queue(self):
+        self.app.config['CLICKS_QUEUE_SIZE'] = 1
+        clicks = ClickLogger(self.app)
+        self.release.clear()
+        clicks.log(self.url + "/first", {}, {})
+        # Wait until the delivery thread is blocked with the first click
+        while clicks._queue.qsize():
+            time.sleep(0.01)
+        clicks.log(self.url + "/second", {}, {})
+        # The request is not blocked, the click is dropped
+        clicks.log(self.url + "/third", {}, {})
+        assert clicks.stats()['dropped'] == 1
+        self.release.set()
+        clicks._queue.join()
+        assert self.paths == ["/first", "/second"]
+        assert clicks.stats()['delivered'] == 2
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,18 +1,66 @@
-from adscore import crawlers
+from adscore import cache, crawlers
 from adscore.tests import ADSCoreTestCase
 import unittest
 
 class TestGoogleBot(ADSCoreTestCase):
+    def _evaluate(self, ip, ua):
+        # Bots are treated as potentially malicious until the DNS verification
+        # running in the background has finished
+        assert crawlers.evaluate(ip, ua) == crawlers.POTENTIAL_MALICIOUS_BOT
+        assert crawlers.evaluate(ip, ua) == crawlers.POTENTIAL_MALICIOUS_BOT
+        crawlers.wait_for_verifications(timeout=10)
+        # Values read from the cache are kept in g for the rest of the request,
+        # a new application context is needed to read the verdict
+        with self.app.app_context(), self.app.test_request_context():
+            return crawlers.evaluate(ip, ua)
+
     def test_classify(self):
         for ip in (' 66.249.66.145', ' 66.249.66.143', ' 66.249.66.149', ' 66.249.66.147'):
             for ua in ('Mozilla/5.0 (Linux; Android 6.0.1; Nexus 5X Build/MMB29P) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2272.96 Mobile Safari/537.36 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
                        'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)'):
-                assert crawlers.evaluate(ip, ua) == crawlers.VERIFIED_BOT
+                assert self._evaluate(ip, ua) == crawlers.VERIFIED_BOT
 
         for ip in ('128.101.175.19',):
             for ua in ('Mozilla/5.0 (Linux; Android 6.0.1; Nexus 5X Build/MMB29P) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2272.96 Mobile Safari/537.36 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
                        'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)'):
-                assert crawlers.evaluate(ip, ua) == crawlers.POTENTIAL_MALICIOUS_BOT
+                assert self._evaluate(ip, ua) == crawlers.POTENTIAL_MALICIOUS_BOT
+
+class TestPendingVerification(ADSCoreTestCase):
+
+    def setUp(self):
+        self.classifications = 0
+        self.verified = False
+        original_classify, original_verify_bot = crawlers._classify, crawlers._verify_bot
+        def classify(remote_ip, user_agent):
+            self.classifications += 1
+            return original_classify(remote_ip, user_agent)
+        crawlers._classify = classify
+        # No DNS lookups, the verification finishes when the test decides
+        crawlers._verify_bot = lambda remote_ip, bot_verification_data: self.verified
+        self.addCleanup(setattr, crawlers, '_classify', original_classify)
+        self.addCleanup(setattr, crawlers, '_verify_bot', original_verify_bot)
+
+    def test_classified_once_per_request(self):
+        ua = 'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)'
+        key = crawlers.cache_key("66.249.66.1", ua)
+        for _ in range(3):
+            assert crawlers.evaluate("66.249.66.1", ua) == crawlers.POTENTIAL_MALICIOUS_BOT
+        assert self.classifications == 1
+        crawlers.wait_for_verifications(timeout=10)
+        # The pending mark never replaces the verdict stored in the meantime
+        cache.flush()
+        assert int(self.app.extensions['redis'].get(key)) == crawlers.POTENTIAL_MALICIOUS_BOT
+
+    def test_pending_mark(self):
+        ua = 'Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)'
+        key = crawlers.cache_key("157.55.39.1", ua)
+        # Bots are not verified while too many verifications are pending
+        self.addCleanup(self.app.config.__setitem__, 'DNS_VERIFICATION_MAX_PENDING', self.app.config['DNS_VERIFICATION_MAX_PENDING'])
+        self.app.config['DNS_VERIFICATION_MAX_PENDING'] = 0
+        assert crawlers.evaluate("157.55.39.1", ua) == crawlers.POTENTIAL_MALICIOUS_BOT
+        cache.flush()
+        assert int(self.app.extensions['redis'].get(key)) == crawlers.PENDING_VERIFICATION
+        assert 0 < self.app.extensions['redis'].ttl(key) <= self.app.config['DNS_VERIFICATION_PENDING_TIME']
 
 
 if __name__ == '__main__':
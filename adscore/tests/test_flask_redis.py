@@ -0,0 +1,50 @@
+from adscore.tests import ADSCoreTestCase
+import unittest
+
+class TestShardedRedis(ADSCoreTestCase):
+
+    def create_app(self):
+        from adscore import create_app
+        return create_app(**{
+            'TESTING': True,
+            'REDIS_URLS': ["fakeredis://:@node-1:6379/0", "fakeredis://:@node-2:6379/0", "fakeredis://:@node-3:6379/0"],
+        })
+
+    def test_keys_are_spread(self):
+        redis_client = self.app.extensions['redis']
+        for i in range(300):
+            redis_client.set("key-{}".format(i), i)
+        for node in redis_client.nodes:
+            assert node.client.dbsize() > 50
+        assert redis_client.mget(["key-1", "key-2", "missing"]) == [b'1', b'2', None]
+
+    def test_unreachable_node(self):
+        redis_client = self.app.extensions['redis']
+        redis_client.set("key", "value")
+        owner = redis_client.node("key")
+        owner.down_until = float("inf")
+        assert redis_client.node("key") is not owner
+        assert redis_client.get("key") is None
+        redis_client.set("key", "value")
+        assert redis_client.get("key") == b'value'
+        assert [stats['up'] for stats in redis_client.stats()].count(False) == 1
+
+    def test_keyless_commands(self):
+        redis_client = self.app.extensions['redis']
+        for i in range(30):
+            redis_client.set("key-{}".format(i), i)
+        assert redis_client.dbsize() == 30
+        assert len(redis_client.keys("key-*")) == 30
+        assert sorted(redis_client.scan_iter("key-*")) == sorted(redis_client.keys("key-*"))
+        # Replies that cannot be combined are given per node
+        assert sorted(redis_client.time()) == sorted(node.name for node in redis_client.nodes)
+        scan, dbsize, value = redis_client.pipeline().scan(0, count=100).dbsize().get("key-1").execute()
+        assert sum(len(keys) for _, keys in scan.values()) == 30
+        assert dbsize == 30
+        assert value == b'1'
+        assert redis_client.flushdb()
+        assert redis_client.dbsize() == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+from adscore import cache, json_codec
+from adscore.api import RequestsManager
+from adscore.api.search import Search
+from adscore.tests import ADSCoreTestCase
+import unittest
+
+class TestHotKeys(ADSCoreTestCase):
+
+    def create_app(self):
+        from adscore import create_app
+        return create_app(**{
+            'TESTING': True,
+            'HOT_KEYS_ENABLED': True,
+            'HOT_KEYS_TOP': 2,
+            'HOT_KEYS_MAX_TRACKED': 3,
+            'HOT_KEYS_DECAY': 0.5,
+            'HOT_KEYS_REFRESH_INTERVAL': 30,
+            'HOT_KEYS_REFRESH_BUDGET': 10,
+        })
+
+    def setUp(self):
+        # The refresher runs outside of requests, as in production
+        self._ctx.pop()
+        self.addCleanup(self._ctx.push)
+        app_context = self.app.app_context()
+        app_context.push()
+        self.addCleanup(app_context.pop)
+        self.hot_keys = self.app.extensions['hot_keys']
+        # Refreshes are run by the tests instead of the background thread
+        self.hot_keys._pid = os.getpid()
+        self.redis_client = self.app.extensions['redis']
+        self.redis_client.flushdb()
+        self.searches = []
+        manager_class = RequestsManager._RequestsManager__RequestsManager
+        original_request = manager_class.request
+        manager_class.request = lambda manager, endpoint, params, **kwargs: self._request(endpoint, params)
+        self.addCleanup(setattr, manager_class, 'request', original_request)
+
+    def _request(self, endpoint, params):
+        if endpoint == self.app.config['BOOTSTRAP_SERVICE']:
+            return {'access_token': "token", 'expire_in': "2050-01-01T00:00:00"}
+        self.searches.append(params['q'])
+        return {'responseHeader': {'QTime': 1}, 'response': {'numFound': 0, 'docs': []}}
+
+    def search_key(self, q):
+        return Search.cache_key(q, rows=25, start=0, sort="date desc", fields="bibcode", count=False)
+
+    def request(self, *queries):
+        """
+        Count the searches as if each of them was requested by a visitor
+        """
+        for q in queries:
+            with self.app.test_request_context():
+                cache.touch(self.search_key(q), {'search': {'q': q, 'rows': 25, 'start': 0, 'sort': "date desc", 'fields': "bibcode"}})
+                cache.flush()
+
+    def score(self, q):
+        return self.redis_client.zscore(self.hot_keys._key("SCORES"), self.search_key(q))
+
+    def test_record(self):
+        self.request("star", "star", "galaxy")
+        assert self.score("star") == 2
+        # Keys are counted once per request
+        with self.app.test_request_context():
+            RequestsManager.init(auth={'access_token': "token", 'expire_in': "2050-01-01T00:00:00", 'bot': False}, cookies={})
+            Search("galaxy", fields="bibcode")
+            Search("galaxy", fields="bibcode")
+            cache.flush()
+        assert self.score("galaxy") == 2
+        recipe = json_codec.loads(self.redis_client.hget(self.hot_keys._key("RECIPES"), self.search_key("galaxy")))
+        assert recipe['search']['q'] == "galaxy"
+
+    def test_refresh_top(self):
+        self.request("star", "star", "star", "galaxy", "galaxy", "comet")
+        self.hot_keys.refresh()
+        # Only the most requested searches are rebuilt
+        assert self.searches == ["star", "galaxy"]
+        assert self.redis_client.exists(self.search_key("star"))
+        assert not self.redis_client.exists(self.search_key("comet"))
+        assert self.hot_keys.stats()['refreshed'] == 2
+        # Counts decay every interval
+        assert self.score("star") == 1.5
+        # Only one worker refreshes per interval
+        self.hot_keys.refresh()
+        assert self.searches == ["star", "galaxy"]
+        assert self.hot_keys.stats()['cycles'] == 1
+
+    def test_keys_not_about_to_expire(self):
+        self.request("star", "galaxy")
+        self.redis_client.set(self.search_key("star"), b"{}", ex=self.app.config['HOT_KEYS_REFRESH_BEFORE'] * 2)
+        self.redis_client.set(self.search_key("galaxy"), b"{}", ex=self.app.config['HOT_KEYS_REFRESH_BEFORE'] // 2)
+        self.hot_keys.refresh()
+        assert self.searches == ["galaxy"]
+
+    def test_budget(self):
+        self.hot_keys.budget = 2
+        self.request("star", "star", "galaxy")
+        self.hot_keys.refresh()
+        # One request per interval of 30 seconds, the most requested key first
+        assert self.searches == ["star"]
+        assert self.hot_keys.stats()['over_budget'] == 1
+
+    def test_forgotten_keys(self):
+        self.request("star", "star", "galaxy", "galaxy", "comet", "comet", "nebula")
+        self.hot_keys.refresh()
+        assert self.score("nebula") is None
+        assert self.redis_client.hget(self.hot_keys._key("RECIPES"), self.search_key("nebula")) is None
+        assert self.redis_client.zcard(self.hot_keys._key("SCORES")) == 3
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import threading
+import http.server
+from adscore.http_pools import HTTPPool, PoolStats
+from adscore.tests import ADSCoreTestCase
+import unittest
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # Keep connections open between requests
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+class TestHTTPPools(ADSCoreTestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "http://127.0.0.1:{}/".format(self.server.server_address[1])
+
+    def test_routing(self):
+        http_pools = self.app.extensions['http_pools']
+        assert http_pools.pool(self.app.config['SEARCH_SERVICE'] + "?q=star").name == 'SEARCH_SERVICE'
+        assert http_pools.pool(self.app.config['METRICS_SERVICE']).name == 'METRICS_SERVICE'
+        assert http_pools.pool("https://example.org/").name == 'default'
+
+    def test_connections_are_reused(self):
+        pool = HTTPPool('test', self.url, size=2, keep_alive=50, timeout=5, warm_up=1)
+        for _ in range(3):
+            assert pool.session.get(self.url, timeout=pool.timeout).status_code == 200
+        stats = pool.stats()
+        assert stats['requests'] == 3
+        assert stats['reused'] == 2
+        assert stats['expired'] == 0
+
+    def test_idle_connections_expire(self):
+        pool = HTTPPool('test', self.url, size=2, keep_alive=0, timeout=5, warm_up=1)
+        for _ in range(3):
+            assert pool.session.get(self.url, timeout=pool.timeout).status_code == 200
+        stats = pool.stats()
+        assert stats['requests'] == 3
+        assert stats['reused'] == 0
+        assert stats['expired'] == 2
+
+    def test_concurrent_stats(self):
+        pool_stats = PoolStats()
+        def record():
+            for _ in range(10000):
+                pool_stats.record(0.001, reused=True, expired=False)
+        threads = [threading.Thread(target=record) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert pool_stats.to_dict()['requests'] == 80000
+        assert pool_stats.to_dict()['reused'] == 80000
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import threading
+import http.server
+from adscore import json_codec
+from adscore.api import RequestsManager
+from adscore.tests import ADSCoreTestCase
+import unittest
+
+class TestCodecs(ADSCoreTestCase):
+
+    def test_codecs(self):
+        for name in json_codec.CODECS:
+            try:
+                codec = json_codec.get_codec(name)
+            except ImportError:
+                continue
+            obj = {'title': ["Étoiles à neutrons"], 'citation_count': 1, 'property': []}
+            data = codec.dumps(obj)
+            assert isinstance(data, bytes)
+            assert codec.loads(data) == obj
+            assert codec.loads(data.decode('utf-8')) == obj
+            with self.assertRaises(ValueError):
+                codec.loads(b'{"title": ')
+
+    def test_configured_codec(self):
+        self.app.config['JSON_CODEC'] = "json"
+        assert json_codec.dumps({'a': 1}) == b'{"a": 1}'
+        assert json_codec.loads(b'{"a": 1}') == {'a': 1}
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = b'{"docs": ["' + b'x' * (2000 if self.path != "/small" else 10) + b'"]}'
+        self.send_response(200)
+        self.send_header('Content-Type', "application/json")
+        if self.path != "/unannounced":
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class TestResponseSize(ADSCoreTestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        self.app.config['API_MAX_RESPONSE_SIZE'] = 1000
+        RequestsManager.init(auth={'access_token': "token", 'expire_in': "2050-01-01T00:00:00", 'bot': False}, cookies={})
+
+    def test_response_size(self):
+        manager = RequestsManager()
+        assert manager.request(self.url + "/small", None) == {'docs': ["x" * 10]}
+        # Announced by Content-Length or detected while reading the body
+        assert manager.request(self.url + "/large", None) == {"error": "Response is too large"}
+        assert manager.request(self.url + "/unannounced", None) == {"error": "Response is too large"}
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import time
+import shutil
+import tempfile
+from adscore.tests import ADSCoreTestCase
+import unittest
+
+class TestLocalCache(ADSCoreTestCase):
+
+    def create_app(self):
+        from adscore import create_app
+        self.path = tempfile.mkdtemp()
+        return create_app(**{
+            'TESTING': True,
+            'LOCAL_CACHE_ENABLED': True,
+            'LOCAL_CACHE_PATH': self.path,
+            'LOCAL_CACHE_MAP_SIZE': 1048576,
+            'LOCAL_CACHE_EXPIRATION_TIME': 3600,
+            'LOCAL_CACHE_EVICTION_BATCH': 50,
+        })
+
+    def tearDown(self):
+        self.app.extensions['local_cache'].close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_get_set(self):
+        local_cache = self.app.extensions['local_cache']
+        local_cache.set_many([("key-1", "value-1"), ("key-2", b"value-2")], ex=60)
+        assert local_cache.get_many(["key-1", "key-2", "missing"]) == [b"value-1", b"value-2", None]
+        # Expiration times are capped
+        local_cache.set("key-3", "value-3", ex=7200)
+        with local_cache._open().begin(db=local_cache._values) as txn:
+            expires_at = local_cache.header.unpack_from(txn.get(b"key-3"))[0]
+        assert expires_at <= time.time() + 3600
+        local_cache.set("expired", "value", ex=-1)
+        assert local_cache.get("expired") is None
+        local_cache.delete(["key-1"])
+        assert local_cache.get("key-1") is None
+
+    def test_long_keys(self):
+        local_cache = self.app.extensions['local_cache']
+        key = "key-" + "x" * 1000
+        local_cache.set(key, "value", ex=60)
+        assert local_cache.get(key) == b"value"
+
+    def test_eviction(self):
+        local_cache = self.app.extensions['local_cache']
+        for i in range(1000):
+            # Keys written later expire later
+            local_cache.set("key-{}".format(i), b"x" * 4000, ex=60 + i)
+        env = local_cache._open()
+        assert local_cache.evictions > 0
+        # Eviction starts at 80% of the database size, it never gets full
+        assert local_cache._used_bytes(env) <= local_cache.map_size
+        assert local_cache.evictions % 50 == 0
+        assert local_cache.get("key-0") is None
+        assert local_cache.get("key-999") == b"x" * 4000
+        # The index sorted by expiration time matches the values
+        with env.begin() as txn:
+            assert txn.stat(local_cache._values)['entries'] == txn.stat(local_cache._expirations)['entries'] == 1000 - local_cache.evictions
+
+
+if __name__ == '__main__':
+    unittest.main()
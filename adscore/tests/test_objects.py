@@ -0,0 +1,52 @@
+from flask import g
+from adscore import cache
+from adscore.api import objects, RequestsManager
+from adscore.tests import ADSCoreTestCase
+import unittest
+
+class TestTranslate(ADSCoreTestCase):
+
+    translations = {
+        "object:M67": "((=abs:M67 OR simbid:1136125 OR nedid:MESSIER_067) database:astronomy)",
+        'object:"NGC 188"': "((=abs:\"NGC 188\" OR simbid:1155547) database:astronomy)",
+    }
+
+    def setUp(self):
+        self.requests = []
+        RequestsManager.init(auth={'access_token': "token"}, cookies={})
+        g.manager_instance.request = self._request
+
+    def _request(self, endpoint, params, method="GET", **kwargs):
+        term = params['query'][0]
+        self.requests.append(term)
+        if term not in self.translations:
+            return {"error": "Unknown object (HTTP status code 400)", "status_code": 400}
+        return {'query': self.translations[term]}
+
+    def test_terms_are_shared(self):
+        manager = RequestsManager()
+        assert objects.translate(manager, "object:M67  year:2020") == {'query': self.translations["object:M67"] + " year:2020"}
+        assert objects.translate(manager, "object:M67 year:2021") == {'query': self.translations["object:M67"] + " year:2021"}
+        assert self.requests == ["object:M67"]
+        results = objects.translate(manager, '(object:M67 OR object:"NGC 188") property:refereed')
+        assert results == {'query': "({} OR {}) property:refereed".format(self.translations["object:M67"], self.translations['object:"NGC 188"'])}
+        assert self.requests == ["object:M67", 'object:"NGC 188"']
+
+    def test_translations_are_cached(self):
+        objects.translate(RequestsManager(), "object:M67 year:2020")
+        cache.flush()
+        with self.app.app_context(), self.app.test_request_context():
+            RequestsManager.init(auth={'access_token': "token"}, cookies={})
+            g.manager_instance.request = self._request
+            objects.translate(RequestsManager(), "object:M67 year:2021")
+        assert self.requests == ["object:M67"]
+
+    def test_errors_are_not_cached(self):
+        manager = RequestsManager()
+        assert 'error' in objects.translate(manager, "object:Unknown year:2020")
+        assert 'error' in objects.translate(manager, "object:Unknown year:2020")
+        assert self.requests == ["object:Unknown", "object:Unknown"]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+from flask import g
+from adscore.api import RequestsManager
+from adscore.api.api import SEARCH_FIELDS
+from adscore.api.search import Search
+from adscore.tests import ADSCoreTestCase
+import unittest
+
+class TestSearchPrefetcher(ADSCoreTestCase):
+
+    def create_app(self):
+        from adscore import create_app
+        return create_app(**{
+            'TESTING': True,
+            'SEARCH_PREFETCH_ENABLED': True,
+            'SEARCH_PREFETCH_MAX_CONCURRENT': 1,
+        })
+
+    def setUp(self):
+        self.searches = []
+        self.prefetcher = self.app.extensions['search_prefetcher']
+        manager_class = RequestsManager._RequestsManager__RequestsManager
+        original_request = manager_class.request
+        manager_class.request = lambda manager, endpoint, params, **kwargs: self._request(params)
+        self.addCleanup(setattr, manager_class, 'request', original_request)
+        RequestsManager.init(auth={'access_token': "token", 'expire_in': "2050-01-01T00:00:00", 'bot': False}, cookies={})
+
+    def _request(self, params):
+        self.searches.append(int(params['start']))
+        docs = [{'bibcode': "2019A&A...629L..{:03d}C".format(int(params['start']) + i), '[citations]': {'num_references': 0, 'num_citations': 0}} for i in range(int(params['rows']))]
+        return {'responseHeader': {'QTime': 1}, 'response': {'numFound': 30, 'docs': docs}}
+
+    def _wait(self):
+        """
+        Wait for the background threads, a new pool is created for the next page
+        """
+        self.prefetcher._executor.shutdown(wait=True)
+        self.prefetcher._pid = None
+
+    def _serve(self, start):
+        results = Search("star", rows=10, start=start, fields=SEARCH_FIELDS)
+        self.prefetcher.served("star", 10, start, "date desc", results)
+        self._wait()
+
+    def test_next_page(self):
+        redis_client = self.app.extensions['redis']
+        self._serve(0)
+        assert self.searches == [0, 10]
+        assert redis_client.exists(Search.cache_key("star", rows=10, start=10, sort="date desc", fields=SEARCH_FIELDS, count=False))
+        # The prefetched page is served from the cache and counted as a hit
+        self._serve(10)
+        assert self.searches == [0, 10, 20]
+        stats = self.prefetcher.stats()
+        assert stats['prefetched'] == 2
+        assert stats['hits'] == 1
+        assert stats['hit_rate'] == 0.5
+        # There is no page after the last one
+        self._serve(20)
+        assert self.searches == [0, 10, 20]
+
+    def test_same_page_is_not_prefetched_again(self):
+        self._serve(0)
+        self.app.extensions['redis'].delete(Search.cache_key("star", rows=10, start=10, sort="date desc", fields=SEARCH_FIELDS, count=False))
+        self._serve(0)
+        assert self.searches == [0, 10]
+        assert self.prefetcher.stats()['throttled'] == 1
+
+    def test_busy_slots(self):
+        self.prefetcher._slots.acquire()
+        self._serve(0)
+        self.prefetcher._slots.release()
+        assert self.searches == [0]
+        assert self.prefetcher.stats()['skipped'] == 1
+
+    def test_no_bootstrap(self):
+        g.manager_instance.auth = {}
+        results = {'response': {'numFound': 30, 'docs': []}}
+        self.prefetcher.served("star", 10, 0, "date desc", results)
+        self._wait()
+        assert self.searches == []
+
+
+if __name__ == '__main__':
+    unittest.main()
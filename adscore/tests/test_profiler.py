@@ -0,0 +1,63 @@
+import time
+import shutil
+import tempfile
+from adscore.tests import ADSCoreTestCase
+import unittest
+
+def _busy(seconds):
+    until = time.time() + seconds
+    while time.time() < until:
+        pass
+
+class TestSamplingProfiler(ADSCoreTestCase):
+
+    def create_app(self):
+        from adscore import create_app
+        self.output_dir = tempfile.mkdtemp()
+        return create_app(**{
+            'TESTING': True,
+            'PROFILER_INTERVAL': 0.005,
+            'PROFILER_OUTPUT_DIR': self.output_dir,
+        })
+
+    def setUp(self):
+        self.addCleanup(shutil.rmtree, self.output_dir, True)
+
+    def test_profile(self):
+        profiler = self.app.extensions['profiler']
+        assert profiler.start(duration=0.5, rate=1.0)
+        # Only one profile at a time
+        assert not profiler.start(duration=0.5)
+        with self.app.test_request_context():
+            profiler._before_request()
+            _busy(0.2)
+            profiler._teardown_request(None)
+        # Threads that are not handling requests are not sampled
+        _busy(0.1)
+        # The session is forgotten once its profile has been written
+        while profiler._session is not None:
+            time.sleep(0.05)
+        stats = profiler.stats()
+        assert stats['samples'] > 0
+        assert len(stats['files']) == 1
+        with open(stats['files'][0]) as f:
+            lines = f.read().splitlines()
+        assert sum(int(line.rpartition(" ")[2]) for line in lines) == stats['samples']
+        assert all("test_profiler:test_profile;" in line for line in lines)
+        assert any(line.rpartition(" ")[0].endswith("test_profiler:_busy") for line in lines)
+
+    def test_sampling_rate(self):
+        profiler = self.app.extensions['profiler']
+        assert profiler.start(duration=0.2, rate=0.0)
+        with self.app.test_request_context():
+            profiler._before_request()
+            _busy(0.1)
+            profiler._teardown_request(None)
+        while profiler._session is not None:
+            time.sleep(0.05)
+        assert profiler.stats()['samples'] == 0
+        assert profiler.stats()['files'] == []
+
+
+if __name__ == '__main__':
+    unittest.main()
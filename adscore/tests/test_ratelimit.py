@@ -0,0 +1,100 @@
+from werkzeug.exceptions import TooManyRequests
+from adscore import ratelimit
+from adscore.ratelimit import SlidingWindowRedisStorage
+from adscore.tests import ADSCoreTestCase
+import unittest
+
+class TestSlidingWindowRedisStorage(ADSCoreTestCase):
+
+    def create_app(self):
+        from adscore import create_app
+        return create_app(**{
+            'TESTING': True,
+            'RATELIMIT_STORAGE_URL': "sliding+fakeredis://",
+            'RATELIMIT_STRATEGY': "moving-window",
+            'RATELIMIT_STORAGE_OPTIONS': {'local_fraction': 0.5, 'local_batch': 10, 'local_interval': 5},
+        })
+
+    def test_script(self):
+        storage = SlidingWindowRedisStorage("sliding+fakeredis://")
+        storage.storage.set("key/0", 10)
+        # Half of the previous window still overlaps with the sliding window
+        assert storage.script(keys=["key/1", "key/0"], args=[10, 60, 0.5, 0]) == [1, 6]
+        # Pending hits are always added, the new hit only if it fits
+        assert storage.script(keys=["key/1", "key/0"], args=[10, 60, 0.5, 4]) == [0, 10]
+        assert storage.storage.get("key/1") == b'5'
+        assert 60 < storage.storage.ttl("key/1") <= 120
+
+    def test_local_batching(self):
+        storage = SlidingWindowRedisStorage("sliding+fakeredis://", local_fraction=0.5, local_batch=10, local_interval=5)
+        allowed = [storage.acquire_entry("LIMITER/key", 10, 3600) for _ in range(15)]
+        assert allowed == [True] * 10 + [False] * 5
+        # Hits are only accepted locally while the count is below half the limit
+        assert storage.stats()['local_hits'] == 4
+        assert storage.stats()['redis_hits'] == 11
+        assert storage.get_moving_window("LIMITER/key", 10, 3600)[1] == 10
+
+    def test_pending_hits_are_shared(self):
+        storages = [SlidingWindowRedisStorage("sliding+fakeredis://", local_fraction=0.5, local_batch=10, local_interval=5) for _ in range(2)]
+        # Both workers share the same Redis
+        storages[1].storage = storages[0].storage
+        storages[1].script = storages[1].storage.register_script(ratelimit.SLIDING_WINDOW_SCRIPT)
+        allowed = [storages[i % 2].acquire_entry("LIMITER/key", 20, 3600) for i in range(30)]
+        assert allowed.count(True) <= 20
+        for storage in storages:
+            storage.acquire_entry("LIMITER/key", 20, 3600)
+        assert int(storages[0].storage.get("LIMITER/key/{}".format(storages[0].buckets["LIMITER/key"].window))) == 20
+
+    def test_pending_hits(self):
+        storage = SlidingWindowRedisStorage("sliding+fakeredis://", local_fraction=0.5, local_batch=10, local_interval=5)
+        for _ in range(4):
+            storage.acquire_entry("LIMITER/key", 100, 3600)
+        assert storage.buckets["LIMITER/key"].pending == 3
+        # Pending hits are kept while Redis cannot be reached...
+        script = storage.script
+        def unreachable(*args, **kwargs):
+            raise ConnectionError("Redis is down")
+        storage.script = unreachable
+        storage.buckets["LIMITER/key"].tokens = 0
+        with self.assertRaises(ConnectionError):
+            storage.acquire_entry("LIMITER/key", 100, 3600)
+        assert storage.buckets["LIMITER/key"].pending == 3
+        storage.script = script
+        storage.acquire_entry("LIMITER/key", 100, 3600)
+        assert storage.buckets["LIMITER/key"].pending == 0
+        assert storage.get_moving_window("LIMITER/key", 100, 3600)[1] == 5
+        # ...but they are dropped once their fixed window has expired
+        storage.acquire_entry("LIMITER/key", 100, 3600)
+        storage.buckets["LIMITER/key"].window -= 1
+        storage.buckets["LIMITER/key"].tokens = 0
+        storage.acquire_entry("LIMITER/key", 100, 3600)
+        assert storage.buckets["LIMITER/key"].pending == 0
+        assert storage.get_moving_window("LIMITER/key", 100, 3600)[1] == 6
+
+    def test_hit(self):
+        with self.app.test_request_context(environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+            ratelimit.hit("2 per 1 day", "test")
+            ratelimit.hit("2 per 1 day", "test")
+            with self.assertRaises(TooManyRequests):
+                ratelimit.hit("2 per 1 day", "test")
+            # Other scopes and addresses are counted separately
+            ratelimit.hit("2 per 1 day", "other")
+        with self.app.test_request_context(environ_base={'REMOTE_ADDR': '10.0.0.2'}):
+            ratelimit.hit("2 per 1 day", "test")
+
+    def test_hit_fallback(self):
+        storage = self.app.extensions['limiter']._storage
+        def unreachable(*args, **kwargs):
+            raise ConnectionError("Redis is down")
+        storage.script = unreachable
+        with self.app.test_request_context(environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+            # Requests are allowed if the storage cannot be reached
+            for _ in range(3):
+                ratelimit.hit("1 per 1 day", "test")
+            self.app.config['RATELIMIT_SWALLOW_ERRORS'] = False
+            with self.assertRaises(ConnectionError):
+                ratelimit.hit("1 per 1 day", "test")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,365 @@
+import copy
+import hashlib
+import urllib.parse
+from flask import abort
+from adscore import cache, crawlers
+from adscore.api import RequestsManager
+from adscore.tests import ADSCoreTestCase
+import unittest
+
+BROWSER = "Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0"
+
+class RoutesTestCase(ADSCoreTestCase):
+    """
+    Requests to the routes of the application (only registered in the module
+    level application) with the API replaced by canned responses
+    """
+
+    records = {
+        "2019A&A...629L...7C": {'bibcode': "2019A&A...629L...7C", 'identifier': ["2019A&A...629L...7C", "10.1051/0004-6361/201936215"], 'title': ["A title"], 'author': ["Author, A."], 'property': [], 'citation_count': 1, '[citations]': {'num_references': 1, 'num_citations': 1}, 'pubdate': "2019-09-00"},
+    }
+
+    references = {
+        "Chen et al. 2019, A&A, 629, L7": "2019A&A...629L...7C",
+        "Einstein 1905, AnP, 17, 891": "1905AnP...322..891E",
+    }
+
+    def create_app(self):
+        from adscore import app
+        # Requests that fail must not leave their context behind
+        app.config['PRESERVE_CONTEXT_ON_EXCEPTION'] = False
+        return app
+
+    def setUp(self):
+        # Every request needs its own application context (and g), as in production
+        self._ctx.pop()
+        self.addCleanup(self._ctx.push)
+        self.app.extensions['redis'].flushdb()
+        self.app.extensions['limiter'].reset()
+        self.requests = []
+        self.unavailable = set()
+        manager_class = RequestsManager._RequestsManager__RequestsManager
+        original_request = manager_class.request
+        def request(manager, endpoint, params, **kwargs):
+            if not manager.auth and endpoint != self.app.config['BOOTSTRAP_SERVICE']:
+                manager._bootstrap()
+            return self._request(endpoint, params, **kwargs)
+        manager_class.request = request
+        self.addCleanup(setattr, manager_class, 'request', original_request)
+
+    def _request(self, endpoint, params, method="GET", **kwargs):
+        config = self.app.config
+        self.requests.append(endpoint)
+        service = [name for name in ('BOOTSTRAP_SERVICE', 'SEARCH_SERVICE', 'GRAPHICS_SERVICE', 'METRICS_SERVICE', 'EXPORT_SERVICE', 'RESOLVER_SERVICE', 'LINKGATEWAY_SERVICE', 'REFERENCE_SERVICE', 'VAULT_SERVICE') if endpoint.startswith(config[name])][0]
+        if service in self.unavailable:
+            abort(503)
+        if service == 'BOOTSTRAP_SERVICE':
+            return {'access_token': "token", 'expire_in': "2050-01-01T00:00:00"}
+        if service == 'SEARCH_SERVICE':
+            identifier = params['q'].partition('identifier:"')[2].rstrip('"')
+            docs = [copy.deepcopy(record) for record in self.records.values() if identifier in record['identifier']]
+            return {'responseHeader': {'QTime': 1}, 'response': {'numFound': len(docs), 'docs': docs}}
+        if service == 'METRICS_SERVICE':
+            return {'citation stats': {'total number of citations': 1, 'normalized number of citations': 1., 'total number of refereed citations': 1, 'normalized number of refereed citations': 1.},
+                    'basic stats': {'total number of reads': 1, 'total number of downloads': 1}}
+        if service == 'EXPORT_SERVICE':
+            return {'export': "@ARTICLE{2019A&A...629L...7C}"}
+        if service == 'GRAPHICS_SERVICE':
+            return {'figures': []}
+        if service == 'REFERENCE_SERVICE':
+            text = urllib.parse.unquote(endpoint[len(config[service])+1:])
+            if text not in self.references:
+                return {"error": "Unable to resolve the reference (HTTP status code 400)", "status_code": 400}
+            return {'resolved': {'bibcode': self.references[text], 'score': "1.0"}}
+        if service == 'VAULT_SERVICE':
+            return {'qid': hashlib.sha1(params['bigquery'][0].encode('utf-8')).hexdigest()}
+        return {}
+
+    def get(self, path, **kwargs):
+        headers = kwargs.pop('headers', {})
+        headers.setdefault('User-Agent', BROWSER)
+        return self.client.get(path, headers=headers, **kwargs)
+
+    def get_cached(self, path, **kwargs):
+        """
+        Request a page as a visitor without session after another visitor filled
+        the caches (the first visitor bootstraps and gets a session)
+        """
+        self.get(path, **kwargs)
+        self.client.cookie_jar.clear()
+        return self.get(path, **kwargs)
+
+    def key(self, setting, identifier):
+        return "/".join((self.app.config[setting], identifier))
+
+    def is_public(self, response):
+        return response.headers.get('Cache-Control', '').startswith("public")
+
+class TestCacheControl(RoutesTestCase):
+
+    def test_anonymous_abstract(self):
+        response = self.get_cached("/abs/2019A&A...629L...7C/abstract")
+        assert response.status_code == 200
+        assert response.headers['Cache-Control'] == "public, max-age={}, s-maxage={}".format(self.app.config['CACHE_CONTROL_MAX_AGE'], self.app.config['CACHE_CONTROL_S_MAXAGE'])
+        assert response.headers['Surrogate-Key'] == "2019A&A...629L...7C 2019A&A...629L...7C/abstract"
+        assert 'Cookie' not in response.vary
+
+    def test_bbb_session(self):
+        self.client.set_cookie("localhost", "session", "bbb")
+        response = self.get("/abs/2019A&A...629L...7C/abstract")
+        assert response.status_code == 200
+        assert not self.is_public(response)
+        assert 'Surrogate-Key' not in response.headers
+
+    def test_cookie_dependent_pages(self):
+        for section in ("citations", "references", "coreads", "similar", "toc"):
+            response = self.get_cached("/abs/2019A&A...629L...7C/" + section)
+            assert response.status_code == 200
+            assert self.is_public(response)
+            assert 'Cookie' in response.vary
+        self.client.set_cookie("localhost", "core", "always")
+        response = self.get("/abs/2019A&A...629L...7C/citations")
+        assert response.status_code == 302
+        assert "/search/" in response.headers['Location']
+        assert not self.is_public(response)
+
+    def test_degraded_pages_are_not_shared(self):
+        self.unavailable.add('METRICS_SERVICE')
+        response = self.get_cached("/abs/2019A&A...629L...7C/metrics")
+        assert not self.is_public(response)
+        self.unavailable.clear()
+        response = self.get_cached("/abs/2019A&A...629L...7C/metrics")
+        assert response.status_code == 200
+        assert self.is_public(response)
+        assert response.headers['Surrogate-Key'] == "2019A&A...629L...7C 2019A&A...629L...7C/metrics"
+
+    def test_errors_are_not_shared(self):
+        response = self.get("/abs/2000Missing.....1....A/abstract")
+        assert response.status_code == 404
+        assert not self.is_public(response)
+
+class TestSession(RoutesTestCase):
+
+    def test_session_is_written_once(self):
+        response = self.get("/abs/2019A&A...629L...7C/exportcitation")
+        assert response.status_code == 200
+        assert self.requests.count(self.app.config['BOOTSTRAP_SERVICE']) == 1
+        assert response.headers['Set-Cookie'].startswith(self.app.config['SESSION_COOKIE_NAME'] + "=")
+        assert response.headers['Cache-Control'] == "private"
+        # The auth data did not change, the session is not re-signed
+        response = self.get("/abs/2019A&A...629L...7C/exportcitation")
+        assert response.status_code == 200
+        assert self.requests.count(self.app.config['BOOTSTRAP_SERVICE']) == 1
+        assert 'Set-Cookie' not in response.headers
+
+    def test_cached_pages_do_not_bootstrap(self):
+        self.get("/abs/2019A&A...629L...7C/abstract")
+        self.client.cookie_jar.clear()
+        self.requests.clear()
+        response = self.get("/abs/2019A&A...629L...7C/abstract")
+        assert response.status_code == 200
+        assert self.requests == []
+        assert 'Set-Cookie' not in response.headers
+        assert self.is_public(response)
+
+    def test_bootstrap_limit(self):
+        self.addCleanup(self.app.config.__setitem__, 'RATELIMIT_BOOTSTRAP', self.app.config['RATELIMIT_BOOTSTRAP'])
+        self.app.config['RATELIMIT_BOOTSTRAP'] = "1 per 1 day"
+        assert self.get("/abs/2019A&A...629L...7C/exportcitation").status_code == 200
+        self.client.cookie_jar.clear()
+        # Requests served from the cache do not bootstrap and are not affected
+        assert self.get("/abs/2019A&A...629L...7C/exportcitation").status_code == 200
+        self.app.extensions['redis'].flushdb()
+        assert self.get("/abs/2019A&A...629L...7C/exportcitation").status_code == 429
+
+class TestMissingIdentifiers(RoutesTestCase):
+
+    def test_malformed_identifiers(self):
+        for path in ("/abs/2019A&A...629L...7*/abstract", "/abs/2019A&A...629L...7C%20OR%20year:2019/abstract",
+                     "/abs/short/abstract", "/abs/10.1051/" + "x" * self.app.config['IDENTIFIER_MAX_LENGTH']):
+            assert self.get(path).status_code == 404
+        # Rejected before any cache or API access
+        assert self.requests == []
+        # Only the bot evaluation of the client was cached
+        assert self.app.extensions['redis'].keys("*") == [self.key('REDIS_REQUESTS_KEY_PREFIX', "127.0.0.1/" + BROWSER).encode('utf-8')]
+
+    def test_missing_identifiers(self):
+        search_service = self.app.config['SEARCH_SERVICE']
+        assert self.get("/abs/2000Missing.....1....A/abstract").status_code == 404
+        assert self.requests.count(search_service) == 1
+        assert self.app.extensions['redis'].get(self.key('REDIS_MISSING_KEY_PREFIX', "2000Missing.....1....A")) is not None
+        response = self.get("/abs/2000Missing.....1....A/abstract")
+        assert response.status_code == 404
+        assert not self.is_public(response)
+        assert self.requests.count(search_service) == 1
+
+    def test_search_errors_are_not_remembered(self):
+        self.unavailable.add('SEARCH_SERVICE')
+        assert self.get("/abs/2019A&A...629L...7C/abstract").status_code == 503
+        assert self.app.extensions['redis'].get(self.key('REDIS_MISSING_KEY_PREFIX', "2019A&A...629L...7C")) is None
+        self.unavailable.clear()
+        assert self.get("/abs/2019A&A...629L...7C/abstract").status_code == 200
+
+class TestAliases(RoutesTestCase):
+
+    def test_alias_redirect(self):
+        redis_client = self.app.extensions['redis']
+        search_service = self.app.config['SEARCH_SERVICE']
+        for section in ("abstract", "metrics"):
+            response = self.get("/abs/10.1051/0004-6361/201936215/" + section)
+            assert response.status_code == 301
+            assert urllib.parse.unquote(response.headers['Location']).endswith("/abs/2019A&A...629L...7C/" + section)
+        # The record was retrieved once and it is only stored under its bibcode
+        assert self.requests.count(search_service) == 1
+        assert redis_client.get(self.key('REDIS_ALIAS_KEY_PREFIX', "10.1051/0004-6361/201936215")) == b"2019A&A...629L...7C"
+        assert redis_client.get("10.1051/0004-6361/201936215") is None
+        assert redis_client.get("2019A&A...629L...7C") is not None
+        response = self.get("/abs/2019A&A...629L...7C/abstract")
+        assert response.status_code == 200
+        assert self.requests.count(search_service) == 1
+
+    def test_purged_alias(self):
+        self.get("/abs/10.1051/0004-6361/201936215/abstract")
+        with self.app.app_context():
+            cache.purge("2019A&A...629L...7C")
+        assert self.app.extensions['redis'].get(self.key('REDIS_ALIAS_KEY_PREFIX', "10.1051/0004-6361/201936215")) is None
+        assert self.get("/abs/10.1051/0004-6361/201936215/abstract").status_code == 301
+        assert self.requests.count(self.app.config['SEARCH_SERVICE']) == 2
+
+class TestReferences(RoutesTestCase):
+
+    def reference_key(self, text):
+        return self.key('REDIS_REFERENCES_KEY_PREFIX', hashlib.sha1(text.encode('utf-8')).hexdigest())
+
+    def resolutions(self):
+        return len([endpoint for endpoint in self.requests if endpoint.startswith(self.app.config['REFERENCE_SERVICE'] + "/")])
+
+    def test_reference(self):
+        redis_client = self.app.extensions['redis']
+        response = self.get("/paper-form", query_string={'reference': "Chen et al. 2019, A&A, 629, L7"})
+        assert response.status_code == 302
+        assert "bibcode%3A2019A%26A...629L...7C" in response.headers['Location']
+        ttl = redis_client.ttl(self.reference_key("Chen et al. 2019, A&A, 629, L7"))
+        assert self.app.config['REDIS_REFERENCES_NEGATIVE_EXPIRATION_TIME'] < ttl <= self.app.config['REDIS_REFERENCES_EXPIRATION_TIME']
+        # References that only differ in whitespace share the cached resolution
+        response = self.get("/paper-form", query_string={'reference': " Chen et al.  2019,\tA&A, 629, L7 "})
+        assert response.status_code == 302
+        assert self.resolutions() == 1
+
+    def test_unresolved_reference(self):
+        response = self.get("/paper-form", query_string={'reference': "Unknown 2019"})
+        assert response.status_code == 200
+        assert b"Error occurred resolving reference" in response.data
+        assert 0 < self.app.extensions['redis'].ttl(self.reference_key("Unknown 2019")) <= self.app.config['REDIS_REFERENCES_NEGATIVE_EXPIRATION_TIME']
+        assert self.get("/paper-form", query_string={'reference': "Unknown 2019"}).status_code == 200
+        assert self.resolutions() == 1
+
+    def test_unavailable_reference_service(self):
+        self.unavailable.add('REFERENCE_SERVICE')
+        assert self.get("/paper-form", query_string={'reference': "Chen et al. 2019, A&A, 629, L7"}).status_code == 200
+        assert self.app.extensions['redis'].get(self.reference_key("Chen et al. 2019, A&A, 629, L7")) is None
+        self.unavailable.clear()
+        assert self.get("/paper-form", query_string={'reference': "Chen et al. 2019, A&A, 629, L7"}).status_code == 302
+
+    def test_reference_list(self):
+        references = "\n".join(["Chen et al. 2019, A&A, 629, L7", "", "Unknown 2019", "Einstein 1905, AnP, 17, 891"])
+        response = self.client.post("/paper-form", data={'references': references}, headers={'User-Agent': BROWSER})
+        assert response.status_code == 302
+        assert "docs%28" in response.headers['Location']
+        assert self.resolutions() == 3
+        # Only the resolved references are searched, with a single query
+        assert self.requests.count(self.app.config['VAULT_SERVICE']) == 1
+        # Resolutions are shared with later submissions
+        response = self.client.post("/paper-form", data={'references': references}, headers={'User-Agent': BROWSER})
+        assert response.status_code == 302
+        assert self.resolutions() == 3
+
+    def test_unresolved_reference_list(self):
+        response = self.client.post("/paper-form", data={'references': "Unknown 2019\nUnknown 2020"}, headers={'User-Agent': BROWSER})
+        assert response.status_code == 200
+        assert b"None of the references could be resolved" in response.data
+        assert self.app.config['VAULT_SERVICE'] not in self.requests
+
+    def test_reference_list_limit(self):
+        self.addCleanup(self.app.config.__setitem__, 'REFERENCES_MAX_BULK', self.app.config['REFERENCES_MAX_BULK'])
+        self.app.config['REFERENCES_MAX_BULK'] = 1
+        references = "Unknown 2019\nChen et al. 2019, A&A, 629, L7"
+        response = self.client.post("/paper-form", data={'references': references}, headers={'User-Agent': BROWSER})
+        assert response.status_code == 200
+        assert self.resolutions() == 1
+
+class TestExport(RoutesTestCase):
+
+    def setUp(self):
+        super(TestExport, self).setUp()
+        self.bibcodes = ["2019A&A...629L..{:03d}C".format(i) for i in range(5)]
+        self.failing_batch = None
+        for key in ('EXPORT_RATELIMIT', 'EXPORT_MAX_RECORDS', 'EXPORT_BATCH_SIZE'):
+            self.addCleanup(self.app.config.__setitem__, key, self.app.config[key])
+        self.app.config['EXPORT_BATCH_SIZE'] = 2
+
+    def _request(self, endpoint, params, method="GET", **kwargs):
+        config = self.app.config
+        if endpoint == config['SEARCH_SERVICE'] and 'cursorMark' in params:
+            self.requests.append(endpoint)
+            start = 0 if params['cursorMark'] == "*" else int(params['cursorMark'])
+            docs = [{'bibcode': bibcode} for bibcode in self.bibcodes[start:start+params['rows']]]
+            return {'responseHeader': {'QTime': 1}, 'response': {'numFound': len(self.bibcodes), 'docs': docs}, 'nextCursorMark': str(start + len(docs))}
+        if endpoint == config['EXPORT_SERVICE']:
+            self.requests.append(endpoint)
+            if params['bibcode'] == self.failing_batch:
+                return {"error": "Export failed"}
+            return {'export': "".join("@ARTICLE{{{}}}\n".format(bibcode) for bibcode in params['bibcode'])}
+        return super(TestExport, self)._request(endpoint, params, method=method, **kwargs)
+
+    def test_export(self):
+        response = self.get("/search/export", query_string={'q': "star"})
+        assert response.status_code == 200
+        assert response.headers['Content-Disposition'] == 'attachment; filename="export.bib"'
+        assert 'X-Export-Truncated' not in response.headers
+        # Batches are streamed in the order of the search results
+        assert response.get_data(as_text=True) == "".join("@ARTICLE{{{}}}\n".format(bibcode) for bibcode in self.bibcodes)
+        assert self.requests.count(self.app.config['EXPORT_SERVICE']) == 3
+
+    def test_truncated_export(self):
+        self.app.config['EXPORT_MAX_RECORDS'] = 3
+        response = self.get("/search/export", query_string={'q': "star"})
+        assert response.status_code == 200
+        assert response.headers['X-Export-Truncated'] == "3 of 5 records"
+        data = response.get_data(as_text=True)
+        assert data.count("@ARTICLE") == 3
+        assert data.endswith("\n% The export is truncated to the first 3 of 5 records\n")
+        assert self.requests.count(self.app.config['EXPORT_SERVICE']) == 2
+
+    def test_export_errors(self):
+        # Errors in the first batch are shown by the search page
+        self.failing_batch = self.bibcodes[:2]
+        response = self.get("/search/export", query_string={'q': "star"})
+        assert response.status_code == 302
+        assert "/search/" in response.headers['Location']
+        # Errors in later batches interrupt the export
+        self.failing_batch = self.bibcodes[2:4]
+        response = self.get("/search/export", query_string={'q': "star"})
+        assert response.status_code == 200
+        assert response.get_data(as_text=True).endswith("\n% The export was interrupted by an error, it is incomplete\n")
+
+    def test_bots_cannot_export(self):
+        self.app.extensions['redis'].set(self.key('REDIS_REQUESTS_KEY_PREFIX', "127.0.0.1/" + BROWSER), crawlers.VERIFIED_BOT)
+        assert self.get("/search/export", query_string={'q': "star"}).status_code == 403
+        assert self.requests == []
+
+    def test_export_limit(self):
+        self.app.config['EXPORT_RATELIMIT'] = "1 per 1 day"
+        assert self.get("/search/export", query_string={'q': "star"}).status_code == 200
+        # Sessions are also limited
+        assert self.client.cookie_jar
+        assert self.get("/search/export", query_string={'q': "star"}).status_code == 429
+
+    def test_missing_query(self):
+        response = self.get("/search/export")
+        assert response.status_code == 302
+        assert self.requests == []
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+from adscore.api import search
+from adscore.api.search import Search, canonical_params
+from adscore.tests import ADSCoreTestCase
+import unittest
+
+class TestCanonicalParams(ADSCoreTestCase):
+
+    def test_query(self):
+        assert canonical_params("  star  \t AND\nplanet ", 25, 0, "date desc", "bibcode")[0] == "star AND planet"
+        # Remaining '+' are query operators
+        assert canonical_params("+star +planet", 25, 0, "date desc", "bibcode")[0] == "+star +planet"
+
+    def test_pagination(self):
+        assert canonical_params("star", "25", "0", "date desc", "bibcode")[1:3] == ("25", "0")
+
+    def test_sort(self):
+        assert canonical_params("star", 25, 0, "date desc", "bibcode")[3] == "date desc, bibcode desc"
+        assert canonical_params("star", 25, 0, " date  DESC ,citation_count Asc", "bibcode")[3] == "date desc, citation_count asc, bibcode desc"
+        # Field names are case-sensitive
+        assert canonical_params("star", 25, 0, "Date desc", "bibcode")[3] == "Date desc, bibcode desc"
+        # The secondary sort is not repeated
+        assert canonical_params("star", 25, 0, "date desc, bibcode desc", "bibcode")[3] == "date desc, bibcode desc"
+
+    def test_fields(self):
+        assert canonical_params("star", 25, 0, "date desc", "title, bibcode,title,,author")[4] == "author,bibcode,title"
+
+    def test_cache_key(self):
+        key = Search.cache_key("star", rows=25, start=0, sort="date desc", fields="title,bibcode")
+        collapsed = search._key_stats['collapsed']
+        assert Search.cache_key("star ", rows="25", start=0, sort="date DESC, bibcode desc", fields="bibcode,title") == key
+        assert search._key_stats['collapsed'] == collapsed + 1
+        # Keys that are not requested by users are not counted
+        assert Search.cache_key("  star", rows=25, start=0, sort="date desc", fields="title,bibcode", count=False) == key
+        assert search._key_stats['collapsed'] == collapsed + 1
+        assert Search.cache_key("star", rows=25, start=25, sort="date desc", fields="title,bibcode") != key
+        assert Search.cache_key("star", rows=25, start=0, sort="date asc", fields="title,bibcode") != key
+
+
+if __name__ == '__main__':
+    unittest.main()
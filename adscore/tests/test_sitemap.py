@@ -0,0 +1,117 @@
+import os
+import gzip
+import shutil
+import tempfile
+import threading
+from adscore.sitemap import SitemapWriter, render_snapshots, snapshot_path
+from adscore.tests import ADSCoreTestCase
+from adscore.tests.test_routes import RoutesTestCase
+import unittest
+
+class TestSitemapWriter(ADSCoreTestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+
+    def read(self, filename):
+        with gzip.open(os.path.join(self.output_dir, filename), "rt", encoding="utf-8") as f:
+            return f.read()
+
+    def test_sharding(self):
+        writer = SitemapWriter(self.output_dir, "https://example.org/", "https://example.org/sitemap/", urls_per_file=2)
+        for bibcode in ("2019A&A...629L...7C", "1905AnP...322..891E", "2000ApJ...500..100A"):
+            writer.add(bibcode)
+        writer.close()
+        assert writer.urls == 3
+        assert writer.filenames == ["sitemap-00001.xml.gz", "sitemap-00002.xml.gz"]
+        first = self.read("sitemap-00001.xml.gz")
+        assert first.count("<url>") == 2
+        # Bibcodes are quoted and escaped
+        assert "<loc>https://example.org/abs/2019A%26A...629L...7C/abstract</loc>" in first
+        assert first.endswith("</urlset>\n")
+        assert self.read("sitemap-00002.xml.gz").count("<url>") == 1
+        with open(os.path.join(self.output_dir, "sitemap.xml"), encoding="utf-8") as f:
+            index = f.read()
+        assert index.count("<sitemap>") == 2
+        assert "<loc>https://example.org/sitemap/sitemap-00002.xml.gz</loc>" in index
+
+    def test_protocol_limit(self):
+        writer = SitemapWriter(self.output_dir, "https://example.org/", "https://example.org/sitemap/", urls_per_file=10**6)
+        assert writer.urls_per_file == 50000
+
+class TestSnapshots(ADSCoreTestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+
+    def test_render_snapshots(self):
+        def render(bibcode):
+            if bibcode.startswith("2000"):
+                return None
+            if bibcode.startswith("2001"):
+                raise ValueError(bibcode)
+            return "<html>{}</html>".format(bibcode)
+        bibcodes = ["2019A&A...629L...7C", "2000ApJ...500..100A", "2001ApJ...500..100A", "1905AnP...322..891E"]
+        assert render_snapshots(iter(bibcodes), render, self.output_dir, workers=2) == (2, 2)
+        path = snapshot_path(self.output_dir, "2019A&A...629L...7C")
+        assert path == os.path.join(self.output_dir, "abs", "2019A&A...629L...7C", "abstract.html")
+        with open(path, encoding="utf-8") as f:
+            assert f.read() == "<html>2019A&A...629L...7C</html>"
+        assert not os.path.exists(snapshot_path(self.output_dir, "2000ApJ...500..100A"))
+
+    def test_workers(self):
+        lock = threading.Lock()
+        running = {'current': 0, 'max': 0}
+        def render(bibcode):
+            with lock:
+                running['current'] += 1
+                running['max'] = max(running['max'], running['current'])
+            threading.Event().wait(0.01)
+            with lock:
+                running['current'] -= 1
+            return b""
+        bibcodes = ("2019A&A...629L.{:03d}C".format(i) for i in range(20))
+        assert render_snapshots(bibcodes, render, self.output_dir, workers=3) == (20, 0)
+        assert running['max'] <= 3
+
+class TestSitemapCommand(RoutesTestCase):
+
+    def setUp(self):
+        super(TestSitemapCommand, self).setUp()
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        self.bibcodes_file = os.path.join(self.output_dir, "bibcodes.txt")
+        with open(self.bibcodes_file, "w") as f:
+            f.write("2019A&A...629L...7C\n\n2000Missing.....1....A\n")
+
+    def test_bibcodes_file(self):
+        result = self.app.test_cli_runner().invoke(args=["sitemap", self.output_dir, "--bibcodes", self.bibcodes_file, "--base-url", "https://example.org"])
+        assert result.exit_code == 0, result.output
+        assert "Wrote 2 URLs in 1 sitemap files" in result.output
+        assert os.path.exists(os.path.join(self.output_dir, "sitemap.xml"))
+        # Without snapshots the API is not used
+        assert self.requests == []
+
+    def test_snapshots(self):
+        result = self.app.test_cli_runner().invoke(args=["sitemap", self.output_dir, "--bibcodes", self.bibcodes_file, "--base-url", "https://example.org/", "--snapshots"])
+        assert result.exit_code == 0, result.output
+        assert "Rendered 1 abstract pages (1 failed)" in result.output
+        with open(snapshot_path(self.output_dir, "2019A&A...629L...7C"), encoding="utf-8") as f:
+            assert "A title" in f.read()
+        # Verified bots credentials are used, no bootstrap
+        assert self.app.config['BOOTSTRAP_SERVICE'] not in self.requests
+        # The dynamic page is served from the data stored while rendering
+        self.requests.clear()
+        assert self.get("/abs/2019A&A...629L...7C/abstract").status_code == 200
+        assert self.app.config['SEARCH_SERVICE'] not in self.requests
+
+    def test_missing_source(self):
+        result = self.app.test_cli_runner().invoke(args=["sitemap", self.output_dir, "--base-url", "https://example.org/"])
+        assert result.exit_code != 0
+        assert "Either --query or --bibcodes has to be provided" in result.output
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+"""
+Decoding and encoding time of the available JSON codecs using recorded API
+responses (e.g., saved with curl from the search, metrics or export services).
+
+    python benchmarks/json_codec.py responses/*.json
+
+Without files, a synthetic search response with 2000 rows is used.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from adscore.json_codec import CODECS
+
+
+def synthetic_search_response(rows):
+    import json
+    random.seed(0)
+    docs = []
+    for i in range(rows):
+        docs.append({
+            'bibcode': "2019A&A...{:03d}L...{}C".format(i % 1000, i),
+            'title': ["Synthetic title number {} about stars and galaxies".format(i)],
+            'author': ["Author, {}".format(chr(65 + j % 26)) for j in range(random.randint(1, 30))],
+            'citation_count': random.randint(0, 1000),
+            'citation_count_norm': random.random() * 100,
+            'pubdate': "2019-{:02d}-00".format(random.randint(1, 12)),
+            '[citations]': {'num_citations': random.randint(0, 1000), 'num_references': random.randint(0, 100)},
+            'property': ["ARTICLE", "REFEREED", "ESOURCE", "DATA"],
+            'esources': ["PUB_PDF", "EPRINT_PDF", "PUB_HTML"],
+            'data': ["CDS:{}".format(random.randint(1, 10)), "NED:{}".format(random.randint(1, 100))],
+        })
+    return json.dumps({'responseHeader': {'status': 0, 'QTime': 42}, 'response': {'numFound': rows, 'start': 0, 'docs': docs}}).encode('utf-8')
+
+
+def measure(function, argument, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(argument)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('payloads', nargs='*', help="files with recorded JSON responses")
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.payloads:
+        payloads = []
+        for path in args.payloads:
+            with open(path, 'rb') as f:
+                payloads.append((os.path.basename(path), f.read()))
+    else:
+        payloads = [("synthetic search (2000 rows)", synthetic_search_response(2000))]
+
+    codecs = []
+    for name, codec_class in CODECS.items():
+        try:
+            codecs.append(codec_class())
+        except ImportError:
+            print("{:<8} not installed".format(name))
+
+    for payload_name, payload in payloads:
+        print("{} ({:.1f} KiB)".format(payload_name, len(payload) / 1024.))
+        obj = codecs[-1].loads(payload)
+        for codec in codecs:
+            loads = measure(codec.loads, payload, args.repeat)
+            dumps = measure(codec.dumps, obj, args.repeat)
+            print("  {:<8} loads {:>8.2f} ms  dumps {:>8.2f} ms".format(codec.name, loads * 1000, dumps * 1000))
+
+
+if __name__ == '__main__':
+    main()
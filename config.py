@@ -14,7 +14,29 @@ RESOLVER_SERVICE =  API_URL+"resolver/"
 GRAPHICS_SERVICE =  API_URL+"graphics/"
 METRICS_SERVICE =  API_URL+"metrics"
 LINKGATEWAY_SERVICE =  ADS_URL+"link_gateway/"
+CLICKS_ASYNC_ENABLED = True # log clicks to link_gateway from a background thread
+CLICKS_QUEUE_SIZE = 10000 # clicks waiting to be logged (new clicks are dropped when it is full)
+CLICKS_TIMEOUT = 5 # seconds
+CLICKS_RETRIES = 2
 API_TIMEOUT = 90
+API_MAX_RESPONSE_SIZE = 20971520 # bytes (larger responses from the API are discarded)
+JSON_CODEC = "auto" # orjson, ujson or json ("auto" uses the fastest one installed)
+SEARCH_PREFETCH_ENABLED = False # warm the cache with the next page of search results in the background
+SEARCH_PREFETCH_MAX_CONCURRENT = 2 # simultaneous prefetches per process (others are skipped)
+SEARCH_PREFETCH_INTERVAL = 60 # seconds (the same page is not prefetched again before it)
+EXPORT_MAX_RECORDS = 10000 # records per bulk export of search results
+EXPORT_BATCH_SIZE = 500 # bibcodes per request to the export service
+EXPORT_MAX_WORKERS = 2 # simultaneous requests to the export service per bulk export
+EXPORT_RATELIMIT = "50 per 1 day" # per IP, bulk exports of search results (sessions included, bots cannot export)
+HOT_KEYS_ENABLED = False # rebuild the most requested searches and abstracts before they expire
+HOT_KEYS_TOP = 100 # keys kept warm
+HOT_KEYS_MAX_TRACKED = 10000 # the least requested keys are forgotten beyond this number
+HOT_KEYS_DECAY = 0.9 # request counts are multiplied by this factor every refresh interval
+HOT_KEYS_REFRESH_INTERVAL = 30 # seconds
+HOT_KEYS_REFRESH_BEFORE = 60 # seconds before expiration (it has to be longer than the interval)
+HOT_KEYS_REFRESH_BUDGET = 60 # requests to the API per minute (shared by all the workers)
+REFERENCES_MAX_BULK = 500 # references resolved per paper form submission
+REFERENCES_MAX_WORKERS = 4 # simultaneous requests to the reference service per submission
 SECRET_KEY = "mjnahGS3CmaVsSfSVGxxytGTGa2vX1CPPoT7gZvIpIQiOZREJwsvfNzWooQx1BA1"
 SESSION_COOKIE_NAME = "session-core"
 SESSION_COOKIE_PATH = SERVER_BASE_URL
@@ -27,13 +49,68 @@ REDIS_EXPIRATION_TIME = 300 # seconds (expire in N seconds)
 REDIS_DATA_KEY_PREFIX = "CORE/DATA"
 REDIS_REQUESTS_KEY_PREFIX = "CORE/REQUESTS"
 REDIS_RENDER_KEY_PREFIX = "CORE/RENDER"
+REDIS_ABSTRACT_SECTIONS_EXPIRATION_TIME = { # seconds (sub-resources of abstracts)
+    "associated": 86400,
+    "graphics": 604800,
+    "metrics": 86400,
+    "export": 604800,
+}
+REDIS_OBJECTS_KEY_PREFIX = "CORE/OBJECTS"
+REDIS_OBJECTS_EXPIRATION_TIME = 604800 # seconds (7 days, object translations rarely change)
+REDIS_REFERENCES_KEY_PREFIX = "CORE/REFERENCES"
+REDIS_REFERENCES_EXPIRATION_TIME = 604800 # seconds (7 days)
+REDIS_REFERENCES_NEGATIVE_EXPIRATION_TIME = 3600 # seconds (references that could not be resolved)
+REDIS_VAULT_KEY_PREFIX = "CORE/VAULT"
+REDIS_VAULT_EXPIRATION_TIME = 2592000 # seconds (30 days, it cannot be longer than the vault retains queries)
+REDIS_PREFETCH_KEY_PREFIX = "CORE/PREFETCH"
+REDIS_ALIAS_KEY_PREFIX = "CORE/ALIAS"
+REDIS_ALIAS_EXPIRATION_TIME = 604800 # seconds (7 days, alternative identifiers rarely change their bibcode)
+REDIS_MISSING_KEY_PREFIX = "CORE/MISSING"
+REDIS_MISSING_EXPIRATION_TIME = 1800 # seconds (identifiers without record, new records are not found before it)
+REDIS_HOT_KEYS_KEY_PREFIX = "CORE/HOT"
+REDIS_TAGS_KEY_PREFIX = "CORE/TAGGED" # sorted sets of keys scored by expiration time
+REDIS_TAGS_EXPIRATION_TIME = 2678400 # seconds (it has to be longer than any other expiration time)
+LOCAL_CACHE_ENABLED = False # LMDB cache shared by all the workers of the same host, in front of Redis
+LOCAL_CACHE_PATH = "/dev/shm/adscore-cache"
+LOCAL_CACHE_MAP_SIZE = 536870912 # bytes (512 MB, maximum size of the local cache)
+LOCAL_CACHE_EXPIRATION_TIME = 60 # seconds (maximum, purged keys may still be served during this time)
+LOCAL_CACHE_EVICTION_BATCH = 1000 # entries removed every time the local cache is full
+CACHE_CONTROL_ENABLED = True # Allow shared caches (nginx/CDN) to store anonymous abstract pages
+CACHE_CONTROL_MAX_AGE = 0 # seconds (browsers)
+CACHE_CONTROL_S_MAXAGE = 300 # seconds (shared caches)
 DNS_LIFETIME = 2 # The total number of seconds to spend trying to get an answer to the question.
 DNS_TIMEOUT = 2 # The number of seconds to wait for a response from a server, before timing out.
+DNS_VERIFICATION_WORKERS = 4 # simultaneous bot verifications (reverse/forward DNS) per process, run in the background
+DNS_VERIFICATION_MAX_PENDING = 1000 # bots are not verified while there are more verifications pending
+DNS_VERIFICATION_PENDING_TIME = 30 # seconds (requests from a bot being verified are not classified again during this time)
 REQUESTS_CONNECTION_POOL_ENABLED = True
+UPSTREAM_LIMITS = { # simultaneous requests per worker to each upstream service setting name (other URLs share the default)
+    "default": {"concurrency": 20, "queue_timeout": 0.5, "max_queue": 20}, # queue_timeout: seconds waiting for a slot before shedding the request
+    "SEARCH_SERVICE": {"concurrency": 20, "queue_timeout": 1},
+    "EXPORT_SERVICE": {"concurrency": 5},
+    "METRICS_SERVICE": {"concurrency": 5},
+    "GRAPHICS_SERVICE": {"concurrency": 5},
+    "RESOLVER_SERVICE": {"concurrency": 5},
+    "REFERENCE_SERVICE": {"concurrency": 5},
+}
+HTTP_POOLS = { # connection pools per upstream service setting name (other URLs use the default pool)
+    "default": {"size": 10, "keep_alive": 50, "timeout": API_TIMEOUT, "warm_up": 1}, # keep_alive: seconds a connection can be idle before it is discarded
+    "SEARCH_SERVICE": {"size": 20, "warm_up": 2},
+    "EXPORT_SERVICE": {"size": 5},
+    "METRICS_SERVICE": {"size": 5, "timeout": 30},
+    "GRAPHICS_SERVICE": {"size": 5, "timeout": 30},
+    "LINKGATEWAY_SERVICE": {"size": 5, "timeout": 10},
+}
 RATELIMIT_DEFAULT = None # individual per route
 RATELIMIT_APPLICATION = "400 per 1 day" # shared by all routes; same value as in https://github.com/adsabs/adsws/blob/9ec9087d2baa4bbf754a8fb5cf915fa1032725ae/adsws/accounts/views.py#L853
-RATELIMIT_STORAGE_URL = "memory://" # "redis://redis-backend:6379"
-RATELIMIT_STRATEGY = "fixed-window"
+RATELIMIT_BOOTSTRAP = "400 per 1 day" # per IP, only requests that bootstrap an access token count; same value as in https://github.com/adsabs/adsws/blob/9ec9087d2baa4bbf754a8fb5cf915fa1032725ae/adsws/accounts/views.py#L853
+RATELIMIT_STORAGE_URL = "memory://" # "sliding+redis://redis-backend:6379" (shared by all the workers)
+RATELIMIT_STORAGE_OPTIONS = { # only for sliding+redis storage
+    'local_fraction': 0.5, # hits are accepted locally while the shared count is below this fraction of the limit...
+    'local_batch': 10, # ...up to this number of hits...
+    'local_interval': 5, # ...or during this number of seconds, before synchronizing with redis
+}
+RATELIMIT_STRATEGY = "fixed-window" # "moving-window" for sliding+redis storage
 RATELIMIT_HEADERS_ENABLED = True
 RATELIMIT_ENABLED = True
 RATELIMIT_SWALLOW_ERRORS = True
@@ -41,6 +118,14 @@ RATELIMIT_KEY_PREFIX = "core" # The final prefix will be LIMITER/core
 VERIFIED_BOTS_ACCESS_TOKEN = ""
 UNVERIFIABLE_BOTS_ACCESS_TOKEN = ""
 MALICIOUS_BOTS_ACCESS_TOKEN = ""
+ADMIN_ACCESS_TOKEN = "" # bearer token for admin endpoints (disabled if empty)
+PROFILER_ENABLED = False # sample the requests of every worker permanently (it can also be started per worker from admin/profiler)
+PROFILER_INTERVAL = 0.01 # seconds between stack samples
+PROFILER_DURATION = 60 # seconds (profiles started without duration, and interval between files when it is permanently enabled)
+PROFILER_MAX_DURATION = 600 # seconds (longest profile that can be started from admin/profiler)
+PROFILER_RATE = 1.0 # fraction of the requests that are sampled
+PROFILER_OUTPUT_DIR = "/tmp/adscore-profiles" # collapsed stack files
+IDENTIFIER_MAX_LENGTH = 256 # characters (longer abstract identifiers are rejected)
 MINIFY = False
 DISABLE_FULL_ADS_LINK = False
 ALERT_MESSAGE = ""
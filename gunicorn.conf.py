@@ -0,0 +1,37 @@
+"""
+Gunicorn settings to load the application once in the master process and fork
+the workers from it (gunicorn loads ./gunicorn.conf.py by default):
+
+    gunicorn wsgi:application
+
+Objects created while loading the application are moved to a permanent
+generation before forking, so that garbage collections in the workers do not
+touch (and copy) the memory pages they share with the master.
+"""
+import gc
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8181")
+workers = int(os.environ.get("GUNICORN_WORKERS", 4))
+preload_app = True
+
+# Avoid collections in the master while the application is loaded, they would
+# leave holes in the memory pages that are going to be shared
+gc.disable()
+
+def when_ready(server):
+    # The application is loaded and the workers have not been forked yet, later
+    # collections in the master do not touch the frozen objects
+    gc.freeze()
+    gc.enable()
+
+def pre_fork(server, worker):
+    # Also freeze what the master allocated since then (e.g., before re-spawning
+    # a worker)
+    gc.freeze()
+
+def post_fork(server, worker):
+    from adscore import app
+    if 'http_pools' in app.extensions:
+        # Open connections to the API before the first requests arrive
+        app.extensions['http_pools'].warm_up()